@@ -0,0 +1,111 @@
+#
+# Benchmark of the DDBChainRatchet against DynamoDB Local under
+# concurrent load.  We compare the conditional write made through a
+# boto3 resource with default settings, as the ratchet used to, with
+# the ratchet's tuned low-level client, with and without group commit.
+# Each thread plays a separate key, checking successive levels as fast
+# as it can, so that every check is a write.  The first checks are
+# included so that the cost of opening connections shows in the tail.
+#
+# Run with: python3 -m test.bench_ddbchainratchet [endpoint]
+
+import logging
+import sys
+import threading
+import time
+import uuid
+
+import boto3
+from botocore.exceptions import ClientError
+from werkzeug.exceptions import HTTPException
+
+from tezos_signer.config import TacoinfraConfig
+from tezos_signer.ddbchainratchet import DDBChainRatchet
+
+THREADS = [1, 8, 32, 64]
+DURATION = 3
+REGION = 'eu-west-1'
+TABLE = 'test'
+
+class ResourceRatchet:
+    def __init__(self, endpoint):
+        self.table = boto3.resource('dynamodb', region_name=REGION,
+                                    endpoint_url=endpoint).Table(TABLE)
+
+    def check(self, sig_type, level, round):
+        try:
+            self.table.put_item(
+                Item={'sig_type': sig_type, 'lastblock': level,
+                      'lastround': round},
+                ConditionExpression="attribute_not_exists(sig_type) OR " +
+                    "(lastblock < :l OR (lastblock = :l AND lastround < :r))",
+                ExpressionAttributeValues={':l': level, ':r': round})
+        except ClientError:
+            pass
+
+#
+# A write which times out may have been applied, in which case its retry
+# fails the condition and the ratchet refuses.  We count those, and any
+# other failures, as errors.
+
+def worker(ratchet, name, deadline, latencies, errors):
+    level = 0
+    while time.perf_counter() < deadline:
+        level += 1
+        start = time.perf_counter()
+        try:
+            ratchet.check(f'Endorsement_NetXdQprcVkpaWU_{name}', level, 0)
+        except HTTPException:
+            errors.append(level)
+        latencies.append(time.perf_counter() - start)
+
+def run(ratchet, nthreads):
+    prefix = uuid.uuid4().hex
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + DURATION
+    threads = [threading.Thread(target=worker,
+                                args=(ratchet, f'{prefix}{n}', deadline,
+                                      latencies, errors))
+               for n in range(nthreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    return (len(latencies) / DURATION,
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)],
+            latencies[-1],
+            len(errors))
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    endpoint = 'http://dynamodb-local:8000'
+    if len(sys.argv) > 1:
+        endpoint = sys.argv[1]
+
+    print(f"{'client':<9} {'threads':>7} {'checks/s':>9} {'p50 (ms)':>9} "
+          f"{'p99 (ms)':>9} {'max (ms)':>9} {'errors':>6}")
+    for nthreads in THREADS:
+        for name in ['resource', 'tuned', 'grouped']:
+            if name == 'resource':
+                ratchet = ResourceRatchet(endpoint)
+            else:
+                ratchet = DDBChainRatchet(TacoinfraConfig(conf={
+                    'aws_region': REGION,
+                    'boto3_endpoint': endpoint,
+                    'chain_ratchet': 'mockery',
+                    'ddb_group_commit': name == 'grouped',
+                    'ddb_pool_size': nthreads,
+                    'ddb_table': TABLE,
+                    'ddb_warmup': nthreads,
+                    'keys': [],
+                }))
+            rate, p50, p99, worst, errors = run(ratchet, nthreads)
+            print(f"{name:<9} {nthreads:>7} {rate:>9.1f} {p50 * 1e3:>9.2f} "
+                  f"{p99 * 1e3:>9.2f} {worst * 1e3:>9.2f} {errors:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#
+# Startup cost of each configuration.  For each pair of ratchet, signer
+# and server below, we start a fresh interpreter, import what a signer
+# with that configuration imports and report the time that took, the
+# peak RSS of the process and which of the heavy dependencies were
+# loaded.  The first line is a bare interpreter for comparison.  Each
+# configuration is run --repeat times and we report the median.
+#
+# Run with: python3 -m test.bench_import
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+CONFIGS = [
+    ('mockery', 'local', 'flask'),
+    ('memory', 'local', 'asgi'),
+    ('sqlite', 'local', 'flask'),
+    ('dynamodb', 'local', 'flask'),
+    ('dynamodb', 'pkcs11_hsm', 'asgi'),
+    ('quorum', 'pkcs11_hsm', 'flask'),
+]
+
+HEAVY = ['boto3', 'PyKCS11', 'pytezos', 'flask', 'uvicorn']
+
+CHILD = '''
+import resource, sys, time
+start = time.perf_counter()
+if {ratchet!r}:
+    from tezos_signer import config
+    config.load(config.ratchets, {ratchet!r})
+    config.load(config.signers, {signer!r})
+    import tezos_signer.{server}app
+elapsed = time.perf_counter() - start
+print({{
+    "seconds": elapsed,
+    "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": [m for m in {heavy!r} if m in sys.modules],
+}})
+'''
+
+def measure(ratchet, signer, server):
+    code = CHILD.format(ratchet=ratchet, signer=signer, server=server,
+                        heavy=HEAVY)
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out.replace("'", '"'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Signer startup cost')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'ratchet':<9} {'signer':<11} {'server':<6} {'import (ms)':>11} "
+          f"{'RSS (MB)':>9}  modules")
+    for ratchet, signer, server in [('', '', '')] + CONFIGS:
+        runs = [measure(ratchet, signer, server) for i in range(args.repeat)]
+        seconds = statistics.median(r['seconds'] for r in runs)
+        rss = statistics.median(r['rss'] for r in runs) / 1024
+        print(f"{ratchet or '-':<9} {signer or '-':<11} {server or '-':<6} "
+              f"{seconds * 1e3:>11.1f} {rss:>9.1f}  "
+              f"{' '.join(runs[0]['modules'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#
+# End-to-end load test.  We drive a signer with the synthetic Tenderbake
+# traffic from loadgen.py and report throughput and latency for each
+# type of request.  The signer is either built in this process from one
+# of the backends below, or is a running signer given by --url.
+#
+#   local       LocalSigner keys and the mockery ratchet
+#   delay       LocalSigner keys behind stand-ins which add --sign-ms
+#               and --ratchet-ms of latency to each signature and ratchet
+#   dynamodb    LocalSigner keys and the DynamoDB ratchet, pointed at
+#               --endpoint, e.g. DynamoDB Local
+#   sqlite      LocalSigner keys and the SQLite ratchet in a temp dir
+#   config      the keys.json given by --config, e.g. for SoftHSM keys
+#
+# Run with, e.g.:
+#
+#   python3 -m test.bench_load --backend delay --keys 8 --chains 2 \
+#       --sign-ms 5 --ratchet-ms 10 --rate 400
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+from test import loadgen
+
+from pytezos.crypto.key import Key
+
+from tezos_signer import config as signer_config
+from tezos_signer.config import TacoinfraConfig
+from tezos_signer.flaskapp import create_app
+
+
+def make_config(args):
+    if args.backend == 'config':
+        with open(args.config, 'r') as file:
+            return TacoinfraConfig(conf=json.load(file))
+
+    keys = [Key.generate(curve=args.curve.encode(), export=False)
+            for i in range(args.keys)]
+    conf = {
+        'chain_ratchet': 'mockery',
+        'keys': [k.secret_key() for k in keys],
+        'policy': { 'baking': 1 },
+        'replay_cache_size': args.replay_cache,
+    }
+    if args.backend == 'delay':
+        signer_config.signers['delay'] = loadgen.DelaySigner
+        signer_config.ratchets['delay'] = \
+            lambda config: loadgen.DelayRatchet(config, args.ratchet_ms)
+        conf['chain_ratchet'] = 'delay'
+        conf['keys'] = [f'{k}:delay:{args.sign_ms}' for k in conf['keys']]
+    elif args.backend == 'dynamodb':
+        conf.update({
+            'aws_region': args.region,
+            'boto3_endpoint': args.endpoint,
+            'chain_ratchet': 'dynamodb',
+            'ddb_table': args.table,
+        })
+    elif args.backend == 'sqlite':
+        conf.update({
+            'chain_ratchet': 'sqlite',
+            'sqlite_file': os.path.join(tempfile.mkdtemp(), 'ratchet.db'),
+        })
+    return TacoinfraConfig(conf=conf)
+
+def main():
+    parser = argparse.ArgumentParser(description='Tenderbake load test')
+    parser.add_argument('--backend', default='local',
+                        choices=['local', 'delay', 'dynamodb', 'sqlite',
+                                 'config'])
+    parser.add_argument('--url', help='drive a running signer instead')
+    parser.add_argument('--pkh', action='append', default=[],
+                        help='key hash to use with --url, may be repeated')
+    parser.add_argument('--config', help='keys.json for --backend config')
+    parser.add_argument('--keys', type=int, default=4)
+    parser.add_argument('--curve', default='p2', choices=['ed', 'sp', 'p2'])
+    parser.add_argument('--chains', type=int, default=1)
+    parser.add_argument('--levels', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='total requests per second, 0 for unpaced')
+    parser.add_argument('--round-prob', type=float, default=0.1)
+    parser.add_argument('--retry-prob', type=float, default=0.05)
+    parser.add_argument('--stale-prob', type=float, default=0.05)
+    parser.add_argument('--replay-cache', type=int, default=0,
+                        help='replay_cache_size, or with --url that of the '
+                             'signer, 0 to expect retries to be rejected')
+    parser.add_argument('--sign-ms', type=float, default=5)
+    parser.add_argument('--ratchet-ms', type=float, default=10)
+    parser.add_argument('--endpoint', default='http://localhost:8000')
+    parser.add_argument('--region', default='eu-west-1')
+    parser.add_argument('--table', default='test')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    if args.url is not None:
+        if not args.pkh:
+            parser.error('--url requires at least one --pkh')
+        target = loadgen.HttpTarget(args.url)
+        pkhs = args.pkh
+        retry_status = 200 if args.replay_cache > 0 else 410
+    else:
+        config = make_config(args)
+        target = loadgen.AppTarget(create_app(config))
+        pkhs = list(config.keys)
+        retry_status = 200 if config.get_replay_cache() is not None else 410
+
+    results = loadgen.run(target, pkhs, chains=args.chains,
+                          levels=args.levels, rate=args.rate,
+                          round_prob=args.round_prob,
+                          retry_prob=args.retry_prob,
+                          stale_prob=args.stale_prob,
+                          retry_status=retry_status, seed=args.seed)
+    loadgen.report(results)
+    if sum(results.unexpected.values()) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#
+# Benchmark of LocalSigner throughput.  For ed25519, secp256k1 and p256
+# keys, we report signatures per second from as many client threads as
+# workers, signing in the threads themselves and in local_processes
+# worker processes, for 1 up to the number of cores.
+#
+# Run with: python3 -m test.bench_localsigner [seconds]
+
+import os
+import sys
+import threading
+import time
+from test.common import sig_reqs
+
+from pytezos.crypto.key import Key
+
+from tezos_signer.config import TacoinfraConfig
+from tezos_signer.localsigner import LocalSigner
+from tezos_signer.sigreq import SignatureReq
+
+CURVES = [('ed25519', b'ed'), ('secp256k1', b'sp'), ('p256', b'p2')]
+
+def signer(curve, processes):
+    config = TacoinfraConfig(conf = {
+        'chain_ratchet': 'mockery',
+        'keys': [],
+        'local_processes': processes,
+    })
+    key = Key.generate(curve=curve, export=False)
+    return LocalSigner(config, {'private_key': key.secret_key()})
+
+def rate(signer, threads, seconds):
+    sigreq = SignatureReq(sig_reqs[0][-1])
+    counts = [0] * threads
+    stop = time.monotonic() + seconds
+
+    def worker(i):
+        while time.monotonic() < stop:
+            signer.sign(sigreq)
+            counts[i] += 1
+
+    ts = [threading.Thread(target=worker, args=(i,))
+          for i in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return sum(counts) / seconds
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    cores = os.cpu_count()
+    counts = sorted({1, cores} | {n for n in [2, 4, 8, 16] if n < cores})
+    print(f'{cores} cores')
+    print(f"{'curve':<10} {'workers':>7} {'threads/s':>10} " +
+          f"{'processes/s':>12}")
+    for name, curve in CURVES:
+        threaded = signer(curve, 0)
+        for n in counts:
+            print(f'{name:<10} {n:>7} {rate(threaded, n, seconds):>10.0f} ' +
+                  f'{rate(signer(curve, n), n, seconds):>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
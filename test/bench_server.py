@@ -0,0 +1,183 @@
+#
+# Load test comparing the Flask server with the ASGI server and with the
+# Octez binary protocol over TCP and over a Unix socket.  We start
+# each server in its own process with a LocalSigner and drive it from a
+# number of client threads, each of which holds its own connection open
+# where the server allows it.  We sign ballots as they do not touch the
+# ratchet and we use an ed25519 key as it is the cheapest to sign with,
+# so that we are measuring the server rather than the backends.  The
+# binary clients send the same ballot as the HTTP clients, but without
+# the JSON and hex.
+#
+# Run with: python3 -m test.bench_server
+
+import http.client
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from test.common import sig_reqs
+
+from pytezos.crypto.key import Key
+
+from tezos_signer import encoding, octezserver
+
+CONCURRENCY = [1, 8, 32, 128]
+DURATION = 5
+
+def serve(server, addr, secret_key):
+    import logging
+
+    from werkzeug.serving import make_server
+
+    from tezos_signer.asgiapp import serve as asgi_serve
+    from tezos_signer.config import TacoinfraConfig
+    from tezos_signer.flaskapp import create_app
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    config = TacoinfraConfig(conf={
+        'bind_port': addr,
+        'chain_ratchet': 'mockery',
+        'keys': [ secret_key ],
+        'policy': { 'voting': ['pass'] },
+        'server': server if server in ['flask', 'asgi'] else 'flask',
+    })
+    if server == 'asgi':
+        asgi_serve(config)
+    elif server == 'tcp':
+        octezserver.make_server(config,
+                                f'tcp://127.0.0.1:{addr}').serve_forever()
+    elif server == 'unix':
+        octezserver.make_server(config, f'unix:{addr}').serve_forever()
+    else:
+        make_server('127.0.0.1', int(addr), create_app(config),
+                    threaded=True).serve_forever()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def connect(server, addr):
+    if server == 'unix':
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(addr)
+        return sock
+    sock = socket.create_connection(('127.0.0.1', addr))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def wait_for(server, addr):
+    for i in range(100):
+        try:
+            connect(server, addr).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise(RuntimeError(f"server on {addr} did not start"))
+
+def binary_client(server, addr, request, deadline, latencies, errors):
+    sock = connect(server, addr)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            sock.sendall(request)
+            resp = octezserver.read_frame(sock)
+            if resp is None:
+                raise ConnectionError('Connection closed')
+            if resp[0] != 0:
+                errors.append(resp)
+                continue
+        except (OSError, octezserver.ProtocolError) as e:
+            errors.append(e)
+            sock.close()
+            sock = connect(server, addr)
+            continue
+        latencies.append(time.perf_counter() - start)
+    sock.close()
+
+def client(server, port, path, body, deadline, latencies, errors):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request('POST', path, body=body,
+                         headers={'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors.append(resp.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(e)
+            conn.close()
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * p))]
+
+def run(server, addr, secret_key, path, body, request):
+    proc = subprocess.Popen([sys.executable, '-m', 'test.bench_server',
+                             'serve', server, str(addr), secret_key])
+    if server in ['tcp', 'unix']:
+        target, args = binary_client, (server, addr, request)
+    else:
+        target, args = client, (server, addr, path, body)
+    try:
+        wait_for(server, addr)
+        for n in CONCURRENCY:
+            latencies = []
+            errors = []
+            deadline = time.perf_counter() + DURATION
+            threads = [threading.Thread(target=target,
+                                        args=args + (deadline, latencies,
+                                                     errors))
+                       for i in range(n)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            latencies.sort()
+            if not latencies:
+                print(f"{server:<6} {n:>5} no successful requests")
+                continue
+            print(f"{server:<6} {n:>5} {len(latencies) / DURATION:>9.1f} "
+                  f"{percentile(latencies, 0.5) * 1e3:>9.2f} "
+                  f"{percentile(latencies, 0.99) * 1e3:>9.2f} "
+                  f"{latencies[-1] * 1e3:>9.2f} {len(errors):>6}")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(*sys.argv[2:])
+        return
+
+    key = Key.generate(curve=b'ed', export=False)
+    path = f'/keys/{key.public_key_hash()}'
+    ballot = [r for r in sig_reqs if r[0] == 'Success' and r[1] == 'Ballot']
+    body = json.dumps(ballot[0][-1])
+    payload = bytes.fromhex(ballot[0][-1])
+    request = octezserver.frame(
+        b'\x00\x00' +
+        encoding.base58_decode(key.public_key_hash().encode(), b'tz1') +
+        len(payload).to_bytes(4, 'big') + payload)
+
+    print(f"{'server':<6} {'conns':>5} {'req/s':>9} {'p50 (ms)':>9} "
+          f"{'p99 (ms)':>9} {'max (ms)':>9} {'errors':>6}")
+    with tempfile.TemporaryDirectory() as dir:
+        for server in ['flask', 'asgi', 'tcp', 'unix']:
+            addr = f'{dir}/signer.sock' if server == 'unix' else free_port()
+            run(server, addr, key.secret_key(), path, body, request)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#
+# Microbenchmark of SignatureReq parsing.  For each of the request
+# types in test.common, we report the cost of parsing a request and of
+# parsing and hashing it (which is what HsmSigner needs).
+#
+# Run with: python3 -m test.bench_sigreq
+
+import timeit
+from test.common import sig_reqs
+
+from tezos_signer.sigreq import SignatureReq
+
+NUMBER = 20000
+
+def bench(payload):
+    parse = timeit.timeit(lambda: SignatureReq(payload), number=NUMBER)
+    hashed = timeit.timeit(lambda: SignatureReq(payload).get_hashed_payload(),
+                           number=NUMBER)
+    return parse / NUMBER, hashed / NUMBER
+
+def main():
+    seen = set()
+    print(f"{'type':<16} {'bytes':>6} {'parse (us)':>12} {'+hash (us)':>12}")
+    for req in sig_reqs:
+        if req[0] != "Success" or req[1] in seen:
+            continue
+        seen.add(req[1])
+        parse, hashed = bench(req[-1])
+        print(f"{req[1]:<16} {len(req[-1]) // 2:>6} "
+              f"{parse * 1e6:>12.2f} {hashed * 1e6:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
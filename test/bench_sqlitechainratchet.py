@@ -0,0 +1,65 @@
+#
+# Benchmark of the SQLiteChainRatchet, comparing a commit (and so an
+# fsync) per request with group commit.  Each thread plays a separate
+# key, checking successive levels as fast as it can.  The database is
+# created in the current directory so that we measure the real disk
+# rather than a tmpfs.
+#
+# Run with: python3 -m test.bench_sqlitechainratchet
+
+import os
+import tempfile
+import threading
+import time
+
+from tezos_signer.config import TacoinfraConfig
+from tezos_signer.sqlitechainratchet import SQLiteChainRatchet
+
+THREADS = [1, 4, 16, 64]
+DURATION = 3
+
+def worker(ratchet, n, deadline, latencies):
+    level = 0
+    while time.perf_counter() < deadline:
+        level += 1
+        start = time.perf_counter()
+        ratchet.check(f'Endorsement_NetXdQprcVkpaWU_tz3bench{n}', level, 0)
+        latencies.append(time.perf_counter() - start)
+
+def run(dirname, group_commit, nthreads):
+    config = TacoinfraConfig(conf={
+        'chain_ratchet': 'sqlite',
+        'sqlite_file': os.path.join(dirname,
+                                    f'bench-{group_commit}-{nthreads}.db'),
+        'sqlite_group_commit': group_commit,
+        'keys': [],
+    })
+    ratchet = SQLiteChainRatchet(config)
+    latencies = []
+    deadline = time.perf_counter() + DURATION
+    threads = [threading.Thread(target=worker,
+                                args=(ratchet, n, deadline, latencies))
+               for n in range(nthreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    return (len(latencies) / DURATION,
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)])
+
+def main():
+    print(f"{'mode':<12} {'threads':>7} {'checks/s':>9} {'p50 (ms)':>9} "
+          f"{'p99 (ms)':>9}")
+    with tempfile.TemporaryDirectory(dir='.') as dirname:
+        for group_commit in [False, True]:
+            mode = 'group' if group_commit else 'per-request'
+            for nthreads in THREADS:
+                rate, p50, p99 = run(dirname, group_commit, nthreads)
+                print(f"{mode:<12} {nthreads:>7} {rate:>9.1f} "
+                      f"{p50 * 1e3:>9.2f} {p99 * 1e3:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#
+# A synthetic Tenderbake load generator.  We simulate a number of bakers,
+# one for each (key, chain) pair, each of which walks forward through the
+# levels sending preendorsements and endorsements for every round that it
+# sees and, when it is its turn, a block.  Some levels take more than one
+# round and some requests are retried after they have been signed, in
+# which case the ratchet must reject them unless the retry is of exactly
+# the same bytes and the signer has a replay cache.  Some requests are
+# also followed by a conflicting request for the same level and round,
+# e.g. a different block, which must always be rejected.
+#
+# Each baker sends its requests in order and waits for the response
+# before sending the next, as a real baker does.  If a rate is given,
+# requests are sent on a fixed schedule and latency is measured from the
+# time at which a request was due rather than when it was sent so that a
+# signer which cannot keep up is not flattered by the bakers backing off.
+#
+# The requests can be sent to an app in this process, built from any
+# TacoinfraConfig, or to a running signer over HTTP.  We also provide
+# stand-ins for the signer and the ratchet which sleep to simulate the
+# latency of an HSM or a remote database.  See bench_load.py.
+
+import http.client
+import json
+import random
+import struct
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from tezos_signer import LocalSigner, MockChainRatchet
+from tezos_signer.encoding import base58_encode, blake2b
+
+be_int = struct.Struct('>L')
+
+
+def chain_id(i):
+    raw = blake2b(f"loadgen chain {i}".encode(), digest_size=32).digest()
+    return raw[:4]
+
+def encode_chain_id(raw):
+    return base58_encode(raw, prefix=b'Net').decode()
+
+def fill(n, *args):
+    return blake2b(repr(args).encode(), digest_size=32).digest()[:n]
+
+#
+# The payloads are laid out as SignatureReq expects to find them.  The
+# hashes are filled with bytes derived from the level and round so that
+# every request is distinct, and the salt gives conflicting requests.
+
+def block(chain, level, round, salt=''):
+    fitness = b''.join([
+        be_int.pack(1), b'\x02',                        # version
+        be_int.pack(4), be_int.pack(level),             # level
+        be_int.pack(0),                                 # locked round
+        be_int.pack(4), be_int.pack(round - 1 & 0xffffffff),
+        be_int.pack(4), be_int.pack(round),             # round
+    ])
+    return (b'\x11' + chain + be_int.pack(level) + b'\x01' +
+            fill(32, 'predecessor', level) +
+            struct.pack('>Q', 1700000000 + level * 15) + b'\x04' +
+            fill(32, 'operations', level, round) +
+            be_int.pack(len(fitness)) + fitness +
+            fill(32, 'payload', level, round, salt) + be_int.pack(round) +
+            fill(8, 'nonce', level, round) + b'\x00\x00').hex()
+
+def consensus(tag, chain, level, round, salt=''):
+    return (bytes([tag]) + chain + fill(32, 'branch', level) +
+            bytes([tag + 2]) + b'\x00\x00' + be_int.pack(level) +
+            be_int.pack(round) +
+            fill(32, 'payload', level, round, salt)).hex()
+
+def preendorsement(chain, level, round, salt=''):
+    return consensus(0x12, chain, level, round, salt)
+
+def endorsement(chain, level, round, salt=''):
+    return consensus(0x13, chain, level, round, salt)
+
+#
+# A baker's stream is a list of (type, hex payload, expected status).
+# The number of rounds at each level is drawn from a generator seeded by
+# the chain and level so that all of the bakers on a chain agree on it.
+
+def baker_stream(chain, keyidx, nkeys, levels, start_level=1000,
+                 round_prob=0.1, retry_prob=0.05, stale_prob=0.05,
+                 retry_status=410, seed=None, rng=None):
+    rng = rng or random.Random()
+    stream = []
+    for level in range(start_level, start_level + levels):
+        chain_rng = random.Random(f'{seed} {chain.hex()} {level}')
+        rounds = 1
+        while rounds < 4 and chain_rng.random() < round_prob:
+            rounds += 1
+        for round in range(rounds):
+            reqs = []
+            if (level + round) % nkeys == keyidx:
+                reqs.append(('Baking', block))
+            reqs.append(('Preendorsement', preendorsement))
+            reqs.append(('Endorsement', endorsement))
+            for req_type, func in reqs:
+                req = (req_type, func(chain, level, round))
+                stream.append(req + (200,))
+                if rng.random() < retry_prob:
+                    stream.append(req + (retry_status,))
+                if rng.random() < stale_prob:
+                    stream.append((req_type,
+                                   func(chain, level, round, 'conflict'),
+                                   410))
+    return stream
+
+#
+# Targets.  connect() is called in each baker's thread and returns a
+# function which sends a request and returns the HTTP status.
+
+class AppTarget:
+    def __init__(self, app):
+        self.app = app
+
+    def connect(self):
+        client = self.app.test_client()
+
+        def send(pkh, hexdata):
+            return client.post(f'/keys/{pkh}',
+                               data=json.dumps(hexdata)).status_code
+        return send
+
+class HttpTarget:
+    def __init__(self, url):
+        self.url = urlsplit(url)
+
+    def connect(self):
+        conn = http.client.HTTPConnection(self.url.hostname,
+                                          self.url.port or 80)
+        prefix = self.url.path.rstrip('/')
+
+        def send(pkh, hexdata):
+            conn.request('POST', f'{prefix}/keys/{pkh}',
+                         body=json.dumps(hexdata),
+                         headers={'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        return send
+
+#
+# Latency injecting stand-ins.  The delay is mostly fixed with an
+# exponential tail and has the given mean in milliseconds.
+
+def delay(mean_ms):
+    if mean_ms > 0:
+        time.sleep(mean_ms / 1000 * (0.8 + random.expovariate(5)))
+
+class DelaySigner(LocalSigner):
+    def __init__(self, config, key):
+        super().__init__(config, key)
+        self.mean_ms = float(key['signer_args'][0])
+
+    def sign(self, sigreq):
+        delay(self.mean_ms)
+        return super().sign(sigreq)
+
+class DelayRatchet(MockChainRatchet):
+    def __init__(self, config, mean_ms=0):
+        super().__init__(config)
+        self.mean_ms = mean_ms
+        self.lock = threading.Lock()
+
+    def check(self, sig_type, level=0, round=0):
+        delay(self.mean_ms)
+        with self.lock:
+            return super().check(sig_type, level, round)
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.unexpected = defaultdict(int)
+
+    def add(self, req_type, expected, status, latency):
+        with self.lock:
+            self.latencies[(req_type, expected)].append(latency)
+            if status != expected:
+                self.unexpected[(req_type, expected)] += 1
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * p))]
+
+def run_baker(target, pkh, stream, rate, results):
+    send = target.connect()
+    start = time.perf_counter()
+    for i, (req_type, hexdata, expected) in enumerate(stream):
+        due = time.perf_counter()
+        if rate > 0:
+            due = start + i / rate
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        try:
+            status = send(pkh, hexdata)
+        except (OSError, http.client.HTTPException):
+            status = None
+        results.add(req_type, expected, status, time.perf_counter() - due)
+
+def run(target, pkhs, chains=1, levels=100, rate=0, round_prob=0.1,
+        retry_prob=0.05, stale_prob=0.05, retry_status=410, seed=None):
+    rng = random.Random(seed)
+    results = Results()
+    bakers = []
+    for c in range(chains):
+        chain = chain_id(c)
+        for i, pkh in enumerate(pkhs):
+            stream = baker_stream(chain, i, len(pkhs), levels,
+                                  round_prob=round_prob,
+                                  retry_prob=retry_prob,
+                                  stale_prob=stale_prob,
+                                  retry_status=retry_status, seed=seed,
+                                  rng=random.Random(rng.random()))
+            bakers.append((pkh, stream))
+
+    per_baker = rate / len(bakers)
+    threads = [threading.Thread(target=run_baker,
+                                args=(target, pkh, stream, per_baker,
+                                      results))
+               for pkh, stream in bakers]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.elapsed = time.perf_counter() - start
+    return results
+
+def report(results, out=print):
+    out(f"{'type':<15} {'status':>6} {'count':>7} {'req/s':>9} "
+        f"{'p50 (ms)':>9} {'p99 (ms)':>9} {'p999 (ms)':>9} "
+        f"{'max (ms)':>9} {'wrong':>6}")
+    for (req_type, expected), lats in sorted(results.latencies.items()):
+        lats.sort()
+        out(f"{req_type:<15} {expected:>6} {len(lats):>7} "
+            f"{len(lats) / results.elapsed:>9.1f} "
+            f"{percentile(lats, 0.5) * 1e3:>9.2f} "
+            f"{percentile(lats, 0.99) * 1e3:>9.2f} "
+            f"{percentile(lats, 0.999) * 1e3:>9.2f} "
+            f"{lats[-1] * 1e3:>9.2f} "
+            f"{results.unexpected[(req_type, expected)]:>6}")
+    total = sum(len(l) for l in results.latencies.values())
+    out(f"{total} requests in {results.elapsed:.2f}s: "
+        f"{total / results.elapsed:.1f} req/s")
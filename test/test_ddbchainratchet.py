@@ -1,11 +1,21 @@
 
+import socket
+import threading
+import time
 import unittest
-from test.common import run_two_key_test
+import uuid
+from test.common import run_two_key_test, sig_reqs
 
 from pytezos.crypto.key import Key
+from werkzeug.exceptions import Gone, InternalServerError
 
+from tezos_signer import metrics
 from tezos_signer.config import TacoinfraConfig
+from tezos_signer.sigreq import SignatureReq
 
+#
+# DynamoDB Local can be slow to answer under load, and so the tests
+# which do not test the budget give it longer than the default second.
 
 class TestRemoteSigner(unittest.TestCase):
     def test_local_and_ddbchainratchet(self):
@@ -15,6 +25,7 @@ class TestRemoteSigner(unittest.TestCase):
             'aws_region': 'eu-west-1',
             'boto3_endpoint': 'http://dynamodb-local:8000',
             'chain_ratchet': 'dynamodb',
+            'ddb_budget_ms': 5000,
             'ddb_table': 'test',
             'keys': [ k1.secret_key(), k2.secret_key() ],
             'policy': {
@@ -27,6 +38,138 @@ class TestRemoteSigner(unittest.TestCase):
         pkh2 = k2.public_key_hash()
         run_two_key_test(config, pkh1, pkh2)
 
+        #
+        # The stale requests in sig_reqs are all at or below a level
+        # and round that we have already committed and so should be
+        # rejected from the cache without a round trip to DynamoDB.
+
+        ratchet = config.get_key(pkh1)['signer'].ratchet
+        self.assertEqual(ratchet.hits, 8)
+        self.assertEqual(ratchet.misses, 12)
+
+        #
+        # And a new config will preload the cache from the table:
+
+        config = TacoinfraConfig(conf = {
+            'aws_region': 'eu-west-1',
+            'boto3_endpoint': 'http://dynamodb-local:8000',
+            'chain_ratchet': 'dynamodb',
+            'ddb_budget_ms': 5000,
+            'ddb_table': 'test',
+            'keys': [ k1.secret_key(), k2.secret_key() ],
+            'policy': {
+                'baking': 1,
+                'voting': ['pass'],
+            }
+        })
+        ratchet = config.get_key(pkh1)['signer'].ratchet
+        self.assertEqual(len(ratchet.hwm), 10)
+        self.assertEqual(ratchet.hwm[f"Baking_NetXdQprcVkpaWU_{pkh1}"],
+                         (12, 0))
+        with self.assertRaises(Gone):
+            config.get_key(pkh1)['signer'].sign(SignatureReq(sig_reqs[0][-1]))
+        self.assertEqual(ratchet.hits, 1)
+        self.assertEqual(ratchet.misses, 0)
+
+    def ddb_config(self, **settings):
+        return TacoinfraConfig(conf = dict({
+            'aws_region': 'eu-west-1',
+            'boto3_endpoint': 'http://dynamodb-local:8000',
+            'chain_ratchet': 'dynamodb',
+            'ddb_budget_ms': 5000,
+            'ddb_table': 'test',
+            'ddb_warmup': 0,
+            'keys': [],
+        }, **settings))
+
+    #
+    # A burst of checks is written in a few transactions.  One of them
+    # conflicts with a write that this ratchet has not seen, which
+    # cancels its transaction, and the others are then written singly.
+
+    def test_group_commit(self):
+        prefix = f'Endorsement_NetXdQprcVkpaWU_tz3{uuid.uuid4().hex}'
+        self.ddb_config().ratchet.check(f'{prefix}0', 5, 0)
+
+        ratchet = self.ddb_config(ddb_group_commit=True,
+                                  ddb_group_window=50).ratchet
+        before = sum(sum(series[:-1])
+                     for series in metrics.batch_size.collect().values())
+        results = {}
+        barrier = threading.Barrier(16)
+
+        def check(n, level):
+            barrier.wait()
+            try:
+                results[(n, level)] = ratchet.check(f'{prefix}{n % 15}',
+                                                    level, 0)
+            except Gone:
+                results[(n, level)] = False
+
+        threads = [threading.Thread(target=check, args=(n, 3))
+                   for n in range(15)]
+        threads.append(threading.Thread(target=check, args=(15, 4)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        #
+        # The sig_type already at 5/0 is refused at both levels and
+        # every other write is committed.
+
+        self.assertEqual(results.pop((0, 3)), False)
+        self.assertEqual(results.pop((15, 4)), False)
+        self.assertTrue(all(results.values()))
+        self.assertLess(ratchet.batches, 16)
+        self.assertGreater(ratchet.fallbacks, 0)
+        after = sum(sum(series[:-1])
+                    for series in metrics.batch_size.collect().values())
+        self.assertEqual(after - before, ratchet.batches)
+
+        #
+        # If the writer fails, its callers write singly and it carries
+        # on with the next batch.
+
+        def fail(reqs):
+            raise RuntimeError('injected')
+
+        ratchet.commit = fail
+        self.assertTrue(ratchet.check(f'{prefix}1', 10, 0))
+        self.assertTrue(ratchet.writer.is_alive())
+        ratchet.close()
+        self.assertFalse(ratchet.writer.is_alive())
+
+    #
+    # A DynamoDB which accepts connections but never answers must fail
+    # the request within the budget.
+
+    def test_ddb_budget(self):
+        with socket.socket() as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen(16)
+            config = TacoinfraConfig(conf = {
+                'aws_region': 'eu-west-1',
+                'boto3_endpoint': f'http://127.0.0.1:{server.getsockname()[1]}',
+                'chain_ratchet': 'dynamodb',
+                'ddb_budget_ms': 600,
+                'ddb_max_attempts': 2,
+                'ddb_pool_size': 32,
+                'ddb_table': 'test',
+                'ddb_warmup': 0,
+                'keys': [],
+            })
+            ratchet = config.ratchet
+            client_config = ratchet.client.meta.config
+            self.assertEqual(client_config.max_pool_connections, 32)
+            self.assertEqual(client_config.read_timeout, 0.3)
+            self.assertEqual(client_config.retries['mode'], 'standard')
+
+            start = time.monotonic()
+            with self.assertRaises(InternalServerError):
+                ratchet.check('Baking_NetXdQprcVkpaWU_tz3budget', 1, 0)
+            self.assertLess(time.monotonic() - start, 0.8)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,8 @@
 
 import os
+import tempfile
+import threading
+import time
 import unittest
 from test.common import INVALID_PREAMBLE, run_two_key_test, sig_reqs
 
@@ -7,7 +10,9 @@ from asn1crypto.core import OctetString
 from PyKCS11 import *
 from pytezos.crypto.key import Key
 
+from tezos_signer import handlers, hsmsigner
 from tezos_signer.config import TacoinfraConfig
+from tezos_signer.hsmsigner import HsmSigner, SessionPool, find_key, load_lib
 from tezos_signer.sigreq import SignatureReq
 
 
@@ -110,6 +115,322 @@ class TestRemoteSigner(unittest.TestCase):
         pkh2 = pub2.public_key_hash()
         run_two_key_test(config, pkh1, pkh2)
 
+    def test_session_pool_concurrency(self):
+        hsm_pin = 'resigner:1234'
+        hsm_lib = '/usr/lib64/libsofthsm2.so'
+
+        with open('/home/ec2-user/hsm_slot', 'r') as file:
+            hsm_slot = int(file.read().rstrip('\n'))
+
+        (pub1, priv1, pub2, priv2) = self.create_hsm_keys(hsm_lib, hsm_slot,
+                                                          hsm_pin)
+
+        payload = SignatureReq(sig_reqs[0][-1]).get_hashed_payload()
+        mech = Mechanism(CKM_ECDSA, None)
+        nthreads = 8
+        nsigs = 64
+
+        #
+        # Each worker holds its session for a moment after signing, so
+        # that the workers overlap, and we count the most sessions that
+        # were checked out at once, which the pool must bound by its size.
+
+        for size in [1, 2, 4]:
+            pool = SessionPool(load_lib(hsm_lib), hsm_slot, hsm_pin, size)
+            with pool.session() as session:
+                key = find_key(session, priv1, True)
+            lock = threading.Lock()
+            out = [0, 0]
+
+            def worker():
+                for i in range(nsigs):
+                    with pool.session() as session:
+                        with lock:
+                            out[0] += 1
+                            out[1] = max(out)
+                        session.sign(key, payload, mech)
+                        time.sleep(0.001)
+                        with lock:
+                            out[0] -= 1
+
+            threads = [threading.Thread(target=worker)
+                       for i in range(nthreads)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            pool.close()
+
+            self.assertEqual(out[1], size)
+
+    def test_key_index(self):
+        class FakeObject:
+            def __init__(self, handle):
+                self.handle = handle
+
+            def value(self):
+                return self.handle
+
+        class FakeSession:
+            def __init__(self):
+                self.objects = {FakeObject(h): f'label-{h}'
+                                for h in range(100)}
+                self.scans = 0
+
+            def login(self, pin):
+                pass
+
+            def findObjects(self, tmpl):
+                self.scans += 1
+                return list(self.objects)
+
+            def getAttributeValue(self, o, attrs):
+                return [self.objects[o]]
+
+        class FakeLib:
+            def openSession(self, slot):
+                return session
+
+        session = FakeSession()
+        pool = SessionPool(FakeLib(), 0, 'pin')
+        for h in range(0, 100, 7):
+            self.assertEqual(pool.find_key(f'label-{h}').value(), h)
+            self.assertEqual(pool.find_key(str(h)).value(), h)
+        self.assertEqual(session.scans, 1)
+
+        self.assertIsNone(pool.find_key('label-100'))
+        self.assertEqual(session.scans, 2)
+        session.objects[FakeObject(100)] = 'label-100'
+        self.assertEqual(pool.find_key('label-100').value(), 100)
+        self.assertEqual(session.scans, 3)
+
+    #
+    # Three fake devices hold the same key.  We check that signatures
+    # are spread across them, that a failing device is skipped until its
+    # backoff has passed and that a slow device is given less work.
+
+    def test_devices(self):
+        class FakeObject:
+            def value(self):
+                return 1
+
+        class FakeSession:
+            def __init__(self, device):
+                self.device = device
+
+            def login(self, pin):
+                pass
+
+            def findObjects(self, tmpl):
+                return [FakeObject()]
+
+            def getAttributeValue(self, o, attrs):
+                return ['label-1']
+
+            def sign(self, key, data, mech):
+                self.device.signs += 1
+                time.sleep(self.device.delay)
+                if self.device.fail:
+                    raise PyKCS11Error(CKR_DEVICE_ERROR)
+                return b'\x00' * 64
+
+        class FakeDevice:
+            def __init__(self):
+                self.signs = 0
+                self.delay = 0.001
+                self.fail = False
+
+            def openSession(self, slot):
+                return FakeSession(self)
+
+        devices = [FakeDevice() for i in range(3)]
+        for i, device in enumerate(devices):
+            hsmsigner.libs[f'fake{i}'] = device
+
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp())
+        try:
+            with open('hsm_passwd', 'w') as file:
+                file.write('1234\n')
+            config = TacoinfraConfig(conf = {
+                'chain_ratchet': 'mockery',
+                'hsm_backoff': 0.2,
+                'hsm_devices': [{'hsm_lib': f'fake{i}', 'hsm_pool_size': 2}
+                                for i in range(3)],
+                'hsm_username': 'resigner',
+                'keys': [],
+            })
+            signer = HsmSigner(config, {'pkh': 'tz3devices',
+                                        'signer_args': ['label-1']})
+        finally:
+            os.chdir(cwd)
+        sigreq = SignatureReq(sig_reqs[0][-1])
+
+        def sign_all(n, threads=6):
+            def worker():
+                for i in range(n):
+                    signer.sign(sigreq)
+            ts = [threading.Thread(target=worker) for i in range(threads)]
+            for t in ts:
+                t.start()
+            for t in ts:
+                t.join()
+
+        sign_all(20)
+        for device in devices:
+            self.assertGreater(device.signs, 20)
+
+        for device in devices:
+            device.signs = 0
+        devices[0].fail = True
+        sign_all(20)
+        failed = devices[0].signs
+        self.assertLessEqual(failed, 6)
+
+        time.sleep(0.2)
+        devices[0].fail = False
+        sign_all(20)
+        self.assertGreater(devices[0].signs, failed + 20)
+
+        for device in devices:
+            device.signs = 0
+        devices[1].delay = 0.02
+        sign_all(20)
+        self.assertLess(devices[1].signs * 3, devices[2].signs)
+
+        for device in devices:
+            device.fail = True
+        with self.assertRaises(PyKCS11Error):
+            signer.sign(sigreq)
+
+        for i in range(3):
+            del hsmsigner.libs[f'fake{i}']
+            del hsmsigner.pools[(f'fake{i}', 0)]
+
+    #
+    # A session which breaks is replaced by the standby at once and
+    # reopened in the background.  The health checks notice when the
+    # device goes away, and when it comes back, without a signature.
+
+    def test_standby(self):
+        class FakeObject:
+            def value(self):
+                return 1
+
+        class FakeInfo:
+            state = CKS_RO_USER_FUNCTIONS
+
+        class FakeSession:
+            def __init__(self, device):
+                self.device = device
+                self.broken = False
+
+            def check(self):
+                if self.broken or self.device.down:
+                    raise PyKCS11Error(CKR_SESSION_HANDLE_INVALID)
+
+            def login(self, pin):
+                if self.device.down:
+                    raise PyKCS11Error(CKR_DEVICE_REMOVED)
+                if self.device.logged_in:
+                    raise PyKCS11Error(CKR_USER_ALREADY_LOGGED_IN)
+                self.device.logged_in = True
+
+            def findObjects(self, tmpl):
+                return [FakeObject()]
+
+            def getAttributeValue(self, o, attrs):
+                return ['label-1']
+
+            def getSessionInfo(self):
+                self.check()
+                return FakeInfo()
+
+            def sign(self, key, data, mech):
+                self.check()
+                self.device.signs += 1
+                return b'\x00' * 64
+
+            def closeSession(self):
+                pass
+
+        class FakeDevice:
+            def __init__(self):
+                self.sessions = []
+                self.signs = 0
+                self.down = False
+                self.logged_in = False
+
+            def openSession(self, slot):
+                if self.down:
+                    raise PyKCS11Error(CKR_DEVICE_REMOVED)
+                self.sessions.append(FakeSession(self))
+                return self.sessions[-1]
+
+        def wait_for(condition):
+            for i in range(100):
+                if condition():
+                    return
+                time.sleep(0.02)
+            self.fail('timed out')
+
+        device = FakeDevice()
+        hsmsigner.libs['fakestandby'] = device
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp())
+        try:
+            with open('hsm_passwd', 'w') as file:
+                file.write('1234\n')
+            config = TacoinfraConfig(conf = {
+                'chain_ratchet': 'mockery',
+                'hsm_backoff': 0.05,
+                'hsm_health_interval': 0.05,
+                'hsm_lib': 'fakestandby',
+                'hsm_standby': 1,
+                'hsm_username': 'resigner',
+                'keys': [],
+            })
+            signer = HsmSigner(config, {'pkh': 'tz3standby',
+                                        'signer_args': ['label-1']})
+        finally:
+            os.chdir(cwd)
+        config.subsigners['standby'] = signer
+        pool = hsmsigner.pools[('fakestandby', 0)]
+        sigreq = SignatureReq(sig_reqs[0][-1])
+        self.assertEqual(len(device.sessions), 2)
+
+        device.sessions[0].broken = True
+        signer.sign(sigreq)
+        self.assertEqual(device.signs, 1)
+        self.assertEqual(pool.errors, 0)
+        wait_for(lambda: pool.repairs == 1 and pool.standby.qsize() == 1)
+        self.assertEqual(len(device.sessions), 3)
+        status, data = handlers.health(config)
+        self.assertEqual(status, 200)
+        self.assertEqual(data['status'], 'ok')
+        self.assertEqual(data['hsm'][0]['standby'], 1)
+
+        device.down = True
+        device.logged_in = False
+        wait_for(lambda: not pool.up())
+        status, data = handlers.health(config)
+        self.assertEqual(status, 503)
+        self.assertEqual(data['status'], 'down')
+        self.assertIsNotNone(data['hsm'][0]['error'])
+        with self.assertRaises(PyKCS11Error):
+            signer.sign(sigreq)
+
+        device.down = False
+        wait_for(lambda: pool.up() and pool.standby.qsize() == 1 and
+                         pool.idle.qsize() == 1)
+        self.assertTrue(device.logged_in)
+        signer.sign(sigreq)
+        self.assertEqual(handlers.health(config)[0], 200)
+
+        pool.close()
+        del hsmsigner.libs['fakestandby']
+        del hsmsigner.pools[('fakestandby', 0)]
+
 
 if __name__ == '__main__':
     unittest.main()
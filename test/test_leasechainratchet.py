@@ -0,0 +1,161 @@
+import time
+import unittest
+import uuid
+from test.common import run_two_key_test
+
+from pytezos.crypto.key import Key
+from werkzeug.exceptions import Gone, ServiceUnavailable
+
+from tezos_signer import config as config_module
+from tezos_signer.config import TacoinfraConfig
+from tezos_signer.leasechainratchet import LeaseChainRatchet, MemoryLeaseStore
+
+SIG_TYPE = 'Endorsement_NetXdQprcVkpaWU_tz3lease'
+
+
+class TestLeaseChainRatchet(unittest.TestCase):
+    def config(self, store, owner, keys=[], **settings):
+        config_module.ratchets['lease_test'] = \
+            lambda config: LeaseChainRatchet(config, store)
+        return TacoinfraConfig(conf = dict({
+            'chain_ratchet': 'lease_test',
+            'keys': keys,
+            'lease_duration': 0.5,
+            'lease_flush_ms': 10,
+            'lease_name': str(uuid.uuid4()),
+            'lease_owner': owner,
+            'policy': {
+                'baking': 1,
+                'voting': ['pass'],
+            }
+        }, **settings))
+
+    def wait_for(self, ratchet):
+        for i in range(200):
+            if ratchet.held() is not None:
+                return
+            time.sleep(0.05)
+        self.fail(f'{ratchet.owner} did not acquire the lease')
+
+    def test_local_and_leasechainratchet(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        k2 = Key.generate(curve=b'p2', export=False)
+        config = self.config(MemoryLeaseStore(), 'a',
+                             [k1.secret_key(), k2.secret_key()])
+        run_two_key_test(config, k1.public_key_hash(), k2.public_key_hash())
+        config.ratchet.close()
+
+    def failover(self, store, **settings):
+        name = str(uuid.uuid4())
+        a = self.config(store, 'a', lease_name=name, **settings).ratchet
+        b = self.config(store, 'b', lease_name=name, **settings).ratchet
+        self.assertIsNotNone(a.held())
+        self.assertIsNone(b.held())
+        with self.assertRaises(ServiceUnavailable):
+            b.check(SIG_TYPE, 1, 0)
+
+        #
+        # The first check reserves levels 1 to 17 and the rest are
+        # checked in memory.
+
+        for level in range(1, 6):
+            self.assertTrue(a.check(SIG_TYPE, level, 0))
+        with self.assertRaises(Gone):
+            a.check(SIG_TYPE, 5, 0)
+        self.assertEqual(a.reservations, 1)
+        time.sleep(0.1)
+        self.assertEqual(store.get(SIG_TYPE), (5, 0, 17))
+
+        #
+        # a stops renewing its lease, as if it had hung, and b takes
+        # over.  b will not sign anything that a had reserved.
+
+        a.stopping.set()
+        a.thread.join()
+        self.wait_for(b)
+        for level in [6, 17]:
+            with self.assertRaises(Gone):
+                b.check(SIG_TYPE, level, 0)
+        self.assertTrue(b.check(SIG_TYPE, 18, 0))
+
+        #
+        # a still believes that it holds the lease and may sign what it
+        # reserved, which b never will, but it is fenced as soon as it
+        # tries to reserve more.
+
+        a.valid_until = time.monotonic() + 60
+        self.assertTrue(a.check(SIG_TYPE, 17, 0))
+        with self.assertRaises(ServiceUnavailable):
+            a.check(SIG_TYPE, 40, 0)
+        self.assertEqual(a.fenced, 1)
+        self.assertIsNone(a.held())
+
+        #
+        # When b releases the lease, it hands over exactly where it
+        # stopped.
+
+        self.assertTrue(b.check(SIG_TYPE, 20, 1))
+        b.close()
+        c = self.config(store, 'c', lease_name=name, **settings).ratchet
+        self.assertIsNotNone(c.held())
+        with self.assertRaises(Gone):
+            c.check(SIG_TYPE, 20, 1)
+        self.assertTrue(c.check(SIG_TYPE, 20, 2))
+        c.close()
+
+    def test_failover(self):
+        self.failover(MemoryLeaseStore())
+
+    #
+    # DynamoDB Local is slower and so gets a longer lease, and a longer
+    # budget than the default second so that a slow reply does not fail
+    # the test.
+
+    def test_ddb_failover(self):
+        from tezos_signer.ddbleasestore import DDBLeaseStore
+
+        settings = {
+            'aws_region': 'eu-west-1',
+            'boto3_endpoint': 'http://dynamodb-local:8000',
+            'ddb_budget_ms': 5000,
+            'ddb_table': 'test',
+            'lease_duration': 2,
+        }
+        store = DDBLeaseStore(TacoinfraConfig(conf = dict({
+            'chain_ratchet': 'mockery',
+            'keys': [],
+        }, **settings)))
+        store.client.delete_item(TableName='test',
+                                 Key={'sig_type': {'S': SIG_TYPE}})
+        self.failover(store, **settings)
+
+    #
+    # A reload which builds a new ratchet hands the lease over from the
+    # old one, when the old one is closed, without waiting for it to
+    # expire.  A reload which fails leaves the old one holding it.
+
+    def test_reload(self):
+        store = MemoryLeaseStore()
+        old = self.config(store, 'a', lease_name='reload').ratchet
+        self.assertTrue(old.check(SIG_TYPE, 1, 0))
+
+        failed = self.config(store, 'a', lease_name='reload').ratchet
+        self.assertIsNone(failed.held())
+        failed.close()
+        self.assertIsNotNone(old.held())
+        self.assertTrue(old.check(SIG_TYPE, 2, 0))
+
+        new = self.config(store, 'a', lease_name='reload').ratchet
+        self.assertIsNotNone(old.held())
+        self.assertIsNone(new.held())
+        old.close()
+        self.assertIsNone(old.held())
+        self.assertIsNotNone(new.held())
+        with self.assertRaises(Gone):
+            new.check(SIG_TYPE, 2, 0)
+        self.assertTrue(new.check(SIG_TYPE, 3, 0))
+        new.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+
+import unittest
+from test import loadgen
+
+from pytezos.crypto.key import Key
+
+from tezos_signer.config import TacoinfraConfig
+from tezos_signer.flaskapp import create_app
+from tezos_signer.sigreq import SignatureReq
+
+
+class TestLoadGen(unittest.TestCase):
+    def test_payloads(self):
+        chain = loadgen.chain_id(0)
+        for req_type, func in [('Baking', loadgen.block),
+                               ('Preendorsement', loadgen.preendorsement),
+                               ('Endorsement', loadgen.endorsement)]:
+            for level, round in [(1, 0), (1000, 3), (2**31, 0)]:
+                got = SignatureReq(func(chain, level, round))
+                self.assertEqual(got.get_type(), req_type)
+                self.assertEqual(got.get_chainid(),
+                                 loadgen.encode_chain_id(chain))
+                self.assertEqual(got.get_level(), level)
+                self.assertEqual(got.get_round(), round)
+
+    def test_run(self):
+        keys = [Key.generate(curve=b'ed', export=False) for i in range(3)]
+        config = TacoinfraConfig(conf = {
+            'chain_ratchet': 'mockery',
+            'keys': [ k.secret_key() for k in keys ],
+            'policy': { 'baking': 1 },
+        })
+        results = loadgen.run(loadgen.AppTarget(create_app(config)),
+                              list(config.keys), chains=2, levels=10,
+                              round_prob=0, retry_prob=0.2,
+                              stale_prob=0.2, seed=1)
+        counts = {k: len(v) for k, v in results.latencies.items()}
+        self.assertEqual(sum(results.unexpected.values()), 0)
+        self.assertEqual(counts[('Baking', 200)], 2 * 10)
+        self.assertEqual(counts[('Preendorsement', 200)], 2 * 3 * 10)
+        self.assertEqual(counts[('Endorsement', 200)], 2 * 3 * 10)
+        self.assertGreater(sum(counts[k] for k in counts if k[1] == 410), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+
+import threading
+import time
+import unittest
+from test.common import run_two_key_test
+
+from pytezos.crypto.key import Key
+from werkzeug.exceptions import Gone
+
+from tezos_signer.config import TacoinfraConfig
+from tezos_signer.memorychainratchet import MemoryChainRatchet
+
+LEVELS = 200
+ROUNDS = 3
+THREADS = 16
+SIG_TYPES = [f'{t}_NetXdQprcVkpaWU_tz3stress{k}'
+             for t in ['Preendorsement', 'Endorsement'] for k in range(4)]
+
+
+class TestMemoryChainRatchet(unittest.TestCase):
+    def config(self, keys=[]):
+        return TacoinfraConfig(conf = {
+            'chain_ratchet': 'memory',
+            'keys': keys,
+            'policy': {
+                'baking': 1,
+                'voting': ['pass'],
+            }
+        })
+
+    def test_local_and_memorychainratchet(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        k2 = Key.generate(curve=b'p2', export=False)
+        config = self.config([k1.secret_key(), k2.secret_key()])
+
+        run_two_key_test(config, k1.public_key_hash(), k2.public_key_hash())
+
+    #
+    # Every thread tries to sign every (level, round) for every sig_type
+    # and we check that none was allowed more than once.  We yield to the
+    # other threads between reading the high-water mark and writing it,
+    # which is where a ratchet without the lock would let a race in.
+
+    def test_stress(self):
+        class YieldingDict(dict):
+            def get(self, k, default=None):
+                v = super().get(k, default)
+                time.sleep(0)
+                return v
+
+        ratchet = MemoryChainRatchet(self.config())
+        ratchet.hwm = YieldingDict()
+        won = []
+        barrier = threading.Barrier(THREADS)
+
+        def worker():
+            mine = []
+            barrier.wait()
+            for level in range(1, LEVELS + 1):
+                for round in range(ROUNDS):
+                    for sig_type in SIG_TYPES:
+                        try:
+                            ratchet.check(sig_type, level, round)
+                            mine.append((sig_type, level, round))
+                        except Gone:
+                            pass
+            won.extend(mine)
+
+        threads = [threading.Thread(target=worker) for i in range(THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(won), len(set(won)))
+        for sig_type in SIG_TYPES:
+            self.assertIn((sig_type, LEVELS, ROUNDS - 1), won)
+
+        with self.assertRaises(Gone):
+            ratchet.check(SIG_TYPES[0], LEVELS, ROUNDS - 1)
+        self.assertTrue(ratchet.check(SIG_TYPES[0], LEVELS, ROUNDS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+
+import threading
+import time
+import unittest
+from test.common import run_two_key_test
+
+from pytezos.crypto.key import Key
+from werkzeug.exceptions import Gone, InternalServerError
+
+from tezos_signer import config as signer_config
+from tezos_signer.config import TacoinfraConfig
+from tezos_signer.memorychainratchet import MemoryChainRatchet
+
+SIG_TYPE = 'Endorsement_NetXdQprcVkpaWU_tz3quorum'
+
+#
+# A stand-in backend which sleeps for delay seconds and then either
+# fails or checks a MemoryChainRatchet that is shared by name, so that
+# several quorums can be pointed at the same set of backends.
+
+stores = {}
+stores_lock = threading.Lock()
+
+class StandinRatchet(MemoryChainRatchet):
+    def __init__(self, config):
+        with stores_lock:
+            self.store = stores.setdefault(config.conf.get('store'),
+                                           MemoryChainRatchet(config))
+        self.delay = config.conf.get('delay', 0)
+        self.fail = config.conf.get('fail', False)
+
+    def check(self, sig_type, level=0, round=0):
+        time.sleep(self.delay)
+        if self.fail:
+            raise Exception('backend unavailable')
+        return self.store.check(sig_type, level, round)
+
+
+class TestQuorumChainRatchet(unittest.TestCase):
+    def setUp(self):
+        signer_config.ratchets['standin'] = StandinRatchet
+        stores.clear()
+
+    def tearDown(self):
+        del signer_config.ratchets['standin']
+
+    def config(self, backends, keys=[], **settings):
+        return TacoinfraConfig(conf = dict({
+            'chain_ratchet': 'quorum',
+            'keys': keys,
+            'policy': {
+                'baking': 1,
+                'voting': ['pass'],
+            },
+            'quorum_ratchets': backends,
+        }, **settings))
+
+    def standins(self, prefix='', **kwargs):
+        backends = [{'chain_ratchet': 'standin', 'store': f'{prefix}{i}'}
+                    for i in range(3)]
+        for i, conf in kwargs.items():
+            backends[int(i[1:])].update(conf)
+        return backends
+
+    def test_local_and_quorumchainratchet(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        k2 = Key.generate(curve=b'p2', export=False)
+        config = self.config([{'chain_ratchet': 'memory'}] * 3,
+                             [k1.secret_key(), k2.secret_key()])
+
+        run_two_key_test(config, k1.public_key_hash(), k2.public_key_hash())
+
+    def test_slow_backend(self):
+        ratchet = self.config(self.standins(b2={'delay': 1})).ratchet
+
+        start = time.perf_counter()
+        for level in range(1, 6):
+            self.assertTrue(ratchet.check(SIG_TYPE, level, 0))
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+        with self.assertRaises(Gone):
+            ratchet.check(SIG_TYPE, 5, 0)
+
+    #
+    # A backend which hangs fills its own pool and is then counted as
+    # failed without holding up the others.
+
+    def test_hung_backend(self):
+        ratchet = self.config(self.standins(b2={'delay': 1}),
+                              executor_threads=2).ratchet
+
+        start = time.perf_counter()
+        for level in range(1, 11):
+            self.assertTrue(ratchet.check(SIG_TYPE, level, 0))
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(ratchet.overloaded['2:StandinRatchet'], 8)
+        self.assertEqual(ratchet.inflight['2:StandinRatchet'], 2)
+
+    def test_failing_backends(self):
+        ratchet = self.config(self.standins(b0={'fail': True})).ratchet
+        self.assertTrue(ratchet.check(SIG_TYPE, 1, 0))
+        with self.assertRaises(Gone):
+            ratchet.check(SIG_TYPE, 1, 0)
+
+        ratchet = self.config(self.standins('x', b0={'fail': True},
+                                            b1={'fail': True})).ratchet
+        with self.assertRaises(InternalServerError):
+            ratchet.check(SIG_TYPE, 1, 0)
+
+    def test_not_nested(self):
+        with self.assertRaises(KeyError):
+            self.config([{'chain_ratchet': 'quorum'}])
+        with self.assertRaises(KeyError):
+            self.config([])
+
+    #
+    # Two signers, each with a quorum over the same three backends, race
+    # for every level and round, and each backend answers the two in a
+    # different order.  At most one may win each (level, round).
+
+    def test_racing_quorums(self):
+        quorums = [self.config(self.standins(
+                       b0={'delay': 0.001 * j}, b1={'delay': 0.002 * (1 - j)},
+                       b2={'delay': 0.001})).ratchet
+                   for j in range(2)]
+        won = []
+        barrier = threading.Barrier(2)
+
+        def worker(ratchet):
+            mine = []
+            for level in range(1, 31):
+                for round in range(2):
+                    barrier.wait()
+                    try:
+                        ratchet.check(SIG_TYPE, level, round)
+                        mine.append((level, round))
+                    except (Gone, InternalServerError):
+                        pass
+            won.extend(mine)
+
+        threads = [threading.Thread(target=worker, args=(q,))
+                   for q in quorums]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(won), len(set(won)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,47 @@
 
+import asyncio
+import json
+import logging
+import os
+import queue
 import re
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from test.common import INVALID_PREAMBLE, run_two_key_test, sig_reqs
 
 from pytezos.crypto.key import Key
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, Gone, ServiceUnavailable
 
+from tezos_signer import MockChainRatchet, ValidateSigner, encoding, metrics, \
+                         octezserver
+from tezos_signer.admission import AdmissionController
+from tezos_signer.asgiapp import SignerApp
 from tezos_signer.config import TacoinfraConfig
+from tezos_signer.flaskapp import create_app
+from tezos_signer.logsetup import REQUEST_LOGGER, DroppingQueueHandler, \
+                                  LogPipeline, RateLimitFilter
+from tezos_signer.reloader import ConfigReloader
+from tezos_signer.replaycache import ReplayCache
 from tezos_signer.sigreq import SignatureReq
 
 
+def asgi_request(app, method, path, body=b''):
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path}
+    asyncio.run(app(scope, receive, send))
+    return sent[0]['status'], sent[1]['body']
+
+
 class TestRemoteSigner(unittest.TestCase):
     def test_identifies_invalid_block_preamble(self):
         with self.assertRaises(BadRequest):
@@ -32,6 +64,10 @@ class TestRemoteSigner(unittest.TestCase):
                 self.assertEqual(req[3], got.level)
                 self.assertEqual(req[4], got.round)
 
+        for payload in ['', '11', '0500', '11' + '00' * 8]:
+            with self.assertRaises(BadRequest):
+                SignatureReq(payload)
+
     def test_bad_configs(self):
         k = Key.generate(curve=b'p2', export=False)
 
@@ -71,6 +107,568 @@ class TestRemoteSigner(unittest.TestCase):
         pkh2 = k2.public_key_hash()
         run_two_key_test(config, pkh1, pkh2)
 
+    #
+    # Keys of each curve signed in worker processes.
+
+    def test_local_processes(self):
+        from tezos_signer import localsigner
+
+        k1 = Key.generate(curve=b'ed', export=False)
+        k2 = Key.generate(curve=b'sp', export=False)
+        config = TacoinfraConfig(conf = {
+            'chain_ratchet': 'mockery',
+            'keys': [ k1.secret_key(), k2.secret_key() ],
+            'local_processes': 2,
+            'policy': {
+                'baking': 1,
+                'voting': ['pass'],
+            }
+        })
+        run_two_key_test(config, k1.public_key_hash(), k2.public_key_hash())
+        localsigner.discard_pool(2, localsigner.pools[2])
+
+    def test_parallel_ratchet(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        k2 = Key.generate(curve=b'p2', export=False)
+        config = TacoinfraConfig(conf = {
+            'chain_ratchet': 'mockery',
+            'keys': [ k1.secret_key(), k2.secret_key() ],
+            'parallel_ratchet': True,
+            'policy': {
+                'baking': 1,
+                'voting': ['pass'],
+            }
+        })
+        run_two_key_test(config, k1.public_key_hash(), k2.public_key_hash())
+
+        class SlowRatchet(MockChainRatchet):
+            def check(self, sig_type, level=0, round=0):
+                time.sleep(0.2)
+                return super().check(sig_type, level, round)
+
+        class SlowSigner:
+            def sign(self, sigreq):
+                time.sleep(0.2)
+                return 'signature'
+
+        key = config.get_key(k1.public_key_hash())
+        signer = ValidateSigner(config, key, ratchet=SlowRatchet(config),
+                                subsigner=SlowSigner())
+        req = [r for r in sig_reqs if r[0] == 'Success' and r[1] == 'Baking']
+        start = time.monotonic()
+        self.assertEqual(signer.sign(SignatureReq(req[0][-1])), 'signature')
+        self.assertLess(time.monotonic() - start, 0.35)
+        with self.assertRaises(Gone):
+            signer.sign(SignatureReq(req[0][-1]))
+
+    def test_batch(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        k2 = Key.generate(curve=b'ed', export=False)
+        pkh1 = k1.public_key_hash()
+        pkh2 = k2.public_key_hash()
+        conf = {
+            'chain_ratchet': 'mockery',
+            'keys': [ k1.secret_key(), k2.secret_key() ],
+            'policy': { 'baking': 1 },
+        }
+        batch = [[pkh, req[-1]] for req in sig_reqs for pkh in [pkh1, pkh2]
+                 if req[1] in ['Baking', 'Preendorsement', 'Endorsement']]
+        batch += [['tz1nope', sig_reqs[0][-1]], [pkh1, 'zz']]
+
+        flask_client = create_app(TacoinfraConfig(conf=conf)).test_client()
+        asgi_app = SignerApp(TacoinfraConfig(conf=conf))
+        for status, body in [
+                (lambda r: (r.status_code, r.get_data()))(
+                    flask_client.post('/batch', data=json.dumps(batch))),
+                asgi_request(asgi_app, 'POST', '/batch',
+                             json.dumps(batch).encode())]:
+            self.assertEqual(status, 200)
+            results = json.loads(body)
+            self.assertEqual(len(results), len(batch))
+            expected = [req[0] for req in sig_reqs for pkh in [pkh1, pkh2]
+                        if req[1] in ['Baking', 'Preendorsement',
+                                      'Endorsement']]
+            for (pkh, data), result, want in zip(batch, results, expected):
+                if want == 'Success':
+                    key = k1 if pkh == pkh1 else k2
+                    key.verify(result['signature'], bytes.fromhex(data))
+                else:
+                    self.assertEqual(result['status'], 410)
+            self.assertEqual(results[-2]['status'], 404)
+            self.assertEqual(results[-1]['status'], 400)
+
+        resp = flask_client.post('/batch', data=json.dumps({'a': 1}))
+        self.assertEqual(resp.status_code, 400)
+
+    def test_replay_cache(self):
+        reqs = [SignatureReq(req[-1]) for req in sig_reqs[:4]]
+        cache = ReplayCache(size=3, ttl=0.2)
+        self.assertIsNone(cache.get('tz1a', reqs[0]))
+        for i, req in enumerate(reqs):
+            cache.put('tz1a', req, f'sig{i}')
+        self.assertIsNone(cache.get('tz1a', reqs[0]))
+        self.assertEqual(cache.get('tz1a', reqs[1]), 'sig1')
+        self.assertIsNone(cache.get('tz1b', reqs[1]))
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        time.sleep(0.25)
+        self.assertIsNone(cache.get('tz1a', reqs[1]))
+        cache.put('tz1a', reqs[0], 'sig0')
+        self.assertEqual(len(cache.entries), 1)
+
+        #
+        # The cache is off unless replay_cache_size is set, when a retry
+        # of the same bytes gets the same signature.
+
+        k1 = Key.generate(curve=b'p2', export=False)
+        conf = {
+            'chain_ratchet': 'mockery',
+            'keys': [ k1.secret_key() ],
+            'policy': { 'baking': 1 },
+        }
+        signer = TacoinfraConfig(conf=conf).get_key(
+            k1.public_key_hash())['signer']
+        signer.sign(reqs[0])
+        with self.assertRaises(Gone):
+            signer.sign(reqs[0])
+
+        signer = TacoinfraConfig(conf=dict(conf, replay_cache_size=10)) \
+            .get_key(k1.public_key_hash())['signer']
+        sig = signer.sign(reqs[0])
+        self.assertEqual(signer.sign(reqs[0]), sig)
+
+    #
+    # We hold the only slot while requests queue up behind it and then
+    # release it, one request at a time, and check the order in which
+    # they are admitted.
+
+    def test_admission(self):
+        admission = AdmissionController(1, queue_size=3, deadline=0.5)
+        order = []
+
+        def request(pkh, req_type, ready):
+            try:
+                with admission.admit(pkh, req_type):
+                    order.append((pkh, req_type))
+                    ready.wait()
+            except ServiceUnavailable:
+                order.append((pkh, 'shed'))
+
+        release = threading.Event()
+        holder = threading.Thread(target=request,
+                                  args=('tz3hold', 'Baking', release))
+        holder.start()
+        while len(order) < 1:
+            time.sleep(0.001)
+
+        queued = [('tz3a', 'Ballot'), ('tz3a', 'Endorsement'),
+                  ('tz3a', 'Preendorsement'), ('tz3a', 'Endorsement'),
+                  ('tz3b', 'Endorsement'), ('tz3a', 'Baking')]
+        released = threading.Event()
+        released.set()
+        threads = []
+        for pkh, req_type in queued:
+            threads.append(threading.Thread(target=request,
+                                            args=(pkh, req_type, released)))
+            threads[-1].start()
+            while sum(admission.waiting) + sum(admission.shed.values()) < \
+                  len(threads):
+                time.sleep(0.001)
+
+        self.assertEqual(order[1:], [('tz3b', 'shed')])
+        self.assertEqual(admission.waiting, [3, 1, 1])
+        release.set()
+        for t in [holder] + threads:
+            t.join()
+        self.assertEqual(order[2:], [
+            ('tz3a', 'Endorsement'), ('tz3a', 'Preendorsement'),
+            ('tz3a', 'Endorsement'), ('tz3a', 'Baking'), ('tz3a', 'Ballot'),
+        ])
+
+        admission.service = 1
+        with self.assertRaises(ServiceUnavailable):
+            with admission.admit('tz3a', 'Endorsement'):
+                with admission.admit('tz3a', 'Endorsement'):
+                    pass
+        self.assertEqual(admission.shed[('consensus', 'deadline')], 1)
+
+        admission.service = 0
+        start = time.monotonic()
+        with self.assertRaises(ServiceUnavailable):
+            with admission.admit('tz3a', 'Endorsement'):
+                with admission.admit('tz3a', 'Endorsement'):
+                    pass
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+        self.assertEqual(admission.shed[('consensus', 'expired')], 1)
+        self.assertEqual(admission.free, 1)
+
+        k1 = Key.generate(curve=b'p2', export=False)
+        config = TacoinfraConfig(conf = {
+            'admission_slots': 1,
+            'chain_ratchet': 'mockery',
+            'keys': [ k1.secret_key() ],
+            'policy': { 'baking': 1 },
+        })
+        client = create_app(config).test_client()
+        resp = client.post(f'/keys/{k1.public_key_hash()}',
+                           data=json.dumps(sig_reqs[0][-1]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(config.get_admission().admitted, [0, 1, 0])
+
+    def test_reload(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        k2 = Key.generate(curve=b'p2', export=False)
+        conf = {
+            'chain_ratchet': 'mockery',
+            'keys': [ k1.secret_key() ],
+            'policy': { 'baking': 1 },
+        }
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, 'keys.json')
+            with open(filename, 'w') as f:
+                json.dump(conf, f)
+            config = ConfigReloader(filename)
+            client = create_app(config).test_client()
+            old = config.get_key(k1.public_key_hash())['signer']
+
+            conf['keys'].append(k2.secret_key())
+            conf['policy']['voting'] = ['pass']
+            with open(filename, 'w') as f:
+                json.dump(conf, f)
+
+            resp = client.post('/admin/reload',
+                               environ_base={'REMOTE_ADDR': '10.0.0.1'})
+            self.assertEqual(resp.status_code, 403)
+            status, body = asgi_request(SignerApp(config), 'POST',
+                                        '/admin/reload')
+            self.assertEqual(status, 403)
+            self.assertIsNone(config.get_key(k2.public_key_hash()))
+
+            resp = client.post('/admin/reload')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {'keys': 2})
+            new = config.get_key(k1.public_key_hash())['signer']
+            self.assertIsNot(new, old)
+            self.assertIs(new.subsigner, old.subsigner)
+            self.assertIs(new.ratchet, old.ratchet)
+            self.assertEqual(new.policy['voting'], ['pass'])
+            self.assertIs(config.get_key(k2.public_key_hash())['signer']
+                          .ratchet, old.ratchet)
+
+            #
+            # The mockery reads none of the settings and so survives a
+            # change to them, but not a change of chain_ratchet, which
+            # closes it.
+
+            conf['ddb_table'] = 'other'
+            with open(filename, 'w') as f:
+                json.dump(conf, f)
+            config.reload()
+            newer = config.get_key(k1.public_key_hash())['signer']
+            self.assertIsNot(newer.subsigner, old.subsigner)
+            self.assertIs(newer.ratchet, old.ratchet)
+
+            closed = []
+            old.ratchet.close = lambda: closed.append(True)
+            conf['chain_ratchet'] = 'memory'
+            with open(filename, 'w') as f:
+                json.dump(conf, f)
+            config.reload()
+            newer = config.get_key(k1.public_key_hash())['signer']
+            self.assertIsNot(newer.ratchet, old.ratchet)
+            self.assertEqual(closed, [True])
+
+            with open(filename, 'w') as f:
+                f.write('{')
+            resp = client.post('/admin/reload')
+            self.assertEqual(resp.status_code, 500)
+            self.assertIs(config.get_key(k1.public_key_hash())['signer'],
+                          newer)
+
+    #
+    # A change to a setting which the ratchet does not read keeps it, and
+    # so what was signed before the reload is still refused after it.
+
+    def test_reload_keeps_ratchet(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        conf = {
+            'chain_ratchet': 'memory',
+            'keys': [ k1.secret_key() ],
+            'policy': { 'baking': 1 },
+        }
+        sigreq = SignatureReq(sig_reqs[0][-1])
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, 'keys.json')
+            with open(filename, 'w') as f:
+                json.dump(conf, f)
+            config = ConfigReloader(filename)
+            config.get_key(k1.public_key_hash())['signer'].sign(sigreq)
+
+            conf['hsm_pool_size'] = 4
+            with open(filename, 'w') as f:
+                json.dump(conf, f)
+            config.reload()
+            with self.assertRaises(Gone):
+                config.get_key(k1.public_key_hash())['signer'].sign(sigreq)
+
+    def test_profile(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        pkh = k1.public_key_hash()
+        client = create_app(TacoinfraConfig(conf = {
+            'chain_ratchet': 'mockery',
+            'keys': [ k1.secret_key() ],
+            'policy': { 'baking': 1 },
+        })).test_client()
+        data = json.dumps(sig_reqs[0][-1])
+
+        resp = client.post('/admin/profile', json={},
+                           environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(resp.status_code, 403)
+        resp = client.post('/admin/profile', json={'mode': 'other'})
+        self.assertEqual(resp.status_code, 400)
+
+        #
+        # Sampling only sees the requests when they have released the
+        # GIL, i.e. mostly while they write their logs, so we look for
+        # the request handler anywhere on the stacks rather than on top.
+        # Other tests' idle ratchet threads are sampled too, hence top.
+
+        for settings in [{'mode': 'cprofile', 'requests': 20},
+                         {'mode': 'sample', 'seconds': 0.2,
+                          'sort': 'cumtime', 'top': 1000}]:
+            resp = client.post('/admin/profile', json=settings)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json()['state'], 'running')
+            resp = client.post('/admin/profile', json={})
+            self.assertEqual(resp.status_code, 409)
+
+            for i in range(10000):
+                client.post(f'/keys/{pkh}', data=data)
+                report = client.get('/admin/profile').get_json()
+                if report['state'] == 'done':
+                    break
+            self.assertEqual(report['state'], 'done')
+            self.assertTrue(any(f['function'].startswith('tezos_signer/')
+                                for f in report['functions']))
+            if settings['mode'] == 'cprofile':
+                self.assertEqual(report['requests'], 20)
+            else:
+                self.assertGreater(report['samples'], 0)
+                self.assertTrue(any(
+                    f['function'].startswith('tezos_signer/handlers.py') and
+                    f['function'].endswith('(sign_or_get)') and
+                    f['cumulative'] > 0 for f in report['functions']))
+
+        resp = client.get('/admin/stacks')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Thread MainThread', resp.get_data(as_text=True))
+
+    def test_octez_sockets(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        binary_pkh = b'\x02' + encoding.base58_decode(
+            k1.public_key_hash().encode(), b'tz3')
+
+        def call(sock, request):
+            sock.sendall(octezserver.frame(request))
+            return octezserver.read_frame(sock)
+
+        with tempfile.TemporaryDirectory() as dir:
+            for family, uri in [(socket.AF_INET, 'tcp://127.0.0.1:0'),
+                                (socket.AF_UNIX, f'unix:{dir}/signer.sock')]:
+                config = TacoinfraConfig(conf = {
+                    'chain_ratchet': 'mockery',
+                    'keys': [ k1.secret_key() ],
+                    'policy': {
+                        'baking': 1,
+                        'voting': ['pass'],
+                    }
+                })
+                server = octezserver.make_server(config, uri)
+                threading.Thread(target=server.serve_forever,
+                                 daemon=True).start()
+                try:
+                    with socket.socket(family) as sock:
+                        sock.connect(server.server_address)
+                        self.assertEqual(call(sock, b'\x02'), b'\x00\x00')
+                        self.assertEqual(call(sock, b'\x05'), b'\x00\x00')
+                        self.assertEqual(
+                            call(sock, b'\x01' + binary_pkh),
+                            b'\x00' + encoding.decode_public_key(
+                                k1.public_key()))
+
+                        for req in sig_reqs:
+                            payload = bytes.fromhex(req[-1])
+                            resp = call(sock, b'\x00' + binary_pkh +
+                                        len(payload).to_bytes(4, 'big') +
+                                        payload)
+                            if req[0] != 'Success':
+                                self.assertEqual(resp[0], 1)
+                                continue
+                            self.assertEqual(resp[0], 0, resp)
+                            sig = encoding.base58_encode(resp[1:], b'p2sig')
+                            k1.verify(sig.decode(), payload)
+
+                        resp = call(sock, b'\x01\x00' + binary_pkh[1:])
+                        self.assertEqual(resp[0], 1)
+                        self.assertIn(b'404 ', resp)
+                        self.assertIn(b'400 ', call(sock, b'\x00\x02'))
+                        self.assertIn(b'not supported', call(sock, b'\x09'))
+                finally:
+                    server.shutdown()
+                    server.server_close()
+
+    def test_flask_and_asgi(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        pkh = k1.public_key_hash()
+        conf = {
+            'chain_ratchet': 'mockery',
+            'keys': [ k1.secret_key() ],
+            'policy': {
+                'baking': 1,
+                'voting': ['pass'],
+            }
+        }
+        flask_client = create_app(TacoinfraConfig(conf=conf)).test_client()
+        asgi_app = SignerApp(TacoinfraConfig(conf=conf))
+
+        def flask_request(method, path, body=b''):
+            resp = flask_client.open(path, method=method, data=body)
+            return resp.status_code, resp.get_data()
+
+        for do_request in [flask_request,
+                           lambda *args: asgi_request(asgi_app, *args)]:
+            status, body = do_request('GET', f'/keys/{pkh}')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)['public_key'],
+                             k1.public_key())
+
+            status, body = do_request('GET', '/authorized_keys')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body), {})
+
+            status, body = do_request('GET', '/keys/tz1nope')
+            self.assertEqual(status, 404)
+
+            status, body = do_request('PUT', f'/keys/{pkh}')
+            self.assertEqual(status, 405)
+
+            status, body = do_request('POST', f'/keys/{pkh}', b'"zz"')
+            self.assertEqual(status, 400)
+
+            status, body = do_request('POST', f'/keys/{pkh}', b'{')
+            self.assertEqual(status, 400)
+
+            for req in sig_reqs:
+                if req[1] not in ['Baking', 'Ballot']:
+                    continue
+                status, body = do_request('POST', f'/keys/{pkh}',
+                                          json.dumps(req[-1]).encode())
+                if req[0] == 'Success':
+                    self.assertEqual(status, 200)
+                    k1.verify(json.loads(body)['signature'],
+                              bytes.fromhex(req[-1]))
+                else:
+                    self.assertIn(status, [403, 410])
+
+    def test_histogram_shards(self):
+        h = metrics.Histogram('test_seconds', 'A test histogram', ('stage',))
+
+        def observe():
+            for i in range(1000):
+                h.observe(0.003, 'a')
+                h.observe(20, 'b')
+
+        threads = [threading.Thread(target=observe) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        observe()
+
+        totals = h.collect()
+        self.assertEqual(sum(totals[('a',)][:-1]), 9000)
+        self.assertEqual(totals[('a',)][metrics.BUCKETS.index(0.005)], 9000)
+        self.assertEqual(totals[('b',)][len(metrics.BUCKETS)], 9000)
+        lines = h.render()
+        self.assertIn('test_seconds_bucket{stage="a",le="0.0025"} 0', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="0.005"} 9000', lines)
+        self.assertIn('test_seconds_bucket{stage="b",le="+Inf"} 9000', lines)
+        self.assertIn('test_seconds_count{stage="b"} 9000', lines)
+
+    def test_metrics_endpoint(self):
+        k1 = Key.generate(curve=b'p2', export=False)
+        pkh = k1.public_key_hash()
+        client = create_app(TacoinfraConfig(conf = {
+            'chain_ratchet': 'mockery',
+            'keys': [ k1.secret_key() ],
+            'policy': {
+                'baking': 1,
+                'voting': ['pass'],
+            }
+        })).test_client()
+
+        resp = client.post(f'/keys/{pkh}', data=json.dumps(sig_reqs[0][-1]))
+        self.assertEqual(resp.status_code, 200)
+
+        resp = client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        body = resp.get_data(as_text=True)
+        for stage, req_type, backend in [
+                ('decode', '', 'python'),
+                ('parse', 'Baking', 'python'),
+                ('policy', 'Baking', 'python'),
+                ('ratchet', 'Baking', 'MockChainRatchet'),
+                ('sign', 'Baking', 'LocalSigner'),
+                ('request', 'Baking', 'total')]:
+            labels = f'stage="{stage}",key="{pkh}",type="{req_type}",' + \
+                     f'backend="{backend}"'
+            self.assertIn(f'signer_stage_seconds_count{{{labels}}} 1', body)
+
+    def test_log_pipeline(self):
+        def record(level, msg):
+            return logging.LogRecord('test', level, __file__, 0, msg, (),
+                                     None)
+
+        ratelimit = RateLimitFilter(rate=0.001, burst=3)
+        passed = [ratelimit.filter(record(logging.WARNING, 'fail'))
+                  for i in range(10)]
+        self.assertEqual(passed, [True] * 3 + [False] * 7)
+        self.assertTrue(ratelimit.filter(record(logging.INFO, 'ok')))
+        ratelimit.tokens = 1
+        rec = record(logging.WARNING, 'fail')
+        self.assertTrue(ratelimit.filter(rec))
+        self.assertEqual(rec.getMessage(),
+                         'fail [7 failure messages suppressed]')
+        self.assertEqual(ratelimit.total_suppressed, 7)
+
+        handler = DroppingQueueHandler(queue.Queue(2))
+        for i in range(5):
+            handler.handle(record(logging.INFO, 'ok'))
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+
+        #
+        # Only request failures are rate limited.
+
+        root = logging.getLogger()
+        level = root.level
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, 'signer.log')
+            pipeline = LogPipeline(filename, failure_rate=0.001,
+                                   failure_burst=1)
+            try:
+                for i in range(3):
+                    logging.getLogger(REQUEST_LOGGER).warning('request')
+                    logging.warning('hsm')
+            finally:
+                pipeline.stop()
+                root.setLevel(level)
+            with open(filename) as f:
+                lines = f.read().splitlines()
+        self.assertEqual(len([l for l in lines if l.endswith('request')]), 1)
+        self.assertEqual(len([l for l in lines if l.endswith('hsm')]), 3)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,87 @@
+
+import multiprocessing
+import os
+import tempfile
+import unittest
+from test.common import run_two_key_test
+
+from pytezos.crypto.key import Key
+from werkzeug.exceptions import Gone
+
+from tezos_signer.config import TacoinfraConfig
+from tezos_signer.sqlitechainratchet import SQLiteChainRatchet
+
+LEVELS = 50
+PROCS = 4
+
+
+def sqlite_config(filename, keys=[], group_commit=True):
+    return TacoinfraConfig(conf = {
+        'chain_ratchet': 'sqlite',
+        'sqlite_file': filename,
+        'sqlite_group_commit': group_commit,
+        'keys': keys,
+        'policy': {
+            'baking': 1,
+            'voting': ['pass'],
+        }
+    })
+
+#
+# Each process races the others to sign every level and returns the
+# levels that it was allowed to sign.
+
+def race(filename, group_commit):
+    ratchet = SQLiteChainRatchet(sqlite_config(filename, [], group_commit))
+    won = []
+    for level in range(1, LEVELS + 1):
+        try:
+            ratchet.check('Endorsement_NetXdQprcVkpaWU_tz3race', level, 0)
+            won.append(level)
+        except Gone:
+            pass
+    return won
+
+
+class TestSQLiteChainRatchet(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'ratchet.db')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_local_and_sqlitechainratchet(self):
+        for group_commit in [True, False]:
+            k1 = Key.generate(curve=b'p2', export=False)
+            k2 = Key.generate(curve=b'p2', export=False)
+            config = sqlite_config(self.filename,
+                                   [ k1.secret_key(), k2.secret_key() ],
+                                   group_commit)
+            run_two_key_test(config, k1.public_key_hash(),
+                             k2.public_key_hash())
+
+    def test_survives_restart(self):
+        ratchet = SQLiteChainRatchet(sqlite_config(self.filename))
+        ratchet.check('Baking_NetXdQprcVkpaWU_tz3restart', 12, 1)
+
+        ratchet = SQLiteChainRatchet(sqlite_config(self.filename))
+        for level, round in [(12, 1), (12, 0), (11, 5)]:
+            with self.assertRaises(Gone):
+                ratchet.check('Baking_NetXdQprcVkpaWU_tz3restart', level,
+                              round)
+        ratchet.check('Baking_NetXdQprcVkpaWU_tz3restart', 12, 2)
+
+    def test_shared_between_processes(self):
+        with multiprocessing.Pool(PROCS) as pool:
+            for group_commit in [True, False]:
+                filename = os.path.join(self.dir.name,
+                                        f'race-{group_commit}.db')
+                results = pool.starmap(race,
+                                       [(filename, group_commit)] * PROCS)
+                won = sorted(level for levels in results for level in levels)
+                self.assertEqual(won, list(range(1, LEVELS + 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,43 @@
 # We skip isorting this file as the order is important.
 #
 # isort: skip_file
+#
+# Only the classes that every signer needs are imported here.  The
+# backends and the config are imported when they are first used, so
+# that, e.g., boto3 is only loaded if we use the DynamoDB ratchet and
+# PyKCS11 only if we use an HSM.  See also ratchets and signers in
+# config.py.
+
+import importlib
 
 from .sigreq import SignatureReq
 
 from .signer import Signer
-from .hsmsigner import HsmSigner
-from .localsigner import LocalSigner
 from .validatesigner import ValidateSigner
 
 from .chainratchet import ChainRatchet, MockChainRatchet
-from .ddbchainratchet import DDBChainRatchet
 
-from .config import TacoinfraConfig
+lazy = {
+    "DDBChainRatchet": ".ddbchainratchet",
+    "HsmSigner": ".hsmsigner",
+    "LeaseChainRatchet": ".leasechainratchet",
+    "LocalSigner": ".localsigner",
+    "MemoryChainRatchet": ".memorychainratchet",
+    "QuorumChainRatchet": ".quorumchainratchet",
+    "SQLiteChainRatchet": ".sqlitechainratchet",
+    "TacoinfraConfig": ".config",
+}
+
+def __getattr__(name):
+    if name not in lazy:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(lazy[name], __name__), name)
+    globals()[name] = value
+    return value
 
 __all__ = [ "ChainRatchet", "MockChainRatchet", "TacoinfraConfig",
-            "DDBChainRatchet", "HsmSigner", "LocalSigner", "MockSigner",
-            "Signer", "SignatureReq", "ValidateSigner" ]
+            "DDBChainRatchet", "HsmSigner", "LeaseChainRatchet",
+            "LocalSigner",
+            "MemoryChainRatchet", "MockSigner", "QuorumChainRatchet",
+            "Signer", "SignatureReq", "SQLiteChainRatchet",
+            "ValidateSigner" ]
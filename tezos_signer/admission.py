@@ -0,0 +1,149 @@
+#
+# Admission control in front of the ratchet and the signer.  At most
+# admission_slots requests are admitted at once and the rest wait in a
+# queue for their class:
+#
+#   consensus   preendorsements and endorsements, which are useless if
+#               they are late
+#   baking      blocks
+#   other       everything else, e.g. ballots
+#
+# When a slot is freed it goes to the first class with a request
+# waiting and, within the class, to each key in turn so that one busy
+# key cannot hold up the others.
+#
+# Requests are shed with a 503 rather than signed too late to be of
+# use: when their class's queue is full, when the time that the queue
+# ahead of them is expected to take, from the recent time that requests
+# have held a slot, is longer than admission_deadline_ms, or when they
+# have waited that long without being admitted.
+#
+# The controller is shared by all of the keys and is disabled if
+# admission_slots is 0, which is the default.
+
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from werkzeug.exceptions import abort
+
+from tezos_signer import metrics
+
+CLASSES = ['consensus', 'baking', 'other']
+PRIORITIES = {
+    'Preendorsement': 0,
+    'Endorsement': 0,
+    'Baking': 1,
+}
+SHED_REASONS = ['full', 'deadline', 'expired']
+SERVICE_DECAY = 0.1
+
+
+class Waiter:
+    __slots__ = ('admitted', 'event')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.admitted = False
+
+class AdmissionController:
+    def __init__(self, slots, queue_size=64, deadline=2.0):
+        if slots < 1:
+            raise(ValueError("admission_slots must be positive"))
+        self.slots = slots
+        self.free = slots
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.queues = [OrderedDict() for c in CLASSES]
+        self.waiting = [0] * len(CLASSES)
+        self.service = 0
+        self.admitted = [0] * len(CLASSES)
+        self.shed = {(c, r): 0 for c in CLASSES for r in SHED_REASONS}
+        metrics.register(self)
+
+    def reject(self, cls, reason, message):
+        # Called with the lock held.
+        self.shed[(CLASSES[cls], reason)] += 1
+        abort(503, f'Signer overloaded: {message}')
+
+    @contextmanager
+    def admit(self, pkh, req_type):
+        cls = PRIORITIES.get(req_type, len(CLASSES) - 1)
+        start = time.monotonic()
+        waiter = None
+        with self.lock:
+            if self.free > 0 and sum(self.waiting[:cls + 1]) == 0:
+                self.free -= 1
+                self.admitted[cls] += 1
+            elif self.waiting[cls] >= self.queue_size:
+                self.reject(cls, 'full', f'{CLASSES[cls]} queue is full')
+            else:
+                ahead = sum(self.waiting[:cls + 1])
+                expected = (ahead // self.slots + 1) * self.service
+                if expected > self.deadline:
+                    self.reject(cls, 'deadline',
+                                f'expected wait {expected * 1000:.0f}ms')
+                waiter = Waiter()
+                self.queues[cls].setdefault(pkh, deque()).append(waiter)
+                self.waiting[cls] += 1
+
+        if waiter is not None:
+            waiter.event.wait(self.deadline)
+            with self.lock:
+                if not waiter.admitted:
+                    queue = self.queues[cls]
+                    queue[pkh].remove(waiter)
+                    if len(queue[pkh]) == 0:
+                        del queue[pkh]
+                    self.waiting[cls] -= 1
+                    self.reject(cls, 'expired',
+                                f'not admitted within ' +
+                                f'{self.deadline * 1000:.0f}ms')
+                self.admitted[cls] += 1
+            metrics.stage_seconds.observe(time.monotonic() - start,
+                                          'admission', pkh, req_type,
+                                          CLASSES[cls])
+
+        admitted = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - admitted)
+
+    def release(self, elapsed):
+        with self.lock:
+            self.service += SERVICE_DECAY * (elapsed - self.service)
+            for cls, queue in enumerate(self.queues):
+                if len(queue) == 0:
+                    continue
+                #
+                # We take the first key's oldest request and, if it has
+                # more waiting, move the key to the back of the line.
+                pkh, waiters = queue.popitem(last=False)
+                waiter = waiters.popleft()
+                if len(waiters) > 0:
+                    queue[pkh] = waiters
+                self.waiting[cls] -= 1
+                waiter.admitted = True
+                waiter.event.set()
+                return
+            self.free += 1
+
+    def collect(self):
+        with self.lock:
+            result = [('signer_admission_slots_free', 'gauge',
+                       'Admission slots not in use', {}, self.free)]
+            for cls, name in enumerate(CLASSES):
+                result.append(('signer_admission_waiting', 'gauge',
+                               'Requests waiting to be admitted',
+                               {'class': name}, self.waiting[cls]))
+                result.append(('signer_admission_admitted_total', 'counter',
+                               'Requests admitted to the signer',
+                               {'class': name}, self.admitted[cls]))
+            for (name, reason), n in self.shed.items():
+                result.append(('signer_admission_shed_total', 'counter',
+                               'Requests shed with a 503',
+                               {'class': name, 'reason': reason}, n))
+            return result
@@ -0,0 +1,167 @@
+#
+# An ASGI server.  Connections and routing are handled by coroutines on
+# the event loop, so many bakers can hold keep-alive connections open
+# without a thread each, and the blocking work of signing (PKCS#11
+# calls, DynamoDB writes, etc.) is passed to a bounded pool of threads.
+#
+# We serve the app with uvicorn, which is imported only when we are
+# configured to use this server.
+
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException, MethodNotAllowed, abort
+
+from tezos_signer import handlers
+
+MAX_CONTENT_LENGTH = 65536
+
+
+class SignerApp:
+    def __init__(self, config, executor=None):
+        self.config = config
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=config.get_executor_threads(),
+                thread_name_prefix='signer')
+        self.executor = executor
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def keys(self, method, key_hash, body):
+        return await self.run(handlers.keys, self.config, key_hash, method,
+                              body)
+
+    async def batch(self, method, body):
+        return await self.run(handlers.batch, self.config, body)
+
+    async def authorized_keys(self, method, body):
+        return handlers.authorized_keys(self.config)
+
+    async def metrics(self, method, body):
+        return await self.run(handlers.get_metrics, self.config)
+
+    async def health(self, method, body):
+        return handlers.health(self.config)
+
+    async def admin_reload(self, method, client, body):
+        return await self.run(handlers.admin_reload, self.config, client)
+
+    async def admin_profile(self, method, client, body):
+        return await self.run(handlers.admin_profile, self.config, client,
+                              method, body)
+
+    async def admin_stacks(self, method, client, body):
+        return handlers.admin_stacks(self.config, client)
+
+    def route(self, method, path, client):
+        if path.startswith('/keys/'):
+            methods = ['GET', 'POST']
+            handler = self.keys
+            args = [path[len('/keys/'):]]
+        elif path == '/batch':
+            methods = ['POST']
+            handler = self.batch
+            args = []
+        elif path == '/authorized_keys':
+            methods = ['GET']
+            handler = self.authorized_keys
+            args = []
+        elif path == '/metrics':
+            methods = ['GET']
+            handler = self.metrics
+            args = []
+        elif path == '/health':
+            methods = ['GET']
+            handler = self.health
+            args = []
+        elif path == '/admin/reload':
+            methods = ['POST']
+            handler = self.admin_reload
+            args = [client]
+        elif path == '/admin/profile':
+            methods = ['GET', 'POST']
+            handler = self.admin_profile
+            args = [client]
+        elif path == '/admin/stacks':
+            methods = ['GET']
+            handler = self.admin_stacks
+            args = [client]
+        else:
+            abort(404)
+        if method not in methods:
+            raise(MethodNotAllowed(valid_methods=methods))
+        return handler, args
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        try:
+            client = (scope.get('client') or ('', 0))[0]
+            handler, args = self.route(scope['method'], scope['path'],
+                                       client)
+            body = await self.read_body(receive)
+            status, data = await handler(scope['method'], *args, body)
+        except HTTPException as e:
+            await self.respond(send, e.code, e.get_body().encode(),
+                               e.get_headers())
+            return
+        except Exception as e:
+            logging.error(f'Exception thrown during request: {str(e)}')
+            status, data = (500, {'error': str(e)})
+
+        if isinstance(data, str):
+            await self.respond(send, status, data.encode(),
+                               [('Content-Type', 'text/plain; charset=utf-8')])
+        else:
+            await self.respond(send, status, json.dumps(data).encode(),
+                               [('Content-Type', 'application/json')])
+
+    async def read_body(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_CONTENT_LENGTH:
+                abort(413)
+            if not message.get('more_body', False):
+                return body
+
+    async def respond(self, send, status, body, headers):
+        headers = [(k.lower().encode(), v.encode()) for k, v in headers
+                   if k.lower() != 'content-length']
+        headers.append((b'content-length', str(len(body)).encode()))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers,
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+def serve(config, app=None):
+    import uvicorn
+
+    if app is None:
+        app = SignerApp(config)
+    uvicorn.run(app, host=config.get_addr(), port=int(config.get_port()),
+                loop='asyncio', http='h11', lifespan='on',
+                timeout_keep_alive=config.get_keepalive_timeout(),
+                log_config=None, access_log=False)
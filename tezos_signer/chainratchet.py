@@ -12,11 +12,26 @@
 # NOTE: the code that inherits from ChainRatchet is expected to
 #       keep self.lastlevel and self.lastround up to date before
 #       calling check().
+#
+# Once all of the keys have been configured, preload() is called with
+# their public key hashes so that a ratchet may warm any state that it
+# keeps in memory.  The default is to do nothing.
+#
+# close() is called when a reload of keys.json has replaced the ratchet,
+# once the new config is in use, so that it may stop its threads and
+# release what it holds.  Checks may still arrive from requests which
+# were in flight.  The default is to do nothing.
 
 from werkzeug.exceptions import abort
 
 
 class ChainRatchet:
+    def preload(self, pkhs):
+        return
+
+    def close(self):
+        return
+
     def check(self, sig_type, level=0, round=0):
         if self.lastlevel < level:
             return True
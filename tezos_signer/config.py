@@ -7,6 +7,7 @@
 #     'hsm_username': 'resigner',
 #     'hsm_slot': 1,
 #     'hsm_lib': '/opt/cloudhsm/lib/libcloudhsm_pkcs11.so',
+#     'hsm_pool_size': 4,
 #     'keys': {
 #         'tz3aTaJ3d7Rh4yXpereo4yBm21xrs4bnzQvW': {
 #             'public_key':
@@ -22,67 +23,173 @@
 # }
 
 
+import copy
+import importlib
+import json
 import logging
 
-from flask import json
-from pytezos.crypto.encoding import is_pkh
-from pytezos.crypto.key import Key
+from tezos_signer import ValidateSigner, metrics
+from tezos_signer.admission import AdmissionController
+from tezos_signer.encoding import is_pkh
+from tezos_signer.replaycache import ReplayCache
 
-from tezos_signer import DDBChainRatchet, HsmSigner, LocalSigner, \
-                         MockChainRatchet, ValidateSigner
+#
+# The ratchets and signers are named by "module:class" so that only the
+# ones that are used are imported, see load().  Entries may also be
+# classes or other callables, e.g. in tests.
 
 ratchets = {
-    "mockery": MockChainRatchet,
-    "dynamodb": DDBChainRatchet,
+    "mockery": "tezos_signer.chainratchet:MockChainRatchet",
+    "dynamodb": "tezos_signer.ddbchainratchet:DDBChainRatchet",
+    "sqlite": "tezos_signer.sqlitechainratchet:SQLiteChainRatchet",
+    "memory": "tezos_signer.memorychainratchet:MemoryChainRatchet",
+    "lease": "tezos_signer.leasechainratchet:LeaseChainRatchet",
+    "quorum": "tezos_signer.quorumchainratchet:QuorumChainRatchet",
 }
 
 signers = {
-    "local": LocalSigner,
-    "amazon_hsm": HsmSigner,   # deprecated, for compatibility
-    "pkcs11_hsm": HsmSigner,
+    "local": "tezos_signer.localsigner:LocalSigner",
+    "amazon_hsm": "tezos_signer.hsmsigner:HsmSigner",   # deprecated
+    "pkcs11_hsm": "tezos_signer.hsmsigner:HsmSigner",
+}
+
+def load(registry, name):
+    entry = registry[name]
+    if isinstance(entry, str):
+        module, attr = entry.split(":")
+        entry = getattr(importlib.import_module(module), attr)
+        registry[name] = entry
+    return entry
+
+#
+# A config may be built from a previous one when keys.json is reloaded.
+# If only the settings below have changed, we reuse the previous
+# ChainRatchet and the signers of any keys which are defined exactly as
+# they were, so that HSM sessions and ratchet caches survive the reload.
+# Any other change builds the signers afresh.  The server settings are
+# only read at startup and so changes to them need a restart.
+#
+# The ChainRatchet is reused unless chain_ratchet or one of the settings
+# that its backend reads, listed by prefix in ratchet_settings, has
+# changed: a new MemoryChainRatchet would forget what has been signed
+# and a new DDBChainRatchet its cache.  Ratchets which are not listed
+# are rebuilt if any setting changes.  A ratchet that is replaced is
+# closed by the ConfigReloader once the new config is in use.
+
+reloadable = ["keys", "log_failure_burst", "log_failure_rate", "log_level",
+              "parallel_ratchet", "policy"]
+restart_only = ["bind_addr", "bind_port", "executor_threads",
+                "keepalive_timeout", "octez_sockets", "server"]
+
+DDB_SETTINGS = ("aws_region", "boto3_endpoint", "ddb_")
+
+ratchet_settings = {
+    "mockery": (),
+    "dynamodb": DDB_SETTINGS,
+    "sqlite": ("sqlite_",),
+    "memory": (),
+    "lease": DDB_SETTINGS + ("lease_",),
+    "quorum": DDB_SETTINGS + ("lease_", "quorum_ratchets", "sqlite_"),
 }
 
 
 class TacoinfraConfig:
-    def __init__(self, filename=None, conf=None):
-        if dict is None and filename is None:
+    def __init__(self, filename=None, conf=None, previous=None):
+        if conf is None and filename is None:
             filename = "keys.json"
 
         if filename is not None:
-            with open("keys.json", "r") as myfile:
+            with open(filename, "r") as myfile:
                 json_blob = myfile.read().replace("\n", "")
                 conf = json.loads(json_blob)
 
         logging.info(f"Loaded config contains: {json.dumps(conf, indent=2)}")
 
-        self.aws_region = conf.get("aws_region")
-        self.bind_addr = conf.get("bind_addr", "127.0.0.1")
-        self.bind_port = conf.get("bind_port", "5000")
-        self.boto3_endpoint = conf.get("boto3_endpoint")
-        self.ddb_table = conf.get("ddb_table")
-        self.hsm_username = conf.get("hsm_username")
-        self.hsm_slot = int(conf.get("hsm_slot", "0"))
-        self.hsm_lib = conf.get("hsm_lib")
-        self.policy = conf.get("policy")
+        self.settings = {k: v for k, v in conf.items() if k not in reloadable}
+        startup = metrics.startup
+        previous_ratchet = None
+        if previous is not None:
+            startup = metrics.Startup()
+            for k in restart_only:
+                if self.settings.get(k) != previous.settings.get(k):
+                    logging.warning(f"Config {k} changes on restart")
+            if self.ratchet_settings() == previous.ratchet_settings():
+                previous_ratchet = previous.ratchet
+            if self.settings != previous.settings:
+                logging.info("Config settings changed, not reusing state")
+                previous = None
+
+        self.parse(conf)
+
+        if self.server not in ["flask", "asgi"]:
+            raise (KeyError(f'server: {self.server} not found'))
 
         if "chain_ratchet" not in conf:
             raise (KeyError("config.chain_ratchet not defined"))
         if conf["chain_ratchet"] not in ratchets:
             raise (KeyError(f'ratchet: {conf["chain_ratchet"]} not found'))
-        cr = ratchets[conf["chain_ratchet"]](self)
+        if previous_ratchet is not None:
+            cr = previous_ratchet
+        else:
+            with startup.phase('ratchet'):
+                cr = load(ratchets, conf["chain_ratchet"])(self)
+        self.ratchet = cr
+        try:
+            self.build(conf, previous, startup)
+        except BaseException:
+            if cr is not previous_ratchet:
+                cr.close()
+            raise
+
+    #
+    # The settings which decide whether the ChainRatchet may be reused,
+    # see ratchet_settings above.
+
+    def ratchet_settings(self):
+        prefixes = ratchet_settings.get(self.settings.get("chain_ratchet"))
+        if prefixes is None:
+            return self.settings
+        return {k: v for k, v in self.settings.items()
+                if k == "chain_ratchet" or k.startswith(prefixes)}
+
+    def build(self, conf, previous, startup):
+        cr = self.ratchet
+
+        if previous is not None:
+            self.replay_cache = previous.replay_cache
+        elif self.replay_cache_size > 0:
+            self.replay_cache = ReplayCache(self.replay_cache_size,
+                                            self.replay_cache_ttl)
+        else:
+            self.replay_cache = None
+
+        if previous is not None:
+            self.admission = previous.admission
+        elif self.admission_slots > 0:
+            self.admission = AdmissionController(self.admission_slots,
+                                                 self.admission_queue,
+                                                 self.admission_deadline_ms
+                                                 / 1000)
+        else:
+            self.admission = None
 
         self.keys = {}
+        self.subsigners = {}
         for k in conf["keys"]:
             l = k.split(":")
             key = {}
+            spec = k
             if isinstance(conf["keys"], dict):
                 key = conf["keys"].get(k)
+                spec = json.dumps([k, key], sort_keys=True)
             if len(l) > 1:
                 key["signer"] = l[1]
                 key["signer_args"] = l[2:]
             if is_pkh(l[0]):
                 key["pkh"] = l[0]
             else:
+                from pytezos.crypto.key import Key
+
                 ptkey = Key.from_encoded_key(l[0])
                 k = ptkey.public_key_hash()
                 key["pkh"] = k
@@ -98,38 +205,199 @@ class TacoinfraConfig:
                 raise (Exception(f"key {k} does not define a signer"))
             if key["signer"] not in signers:
                 raise (KeyError(f'signer: {key["signer"]} not defined'))
-            ss = signers[key["signer"]](self, key)
+            ss = None
+            if previous is not None:
+                ss = previous.subsigners.get(spec)
+            if ss is None:
+                with startup.phase('signers'):
+                    ss = load(signers, key["signer"])(self, key)
+            self.subsigners[spec] = ss
 
             key["signer"] = ValidateSigner(self, key, ratchet=cr, subsigner=ss)
 
             self.keys[k] = key
 
+        with startup.phase('preload'):
+            cr.preload([key["pkh"] for key in self.keys.values()])
+        logging.info(f"Startup phases: {startup.summary()}")
+
+    def parse(self, conf):
+        self.conf = conf
+        self.admission_deadline_ms = float(conf.get("admission_deadline_ms",
+                                                    "2000"))
+        self.admission_queue = int(conf.get("admission_queue", "64"))
+        self.admission_slots = int(conf.get("admission_slots", "0"))
+        self.aws_region = conf.get("aws_region")
+        self.bind_addr = conf.get("bind_addr", "127.0.0.1")
+        self.bind_port = conf.get("bind_port", "5000")
+        self.boto3_endpoint = conf.get("boto3_endpoint")
+        self.ddb_budget_ms = float(conf.get("ddb_budget_ms", "1000"))
+        self.ddb_group_commit = conf.get("ddb_group_commit", False)
+        self.ddb_group_window = float(conf.get("ddb_group_window", "1"))
+        self.ddb_max_attempts = int(conf.get("ddb_max_attempts", "3"))
+        self.ddb_pool_size = int(conf.get("ddb_pool_size", "10"))
+        self.ddb_table = conf.get("ddb_table")
+        self.ddb_warmup = int(conf.get("ddb_warmup", "4"))
+        self.executor_threads = int(conf.get("executor_threads", "16"))
+        self.hsm_backoff = float(conf.get("hsm_backoff", "5"))
+        self.hsm_devices = conf.get("hsm_devices", [])
+        self.hsm_health_interval = float(conf.get("hsm_health_interval",
+                                                  "5"))
+        self.hsm_username = conf.get("hsm_username")
+        self.hsm_slot = int(conf.get("hsm_slot", "0"))
+        self.hsm_lib = conf.get("hsm_lib")
+        self.hsm_pool_size = int(conf.get("hsm_pool_size", "1"))
+        self.hsm_standby = int(conf.get("hsm_standby", "1"))
+        self.keepalive_timeout = int(conf.get("keepalive_timeout", "75"))
+        self.lease_duration = float(conf.get("lease_duration", "10"))
+        self.lease_flush_ms = float(conf.get("lease_flush_ms", "100"))
+        self.lease_name = conf.get("lease_name", "signer")
+        self.lease_owner = conf.get("lease_owner")
+        self.lease_reserve = int(conf.get("lease_reserve", "16"))
+        self.local_processes = int(conf.get("local_processes", "0"))
+        self.log_failure_burst = int(conf.get("log_failure_burst", "50"))
+        self.log_failure_rate = float(conf.get("log_failure_rate", "10"))
+        self.log_level = conf.get("log_level", "INFO")
+        self.octez_sockets = conf.get("octez_sockets", [])
+        self.parallel_ratchet = conf.get("parallel_ratchet", False)
+        self.policy = conf.get("policy")
+        self.quorum_ratchets = conf.get("quorum_ratchets", [])
+        self.replay_cache_size = int(conf.get("replay_cache_size", "0"))
+        self.replay_cache_ttl = float(conf.get("replay_cache_ttl", "120"))
+        self.server = conf.get("server", "flask")
+        self.sqlite_file = conf.get("sqlite_file", "ratchet.db")
+        self.sqlite_group_commit = conf.get("sqlite_group_commit", True)
+        self.sqlite_group_window = float(conf.get("sqlite_group_window", 0))
+
+    #
+    # derive() returns a copy of this config with some of its settings
+    # replaced, e.g. to configure each of the ratchets of a quorum.  The
+    # keys are not rebuilt.
+
+    def derive(self, overrides):
+        config = copy.copy(self)
+        config.parse(dict(self.conf, **overrides))
+        return config
+
     def get_addr(self):
         return self.bind_addr
 
+    def get_admission(self):
+        return self.admission
+
     def get_aws_region(self):
         return self.aws_region
 
     def get_boto3_endpoint(self):
         return self.boto3_endpoint
 
+    def get_ddb_budget_ms(self):
+        return self.ddb_budget_ms
+
+    def get_ddb_group_commit(self):
+        return self.ddb_group_commit
+
+    def get_ddb_group_window(self):
+        return self.ddb_group_window
+
+    def get_ddb_max_attempts(self):
+        return self.ddb_max_attempts
+
+    def get_ddb_pool_size(self):
+        return self.ddb_pool_size
+
     def get_ddb_table(self):
         return self.ddb_table
 
+    def get_ddb_warmup(self):
+        return self.ddb_warmup
+
+    def get_executor_threads(self):
+        return self.executor_threads
+
+    def get_hsm_backoff(self):
+        return self.hsm_backoff
+
+    def get_hsm_devices(self):
+        return self.hsm_devices
+
+    def get_hsm_health_interval(self):
+        return self.hsm_health_interval
+
     def get_hsm_lib(self):
         return self.hsm_lib
 
+    def get_hsm_pool_size(self):
+        return self.hsm_pool_size
+
     def get_hsm_slot(self):
         return self.hsm_slot
 
+    def get_hsm_standby(self):
+        return self.hsm_standby
+
     def get_hsm_username(self):
         return self.hsm_username
 
+    def get_keepalive_timeout(self):
+        return self.keepalive_timeout
+
     def get_key(self, pkh):
         return self.keys.get(pkh)
 
+    def get_lease_duration(self):
+        return self.lease_duration
+
+    def get_lease_flush_ms(self):
+        return self.lease_flush_ms
+
+    def get_lease_name(self):
+        return self.lease_name
+
+    def get_lease_owner(self):
+        return self.lease_owner
+
+    def get_lease_reserve(self):
+        return self.lease_reserve
+
+    def get_local_processes(self):
+        return self.local_processes
+
+    def get_log_failure_burst(self):
+        return self.log_failure_burst
+
+    def get_log_failure_rate(self):
+        return self.log_failure_rate
+
+    def get_log_level(self):
+        return self.log_level
+
+    def get_octez_sockets(self):
+        return self.octez_sockets
+
+    def get_parallel_ratchet(self):
+        return self.parallel_ratchet
+
     def get_port(self):
         return self.bind_port
 
     def get_policy(self):
         return self.policy
+
+    def get_quorum_ratchets(self):
+        return self.quorum_ratchets
+
+    def get_replay_cache(self):
+        return self.replay_cache
+
+    def get_server(self):
+        return self.server
+
+    def get_sqlite_file(self):
+        return self.sqlite_file
+
+    def get_sqlite_group_commit(self):
+        return self.sqlite_group_commit
+
+    def get_sqlite_group_window(self):
+        return self.sqlite_group_window
@@ -1,47 +1,363 @@
 
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
 
 import boto3
-from botocore.exceptions import ClientError
-from werkzeug.exceptions import abort
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from botocore.retries import standard
+from werkzeug.exceptions import Gone, abort
 
-from tezos_signer import ChainRatchet
+from tezos_signer import ChainRatchet, metrics
 
+#
+# DynamoDB is the source of truth for the ratchet, but we keep a
+# write-through cache of the highest (level, round) that we know to be
+# committed for each sig_type.  The ratchet only ever moves forward and
+# so any request at or below the cached value would fail the conditional
+# write and we can reject it without a round trip.  Requests above the
+# cached value still go to DynamoDB which decides whether they are
+# accepted: the cache may lag behind the table, e.g. when other signers
+# share it, but it is never ahead of it.
+#
+# We use the low-level client rather than a boto3 resource to avoid the
+# resource layer's (de)serialisation on every write, with a pool of
+# ddb_pool_size connections kept alive with TCP keep-alives and
+# standard retries.  A write must complete within ddb_budget_ms: we give
+# each of the ddb_max_attempts attempts an equal share of the budget as
+# its connect and read timeouts, and the backoff before each retry is
+# cut short so that the retry may still finish by the deadline, or the
+# retry is dropped if the deadline has passed.  And so a slow or
+# unreachable DynamoDB fails the request quickly rather than holding up
+# the baker.  At startup, we make ddb_warmup reads in parallel so that
+# the first requests do not pay for opening connections and TLS
+# handshakes.
+#
+# With ddb_group_commit, concurrent checks are written together, as
+# the attestations of all of the keys are at the start of each level.
+# Callers queue their writes for a writer thread which, if others are
+# already queued behind the first, waits ddb_group_window ms for the
+# rest of the burst to arrive.  It then sends everything queued, up to
+# MAX_BATCH writes, as one TransactWriteItems with the usual condition
+# on each write.  A transaction may not write the same item twice, so a
+# second write for a sig_type waits for the next batch.  If any
+# condition fails, DynamoDB cancels the whole transaction and tells us
+# which writes failed their conditions: those callers get their 410 and
+# the others fall back to writing singly, as do all of the callers of a
+# batch if the writer fails.  A caller waits no longer than
+# ddb_budget_ms for its batch.
+
+MAX_BATCH = 100
+
+CONDITION = "attribute_not_exists(sig_type) OR " + \
+                "(lastblock < :l OR " + \
+                    "( lastblock = :l AND lastround < :r)" + \
+                ")"
+
+RETRY = object()
+
+def make_client(config):
+    attempts = config.get_ddb_max_attempts()
+    budget = config.get_ddb_budget_ms() / 1000.0
+    timeout = budget / attempts
+    kwargs = {
+        "region_name": config.get_aws_region(),
+        "config": Config(
+            max_pool_connections=config.get_ddb_pool_size(),
+            connect_timeout=timeout,
+            read_timeout=timeout,
+            retries={'mode': 'standard', 'total_max_attempts': attempts},
+            tcp_keepalive=True,
+        ),
+    }
+    url = config.get_boto3_endpoint()
+    if url is not None:
+        kwargs.update({"endpoint_url": url})
+    client = boto3.client('dynamodb', **kwargs)
+    limit_retries(client, attempts, budget, timeout)
+    return client
+
+#
+# botocore's standard retry handler decides whether to retry and how
+# long to back off, but it knows nothing of our budget, so we replace it
+# with one which stamps each call with its deadline and bounds the
+# backoff by it.
+
+def limit_retries(client, attempts, budget, timeout):
+    events = client.meta.events
+    events.unregister('needs-retry.dynamodb',
+                      unique_id='retry-config-dynamodb')
+    handler = standard.register_retry_handler(client, attempts)
+    events.unregister('needs-retry.dynamodb',
+                      unique_id='retry-config-dynamodb')
+
+    def start(context, **kwargs):
+        context['deadline'] = time.monotonic() + budget
+
+    def needs_retry(request_dict, **kwargs):
+        delay = handler.needs_retry(request_dict=request_dict, **kwargs)
+        deadline = request_dict['context'].get('deadline')
+        if delay is None or deadline is None:
+            return delay
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        return min(delay, max(0, remaining - timeout))
+
+    events.register('before-call.dynamodb', start)
+    events.register('needs-retry.dynamodb', needs_retry,
+                    unique_id='retry-config-dynamodb')
 
 class DDBChainRatchet(ChainRatchet):
 
     def __init__(self, config):
         self.REGION = config.get_aws_region()
-        kwargs = {"region_name":self.REGION}
-        url = config.get_boto3_endpoint()
-        if url is not None:
-            kwargs.update({"endpoint_url": url})
-        self.dynamodb = boto3.resource('dynamodb', **kwargs)
-        self.table = self.dynamodb.Table(config.get_ddb_table())
+        self.table = config.get_ddb_table()
+        self.client = make_client(config)
+
+        self.lock = threading.Lock()
+        self.hwm = {}
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.fallbacks = 0
+        metrics.register(self)
+
+        self.group_commit = config.get_ddb_group_commit()
+        self.group_window = config.get_ddb_group_window() / 1000.0
+        self.budget = config.get_ddb_budget_ms() / 1000.0
+        self.closed = False
+        if self.group_commit:
+            self.queue = queue.Queue()
+            self.writer = threading.Thread(target=self.write_loop,
+                                           name='ddb-ratchet', daemon=True)
+            self.writer.start()
+
+        with metrics.startup.phase('ddb_warmup'):
+            self.warmup(config.get_ddb_warmup())
+
+    def warmup(self, n):
+        def get(i):
+            self.client.get_item(TableName=self.table,
+                                 Key={'sig_type': {'S': 'warmup'}})
+
+        if n <= 0:
+            return
+        try:
+            with ThreadPoolExecutor(max_workers=n) as executor:
+                list(executor.map(get, range(n)))
+        except (BotoCoreError, ClientError) as e:
+            logging.warning(f"DynamoDB warm up failed: {e}")
+
+    def collect(self):
+        labels = {'table': self.table}
+        return [
+            ('signer_ratchet_cache_hits_total', 'counter',
+             'Ratchet checks rejected from the in-memory cache', labels,
+             self.hits),
+            ('signer_ratchet_cache_misses_total', 'counter',
+             'Ratchet checks sent to DynamoDB', labels, self.misses),
+            ('signer_ratchet_batches_total', 'counter',
+             'Transactions of grouped ratchet writes', labels,
+             self.batches),
+            ('signer_ratchet_batch_fallbacks_total', 'counter',
+             'Grouped ratchet writes retried singly', labels,
+             self.fallbacks),
+        ]
+
+    def update_hwm(self, sig_type, level, round):
+        with self.lock:
+            if (level, round) > self.hwm.get(sig_type, (-1, -1)):
+                self.hwm[sig_type] = (level, round)
+
+    def preload(self, pkhs):
+        pkhs = set(pkhs)
+        if len(pkhs) == 0:
+            return
+        kwargs = {
+            'TableName': self.table,
+            'ProjectionExpression': 'sig_type, lastblock, lastround',
+            'ConsistentRead': True,
+        }
+        count = 0
+        while True:
+            resp = self.client.scan(**kwargs)
+            for item in resp.get('Items', []):
+                sig_type = item['sig_type']['S']
+                if sig_type.rsplit('_', 1)[-1] not in pkhs:
+                    continue
+                self.update_hwm(sig_type, int(item['lastblock']['N']),
+                                int(item['lastround']['N']))
+                count += 1
+            if 'LastEvaluatedKey' not in resp:
+                break
+            kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+        logging.info(f"Preloaded {count} ratchet entries from DynamoDB")
 
     def check(self, sig_type, level=0, round=0):
+        with self.lock:
+            last = self.hwm.get(sig_type)
+            if last is not None and (level, round) <= last:
+                self.hits += 1
+            else:
+                self.misses += 1
+                last = None
+        if last is not None:
+            abort(410, f"Will not sign {level}/{round} because ratchet " +
+                       f"has seen {last[0]}/{last[1]}")
+
+        if self.group_commit and not self.closed:
+            fut = Future()
+            self.queue.put(((sig_type, level, round), fut))
+            try:
+                result = fut.result(timeout=self.budget)
+            except TimeoutError:
+                logging.error("DynamoDB group commit timed out")
+                abort(500, "DB error")
+            if result is not RETRY:
+                self.update_hwm(sig_type, level, round)
+                return True
+
+        self.put(sig_type, level, round)
+        self.update_hwm(sig_type, level, round)
+        return True
+
+    def item(self, sig_type, level, round):
+        return {
+            'sig_type': {'S': sig_type},
+            'lastblock': {'N': str(level)},
+            'lastround': {'N': str(round)},
+        }
+
+    def values(self, level, round):
+        return {
+            ':l': {'N': str(level)},
+            ':r': {'N': str(round)},
+        }
+
+    def refused(self, sig_type, old, message):
+        #
+        # The table is ahead of our cache and has told us by how much,
+        # so we remember it for the retries.
+        if old is not None and 'lastblock' in old:
+            self.update_hwm(sig_type, int(old['lastblock']['N']),
+                            int(old['lastround']['N']))
+        return Gone("Ratchet will not sign: " + message)
+
+    def put(self, sig_type, level, round):
         try:
-            self.table.put_item(
-                Item={
-                    'sig_type': sig_type,
-                    'lastblock': level,
-                    'lastround': round,
-                },
-                ConditionExpression=
-                    "attribute_not_exists(sig_type) OR " +
-                        "(lastblock < :l OR " +
-                            "( lastblock = :l AND lastround < :r)" +
-                        ")",
-                ExpressionAttributeValues={
-                    ':l': level,
-                    ':r': round
-                }
+            self.client.put_item(
+                TableName=self.table,
+                Item=self.item(sig_type, level, round),
+                ConditionExpression=CONDITION,
+                ExpressionAttributeValues=self.values(level, round),
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
             )
         except ClientError as err:
             code = err.response['Error']['Code']
             if code == "ConditionalCheckFailedException":
-                abort(410, "Ratchet will not sign: " + 
-                      err.response['Error']['Message'])
+                raise self.refused(sig_type, err.response.get('Item'),
+                                   err.response['Error']['Message'])
             logging.error("DynamoDB error during UpdateItem: " +
                           err.response['Error']['Message'])
             abort(500, "DB error")
+        except BotoCoreError as err:
+            logging.error(f"DynamoDB error during UpdateItem: {err}")
+            abort(500, "DB error")
+
+    #
+    # commit() returns, for each write, None if it was committed, an
+    # exception for its caller, or RETRY if it should be written singly.
+
+    def commit(self, reqs):
+        if len(reqs) == 1:
+            return [RETRY]
+        try:
+            self.client.transact_write_items(TransactItems=[
+                {'Put': {
+                    'TableName': self.table,
+                    'Item': self.item(sig_type, level, round),
+                    'ConditionExpression': CONDITION,
+                    'ExpressionAttributeValues': self.values(level, round),
+                    'ReturnValuesOnConditionCheckFailure': 'ALL_OLD',
+                }} for sig_type, level, round in reqs])
+        except ClientError as err:
+            code = err.response['Error']['Code']
+            reasons = err.response.get('CancellationReasons')
+            if code != 'TransactionCanceledException' or \
+               reasons is None or len(reasons) != len(reqs):
+                logging.warning("DynamoDB error during TransactWriteItems: " +
+                                err.response['Error']['Message'])
+                self.fallbacks += len(reqs)
+                return [RETRY for req in reqs]
+            results = []
+            for (sig_type, level, round), reason in zip(reqs, reasons):
+                if reason.get('Code') == 'ConditionalCheckFailed':
+                    results.append(self.refused(sig_type, reason.get('Item'),
+                                                reason.get('Message', '')))
+                else:
+                    self.fallbacks += 1
+                    results.append(RETRY)
+            return results
+        except Exception as err:
+            logging.warning(f"DynamoDB error during TransactWriteItems: {err}")
+            self.fallbacks += len(reqs)
+            return [RETRY for req in reqs]
+        return [None for req in reqs]
+
+    #
+    # close() queues None, which stops the writer once it has written
+    # everything queued before it.
+
+    def write_loop(self):
+        deferred = []
+        stopping = False
+        while deferred or not stopping:
+            batch = deferred or [self.queue.get()]
+            deferred = []
+            if self.group_window > 0 and not self.queue.empty():
+                time.sleep(self.group_window)
+            while len(batch) < MAX_BATCH and not stopping:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+                if len(batch) == 0:
+                    continue
+            seen = set()
+            reqs = []
+            for req, fut in batch:
+                if req[0] in seen:
+                    deferred.append((req, fut))
+                else:
+                    seen.add(req[0])
+                    reqs.append((req, fut))
+            try:
+                self.write_batch(reqs)
+            except Exception as e:
+                logging.error(f"DynamoDB group commit failed: {e}")
+                for req, fut in reqs:
+                    if not fut.done():
+                        fut.set_result(RETRY)
+
+    def write_batch(self, reqs):
+        self.batches += 1
+        metrics.batch_size.observe(len(reqs), 'dynamodb')
+        results = self.commit([req for req, fut in reqs])
+        for (req, fut), result in zip(reqs, results):
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+    def close(self):
+        if self.group_commit and not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.writer.join()
@@ -0,0 +1,147 @@
+#
+# The store for LeaseChainRatchet in DynamoDB.  The lease is an item in
+# ddb_table whose sig_type is "lease_" followed by lease_name, with the
+# owner, epoch and expiry.  Each sig_type's item holds lastblock and
+# lastround, as for DDBChainRatchet, and the reservation, so a table
+# may be moved from DDBChainRatchet to LeaseChainRatchet as it is.
+# (Moving it back is only safe once the lease has been released, as
+# lastblock may be behind the reservation until then.)
+#
+# A reservation is a transaction of a condition check that the lease
+# is still ours at our epoch and the update of the sig_type, so that
+# it fails once anyone else has acquired the lease.
+
+import logging
+
+from botocore.exceptions import ClientError
+
+from tezos_signer.ddbchainratchet import make_client
+from tezos_signer.leasechainratchet import Fenced
+
+
+class DDBLeaseStore:
+
+    def __init__(self, config):
+        self.table = config.get_ddb_table()
+        self.client = make_client(config)
+
+    def lease_key(self, name):
+        return {'sig_type': {'S': f'lease_{name}'}}
+
+    def acquire(self, name, owner, duration, now):
+        try:
+            resp = self.client.update_item(
+                TableName=self.table,
+                Key=self.lease_key(name),
+                UpdateExpression='SET lease_owner = :o, expires = :x, ' +
+                                 'epoch = if_not_exists(epoch, :z) + :one',
+                ConditionExpression='attribute_not_exists(sig_type) OR ' +
+                                    'expires < :now OR lease_owner = :o',
+                ExpressionAttributeValues={
+                    ':o': {'S': owner},
+                    ':x': {'N': str(now + duration)},
+                    ':z': {'N': '0'},
+                    ':one': {'N': '1'},
+                    ':now': {'N': str(now)},
+                },
+                ReturnValues='UPDATED_NEW',
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] == \
+               'ConditionalCheckFailedException':
+                return None
+            raise
+        return int(resp['Attributes']['epoch']['N'])
+
+    def update_lease(self, name, owner, epoch, expires):
+        try:
+            self.client.update_item(
+                TableName=self.table,
+                Key=self.lease_key(name),
+                UpdateExpression='SET expires = :x',
+                ConditionExpression='lease_owner = :o AND epoch = :e',
+                ExpressionAttributeValues={
+                    ':o': {'S': owner},
+                    ':e': {'N': str(epoch)},
+                    ':x': {'N': str(expires)},
+                },
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] == \
+               'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def renew(self, name, owner, epoch, duration, now):
+        return self.update_lease(name, owner, epoch, now + duration)
+
+    def release(self, name, owner, epoch):
+        self.update_lease(name, owner, epoch, 0)
+
+    def get(self, sig_type):
+        resp = self.client.get_item(TableName=self.table,
+                                    Key={'sig_type': {'S': sig_type}},
+                                    ConsistentRead=True)
+        item = resp.get('Item')
+        if item is None:
+            return None
+        lastblock = lastround = None
+        if 'lastblock' in item:
+            lastblock = int(item['lastblock']['N'])
+            lastround = int(item['lastround']['N'])
+        return (lastblock, lastround, int(item.get('reserved', {'N': 0})['N']))
+
+    def reserve(self, sig_type, reserved, name, owner, epoch, hwm=None):
+        update = 'SET reserved = :r'
+        values = {':r': {'N': str(reserved)}}
+        if hwm is not None:
+            update += ', lastblock = :l, lastround = :rd'
+            values.update({':l': {'N': str(hwm[0])},
+                           ':rd': {'N': str(hwm[1])}})
+        try:
+            self.client.transact_write_items(TransactItems=[
+                {'ConditionCheck': {
+                    'TableName': self.table,
+                    'Key': self.lease_key(name),
+                    'ConditionExpression': 'lease_owner = :o AND epoch = :e',
+                    'ExpressionAttributeValues': {
+                        ':o': {'S': owner},
+                        ':e': {'N': str(epoch)},
+                    },
+                }},
+                {'Update': {
+                    'TableName': self.table,
+                    'Key': {'sig_type': {'S': sig_type}},
+                    'UpdateExpression': update,
+                    'ExpressionAttributeValues': values,
+                }},
+            ])
+        except ClientError as err:
+            if err.response['Error']['Code'] == \
+               'TransactionCanceledException':
+                reasons = err.response.get('CancellationReasons', [])
+                if len(reasons) > 0 and \
+                   reasons[0].get('Code') == 'ConditionalCheckFailed':
+                    raise Fenced(f'Lease {name} epoch {epoch} is not current')
+            raise
+
+    def persist(self, sig_type, level, round):
+        try:
+            self.client.update_item(
+                TableName=self.table,
+                Key={'sig_type': {'S': sig_type}},
+                UpdateExpression='SET lastblock = :l, lastround = :r',
+                ConditionExpression=
+                    'attribute_not_exists(lastblock) OR lastblock < :l ' +
+                    'OR (lastblock = :l AND lastround < :r)',
+                ExpressionAttributeValues={
+                    ':l': {'N': str(level)},
+                    ':r': {'N': str(round)},
+                },
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] != \
+               'ConditionalCheckFailedException':
+                logging.warning('DynamoDB error persisting the ratchet: ' +
+                                err.response['Error']['Message'])
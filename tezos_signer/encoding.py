@@ -0,0 +1,113 @@
+#
+# The few Tezos encodings that we need on the request path, so that the
+# signer does not have to import all of pytezos (and its dependencies)
+# to encode a chain id or a signature or to recognise a key hash.  Only
+# LocalSigner and keys given as public or secret keys in keys.json need
+# pytezos itself.
+#
+# The prefixes are the binary prefixes of the Tezos base58check
+# encodings, as in pytezos.crypto.encoding, with the length of the
+# data that follows them.
+
+import hashlib
+
+ALPHABET = b'123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+INDEX = {c: i for i, c in enumerate(ALPHABET)}
+
+prefixes = {
+    b'tz1': (b'\x06\xa1\x9f', 20),
+    b'tz2': (b'\x06\xa1\xa1', 20),
+    b'tz3': (b'\x06\xa1\xa4', 20),
+    b'tz4': (b'\x06\xa1\xa6', 20),
+    b'edpk': (b'\x0d\x0f\x25\xd9', 32),
+    b'sppk': (b'\x03\xfe\xe2\x56', 33),
+    b'p2pk': (b'\x03\xb2\x8b\x7f', 33),
+    b'Net': (b'\x57\x52\x00', 4),
+    b'sig': (b'\x04\x82\x2b', 64),
+    b'edsig': (b'\x09\xf5\xcd\x86\x12', 64),
+    b'spsig': (b'\x0d\x73\x65\x13\x3f', 64),
+    b'p2sig': (b'\x36\xf0\x2c\x34', 64),
+}
+
+#
+# In binary, key hashes and public keys are preceded by a tag for the
+# curve, which is their index in these lists.
+
+pkh_prefixes = [b'tz1', b'tz2', b'tz3', b'tz4']
+pk_prefixes = [b'edpk', b'sppk', b'p2pk']
+sig_prefixes = [b'edsig', b'spsig', b'p2sig', b'sig']
+
+
+def blake2b(data=b'', digest_size=32):
+    return hashlib.blake2b(data, digest_size=digest_size)
+
+def checksum(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4]
+
+def b58encode_check(data):
+    data += checksum(data)
+    n = int.from_bytes(data, 'big')
+    out = bytearray()
+    while n > 0:
+        n, r = divmod(n, 58)
+        out.append(ALPHABET[r])
+    out.extend(ALPHABET[0:1] * (len(data) - len(data.lstrip(b'\0'))))
+    out.reverse()
+    return bytes(out)
+
+def b58decode_check(v):
+    n = 0
+    try:
+        for c in v:
+            n = n * 58 + INDEX[c]
+    except KeyError:
+        raise ValueError('Invalid base58 character')
+    data = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    data = b'\0' * (len(v) - len(v.lstrip(ALPHABET[0:1]))) + data
+    if len(data) < 4 or checksum(data[:-4]) != data[-4:]:
+        raise ValueError('Invalid base58 checksum')
+    return data[:-4]
+
+def base58_encode(v, prefix):
+    binary, length = prefixes.get(prefix, (None, None))
+    if binary is None or len(v) != length:
+        raise ValueError('Invalid encoding, prefix or length mismatch.')
+    return b58encode_check(binary + v)
+
+def base58_decode(v, prefix):
+    binary, length = prefixes[prefix]
+    data = b58decode_check(v)
+    if not data.startswith(binary) or len(data) != len(binary) + length:
+        raise ValueError('Invalid encoding, prefix or length mismatch.')
+    return data[len(binary):]
+
+def is_pkh(v):
+    if isinstance(v, str):
+        v = v.encode()
+    if not isinstance(v, bytes):
+        return False
+    for prefix in pkh_prefixes:
+        if v.startswith(prefix):
+            try:
+                base58_decode(v, prefix)
+                return True
+            except ValueError:
+                return False
+    return False
+
+def encode_pkh(tag, raw):
+    if tag >= len(pkh_prefixes):
+        raise ValueError(f'Unknown key hash tag {tag}')
+    return base58_encode(raw, pkh_prefixes[tag]).decode()
+
+def decode_public_key(v):
+    for tag, prefix in enumerate(pk_prefixes):
+        if v.startswith(prefix.decode()):
+            return bytes([tag]) + base58_decode(v.encode(), prefix)
+    raise ValueError('Unknown public key prefix')
+
+def decode_signature(v):
+    for prefix in sig_prefixes:
+        if v.startswith(prefix.decode()):
+            return base58_decode(v.encode(), prefix)
+    raise ValueError('Unknown signature prefix')
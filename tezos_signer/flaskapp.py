@@ -0,0 +1,60 @@
+#
+# The Flask server.  This is the default server and is run with Flask's
+# built-in server by scripts/signer.
+
+from flask import Flask, Response, json, request
+
+from tezos_signer import handlers
+
+
+def make_response(app, status, data):
+    if isinstance(data, str):
+        return Response(data, status=status, mimetype='text/plain')
+    return app.response_class(
+        response=json.dumps(data),
+        status=status,
+        mimetype='application/json'
+    )
+
+def create_app(config):
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = 65536
+
+    @app.route('/keys/<key_hash>', methods=['GET', 'POST'])
+    def sign(key_hash):
+        return make_response(app, *handlers.keys(config, key_hash,
+                                                 request.method,
+                                                 request.get_data()))
+
+    @app.route('/batch', methods=['POST'])
+    def batch():
+        return make_response(app, *handlers.batch(config, request.get_data()))
+
+    @app.route('/authorized_keys', methods=['GET'])
+    def authorized_keys():
+        return make_response(app, *handlers.authorized_keys(config))
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return make_response(app, *handlers.get_metrics(config))
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return make_response(app, *handlers.health(config))
+
+    @app.route('/admin/reload', methods=['POST'])
+    def admin_reload():
+        return make_response(app, *handlers.admin_reload(config,
+                                                         request.remote_addr))
+
+    @app.route('/admin/profile', methods=['GET', 'POST'])
+    def admin_profile():
+        return make_response(app, *handlers.admin_profile(
+            config, request.remote_addr, request.method, request.get_data()))
+
+    @app.route('/admin/stacks', methods=['GET'])
+    def admin_stacks():
+        return make_response(app, *handlers.admin_stacks(config,
+                                                         request.remote_addr))
+
+    return app
@@ -0,0 +1,256 @@
+#
+# These are the request handlers which are shared by the servers that
+# we provide in flaskapp.py and asgiapp.py.  They are independent of the
+# web framework: they take the config and the parts of the request that
+# they need and return a tuple of (status, data) where data is either a
+# dictionary to be returned as JSON or a string to be returned as text.
+# Failures that should be returned to the client are raised as werkzeug
+# HTTPExceptions, e.g. via abort().
+#
+# The handlers block on the signers and ratchets and so asynchronous
+# servers should call them from an executor.
+#
+# The /admin endpoints are only served to clients on the loopback
+# interface.  Requests to /keys and /batch are passed through the
+# profiler while a profile started by /admin/profile is running, see
+# profiler.py.
+
+import ipaddress
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException, abort
+
+from tezos_signer import SignatureReq, metrics
+from tezos_signer.profiler import profiler
+
+reqlog = logging.getLogger('tezos_signer.request')
+
+#
+# We log one record per request.  The arguments are formatted lazily by
+# the logging thread, so this costs little on the request path and, at
+# WARNING, failures are subject to the rate limit in logsetup.py.
+
+def logreq(key_hash, sigreq, start, status, error=None):
+    elapsed = time.perf_counter() - start
+    if sigreq is not None:
+        metrics.stage_seconds.observe(elapsed, 'request', key_hash,
+                                      sigreq.get_type(), 'total')
+    if error is None:
+        reqlog.info('key=%s req="%s" status=%d took=%.6f', key_hash,
+                    sigreq if sigreq is not None else '-', status, elapsed)
+    else:
+        reqlog.warning('key=%s req="%s" status=%d took=%.6f error="%s"',
+                       key_hash, sigreq if sigreq is not None else '-',
+                       status, elapsed, error)
+
+def decode_json(body):
+    try:
+        return json.loads(body)
+    except ValueError:
+        abort(400, 'Failed to decode JSON object')
+
+#
+# The binary protocol (see octezserver.py) calls keys() with raw set and
+# the payload itself as the body rather than hex in JSON.
+
+def keys(config, key_hash, method, body=None, raw=False):
+    if profiler.active:
+        return profiler.profile(sign_or_get, config, key_hash, method, body,
+                                raw)
+    return sign_or_get(config, key_hash, method, body, raw)
+
+def sign_or_get(config, key_hash, method, body, raw):
+    response = None
+    sigreq = None
+    start = time.perf_counter()
+    try:
+        key = config.get_key(key_hash)
+        if key is not None:
+            if method == 'POST':
+                if raw:
+                    hexdata = body
+                else:
+                    with metrics.timed('decode', key_hash, '', 'python'):
+                        hexdata = decode_json(body)
+                parse_start = time.perf_counter()
+                sigreq = SignatureReq(hexdata)
+                metrics.stage_seconds.observe(
+                    time.perf_counter() - parse_start,
+                    'parse', key_hash, sigreq.get_type(), 'python')
+                response = (200, {
+                    'signature': key['signer'].sign(sigreq)
+                })
+            else:
+                response = (200, { 'public_key': key['public_key'] })
+        else:
+            response = (404, 'Key not found')
+            logreq(key_hash, sigreq, start, 404, 'Key not found')
+            return response
+    except HTTPException as e:
+        logreq(key_hash, sigreq, start, e.code, e.description)
+        raise
+    except Exception as e:
+        logreq(key_hash, sigreq, start, 500,
+               f'Exception thrown during request: {e}')
+        return (500, {'error': str(e)})
+
+    logreq(key_hash, sigreq, start, 200)
+
+    return response
+
+#
+# A batch is a list of [key_hash, data] pairs which are signed as if
+# each had been POSTed to /keys/<key_hash>, and the response is a list
+# of the results in the same order: either {"signature": ...} or
+# {"status": ..., "error": ...}.  We look up the keys and parse all of
+# the requests first and then sign in parallel across keys.  The
+# requests for each key are signed in the order that they appear in the
+# batch so that, e.g., a preendorsement is ratcheted before the
+# endorsement that follows it.
+#
+# The batch threads are separate from those used for parallel_ratchet
+# as they wait on them.
+
+batch_executor = None
+batch_executor_lock = threading.Lock()
+
+def get_batch_executor(threads):
+    global batch_executor
+
+    with batch_executor_lock:
+        if batch_executor is None:
+            batch_executor = ThreadPoolExecutor(max_workers=threads,
+                                                thread_name_prefix='batch')
+        return batch_executor
+
+def batch_error(key_hash, sigreq, start, status, error):
+    logreq(key_hash, sigreq, start, status, error)
+    return {'status': status, 'error': error}
+
+def batch_sign(key, items, results, start):
+    for i, key_hash, sigreq in items:
+        try:
+            results[i] = { 'signature': key['signer'].sign(sigreq) }
+            logreq(key_hash, sigreq, start, 200)
+        except HTTPException as e:
+            results[i] = batch_error(key_hash, sigreq, start, e.code,
+                                     e.description)
+        except Exception as e:
+            results[i] = batch_error(key_hash, sigreq, start, 500,
+                                     f'Exception thrown during request: {e}')
+
+def batch(config, body):
+    if profiler.active:
+        return profiler.profile(sign_batch, config, body)
+    return sign_batch(config, body)
+
+def sign_batch(config, body):
+    start = time.perf_counter()
+    items = decode_json(body)
+    if not isinstance(items, list) or \
+       not all(isinstance(i, list) and len(i) == 2 for i in items):
+        abort(400, 'Batch must be a list of [key_hash, data] pairs')
+
+    results = [None] * len(items)
+    groups = {}
+    for i, (key_hash, hexdata) in enumerate(items):
+        key = config.get_key(key_hash) if isinstance(key_hash, str) else None
+        if key is None:
+            results[i] = batch_error(key_hash, None, start, 404,
+                                     'Key not found')
+            continue
+        try:
+            parse_start = time.perf_counter()
+            sigreq = SignatureReq(hexdata)
+            metrics.stage_seconds.observe(time.perf_counter() - parse_start,
+                                          'parse', key_hash,
+                                          sigreq.get_type(), 'python')
+        except HTTPException as e:
+            results[i] = batch_error(key_hash, None, start, e.code,
+                                     e.description)
+            continue
+        groups.setdefault(key['pkh'], (key, []))[1].append((i, key_hash,
+                                                            sigreq))
+
+    if len(groups) == 1:
+        batch_sign(*next(iter(groups.values())), results, start)
+    elif len(groups) > 1:
+        executor = get_batch_executor(config.get_executor_threads())
+        futures = [executor.submit(batch_sign, key, group, results, start)
+                   for key, group in groups.values()]
+        for f in futures:
+            f.result()
+
+    return (200, results)
+
+def authorized_keys(config):
+    return (200, {})
+
+def get_metrics(config):
+    return (200, metrics.render())
+
+#
+# GET /health reports the state of the HSMs as their health checks and
+# signatures last left it, without touching them, so it may be probed
+# as often as one likes.  It fails with 503 if any key has no device
+# which is up.
+
+def health(config):
+    devices = {}
+    status = 'ok'
+    for signer in config.subsigners.values():
+        if not hasattr(signer, 'health'):
+            continue
+        states = signer.health()
+        for state in states:
+            devices[state['device']] = state
+        if not any(state['up'] for state in states):
+            status = 'down'
+    if status == 'ok' and not all(d['up'] for d in devices.values()):
+        status = 'degraded'
+    return (503 if status == 'down' else 200,
+            {'status': status, 'hsm': [devices[d] for d in sorted(devices)]})
+
+def require_loopback(remote_addr):
+    try:
+        if ipaddress.ip_address(remote_addr).is_loopback:
+            return
+    except ValueError:
+        pass
+    abort(403, 'Admin requests are only allowed from loopback')
+
+def admin_reload(config, remote_addr):
+    require_loopback(remote_addr)
+    if not hasattr(config, 'reload'):
+        abort(404, 'Config reloading is not enabled')
+    try:
+        new = config.reload()
+    except Exception as e:
+        abort(500, f'Reload failed: {e}')
+    return (200, {'keys': len(new.keys)})
+
+#
+# POST /admin/profile starts a profile with the settings in the body, see
+# Profiler.start(), and GET returns the hot functions once it is done.
+
+def admin_profile(config, remote_addr, method, body=None):
+    require_loopback(remote_addr)
+    if method == 'GET':
+        return (200, profiler.report())
+    args = decode_json(body) if body else {}
+    if not isinstance(args, dict):
+        abort(400, 'Profile settings must be a JSON object')
+    try:
+        return (200, profiler.start(**args))
+    except (TypeError, ValueError) as e:
+        abort(400, f'Bad profile settings: {e}')
+    except RuntimeError as e:
+        abort(409, str(e))
+
+def admin_stacks(config, remote_addr):
+    require_loopback(remote_addr)
+    return (200, profiler.stacks())
@@ -2,22 +2,408 @@
 #
 
 import logging
+import queue
 import threading
+import time
+from contextlib import contextmanager
 
 from PyKCS11 import CKA_CLASS, CKA_LABEL, CKM_ECDSA, CKO_PRIVATE_KEY, \
-                    Mechanism, PyKCS11Lib
+                    CKR_DEVICE_ERROR, CKR_DEVICE_REMOVED, CKR_SESSION_CLOSED, \
+                    CKR_SESSION_HANDLE_INVALID, CKR_TOKEN_NOT_PRESENT, \
+                    CKR_USER_ALREADY_LOGGED_IN, CKR_USER_NOT_LOGGED_IN, \
+                    CKS_RO_USER_FUNCTIONS, CKS_RW_USER_FUNCTIONS, Mechanism, \
+                    PyKCS11Error, PyKCS11Lib
 
-from tezos_signer import Signer
+from tezos_signer import Signer, metrics
 
 #
-# We maintain a global seesion as many HSMs will prevent
-# multiple logins from the same user at the same time,
-# notably SoftHSMv2 which is used in our test framework.
-# This is also a little more efficient and we do not currently
-# have the ability to configure multiple HSMs in any case, so
-# we are not losing any functionality...
+# We maintain a global pool of sessions per HSM (library and slot)
+# which is shared by all of the HsmSigners.  PKCS#11 shares the login
+# state between all of the sessions that an application has open on a
+# token and many HSMs will prevent multiple logins from the same user
+# at the same time, notably SoftHSMv2 which is used in our test
+# framework, so we login once and open the rest of the sessions behind
+# it.  A session may only be used by one thread at a time and so each
+# signature checks a session out of the pool for the duration of the
+# call, which allows up to hsm_pool_size signatures to be in flight.
+#
+# Each pool also keeps an index of the private keys on the token by
+# label and by handle.  It is built with a single enumeration of the
+# token when the first HsmSigner looks for its key, rather than each
+# HsmSigner searching the token in turn, and is rebuilt if a key is not
+# found in case it was created after the index was built.
+#
+# Several HSMs, or slots, holding replicas of the same keys may be
+# listed in hsm_devices, each as a dictionary which overrides hsm_lib,
+# hsm_slot, hsm_username and hsm_pool_size.  Each pool also tracks the
+# health of its device: the number of signatures outstanding on it,
+# i.e. in flight or waiting for a session, the recent latency, and
+# whether it has failed recently.  An HsmSigner sends each signature to
+# the healthy device with the fewest outstanding, which steers requests
+# away from a device that has become slow as its requests pile up, and
+# retries on the next device if the call fails.  A device that fails is
+# skipped for hsm_backoff seconds, doubling with each consecutive
+# failure, unless no other device is available.
+
+MAX_BACKOFF = 60
+LATENCY_DECAY = 0.1
+SESSION_WAIT = 5
+
+#
+# The errors which mean that a session, or the device behind it, is
+# no longer usable.  Anything else, e.g. CKR_DATA_INVALID, is a problem
+# with the request and the session goes back to the pool.
+
+SESSION_ERRORS = [
+    CKR_DEVICE_ERROR,
+    CKR_DEVICE_REMOVED,
+    CKR_SESSION_CLOSED,
+    CKR_SESSION_HANDLE_INVALID,
+    CKR_TOKEN_NOT_PRESENT,
+    CKR_USER_NOT_LOGGED_IN,
+]
+
+#
+# Of those, the errors which are the session's own, after which a new
+# session on the same device should succeed.  After the others, e.g.
+# CKR_DEVICE_ERROR, the device is skipped and another one is tried.
+
+RETRY_ERRORS = [
+    CKR_SESSION_CLOSED,
+    CKR_SESSION_HANDLE_INVALID,
+    CKR_USER_NOT_LOGGED_IN,
+]
+
+libs = {}
+pools = {}
+pools_lock = threading.Lock()
+
+def load_lib(libfile):
+    with pools_lock:
+        if libfile not in libs:
+            with metrics.startup.phase('hsm_load'):
+                pkcs11 = PyKCS11Lib()
+                pkcs11.load(libfile)
+            libs[libfile] = pkcs11
+        return libs[libfile]
+
+def get_pool(libfile, slot, pin, size=1, backoff=5, standby=0,
+             health_interval=0):
+    pkcs11 = load_lib(libfile)
+    with pools_lock:
+        if (libfile, slot) not in pools:
+            with metrics.startup.phase('hsm_login'):
+                pools[(libfile, slot)] = SessionPool(pkcs11, slot, pin,
+                                                     size, backoff,
+                                                     f'{libfile}:{slot}',
+                                                     standby,
+                                                     health_interval)
+        return pools[(libfile, slot)]
+
+def choose(pools, exclude=()):
+    candidates = [p for p in pools if p not in exclude]
+    if len(candidates) == 0:
+        return None
+    healthy = [p for p in candidates if p.up()]
+    if len(healthy) == 0:
+        return min(candidates, key=lambda p: p.down_until)
+    return min(healthy, key=lambda p: (p.outstanding, p.latency))
+
+#
+# Raised in place of a session error when a standby session has already
+# taken the failed session's place, and so the signature may be retried
+# on the same device at once.
+
+class SessionReplaced(PyKCS11Error):
+    pass
+
+class SessionPool:
+    def __init__(self, pkcs11, slot, pin, size=1, backoff=5, name=None,
+                 standby=0, health_interval=0):
+        if size < 1:
+            raise(ValueError("HSM session pool size must be positive"))
+        self.pkcs11 = pkcs11
+        self.slot = slot
+        self.pin = pin
+        self.size = size
+        self.name = name if name is not None else str(slot)
+        self.idle = queue.Queue()
+        self.standby = queue.Queue()
+        self.broken = queue.Queue()
+        self.missing = 0
+        self.index_lock = threading.Lock()
+        self.index = None
+        self.state_lock = threading.Lock()
+        self.backoff = backoff
+        self.outstanding = 0
+        self.latency = 0
+        self.failures = 0
+        self.errors = 0
+        self.repairs = 0
+        self.down_until = 0
+        self.healthy = True
+        self.checked = None
+        self.error = None
+        for i in range(size + standby):
+            session = self.open()
+            if i < size:
+                self.idle.put(session)
+            else:
+                self.standby.put(session)
+
+        self.stopping = threading.Event()
+        self.threads = [threading.Thread(target=self.repair_loop,
+                                         name=f'hsm-repair {self.name}',
+                                         daemon=True)]
+        if health_interval > 0:
+            self.threads.append(threading.Thread(
+                target=self.health_loop, args=(health_interval,),
+                name=f'hsm-health {self.name}', daemon=True))
+        for t in self.threads:
+            t.start()
+
+        metrics.register(self)
+
+    #
+    # Sessions are opened behind a single login, see above, but after
+    # the connection to the HSM has been lost the login has gone with
+    # it, so each new session logs in unless we already are.
+
+    def open(self):
+        session = self.pkcs11.openSession(self.slot)
+        try:
+            session.login(self.pin)
+        except PyKCS11Error as e:
+            if e.value != CKR_USER_ALREADY_LOGGED_IN:
+                session.closeSession()
+                raise
+        return session
 
-session = None
+    #
+    # A session which fails with one of SESSION_ERRORS is not returned
+    # to the pool.  A standby session takes its place at once, so the
+    # retry need not wait, and the broken session is reopened by the
+    # repair thread.  If every session is broken, e.g. because the HSM
+    # has gone away, or none is freed within SESSION_WAIT seconds, we
+    # fail rather than wait for the repair.
+
+    @contextmanager
+    def session(self):
+        with self.state_lock:
+            self.outstanding += 1
+        try:
+            with self.state_lock:
+                gone = self.missing >= self.size
+            try:
+                if gone:
+                    raise queue.Empty
+                session = self.idle.get(timeout=SESSION_WAIT)
+            except queue.Empty:
+                raise PyKCS11Error(CKR_DEVICE_ERROR,
+                                   f'no session available on {self.name}')
+            try:
+                yield session
+            except PyKCS11Error as e:
+                if e.value not in SESSION_ERRORS:
+                    raise
+                replaced = self.discard(session)
+                session = None
+                if replaced and e.value in RETRY_ERRORS:
+                    raise SessionReplaced(e.value, e.text) from e
+                raise
+            finally:
+                if session is not None:
+                    self.idle.put(session)
+        finally:
+            with self.state_lock:
+                self.outstanding -= 1
+
+    def discard(self, session):
+        try:
+            self.idle.put(self.standby.get_nowait())
+            replaced = True
+        except queue.Empty:
+            with self.state_lock:
+                self.missing += 1
+            replaced = False
+        self.broken.put(session)
+        return replaced
+
+    def close_quietly(self, session):
+        try:
+            session.closeSession()
+        except Exception as e:
+            logging.debug(f'HSM {self.name} failed to close a session: {e}')
+
+    def set_health(self, error=None):
+        with self.state_lock:
+            self.healthy = error is None
+            self.error = None if error is None else str(error)
+
+    def repair_loop(self):
+        while not self.stopping.is_set():
+            session = self.broken.get()
+            if session is None:
+                return
+            self.close_quietly(session)
+            while not self.stopping.is_set():
+                try:
+                    session = self.open()
+                    break
+                except Exception as e:
+                    self.set_health(e)
+                    logging.warning(f'HSM {self.name} failed to open a ' +
+                                    f'session: {e}')
+                    self.stopping.wait(self.backoff)
+            else:
+                return
+            self.set_health()
+            with self.state_lock:
+                self.repairs += 1
+                missing = self.missing > 0
+                if missing:
+                    self.missing -= 1
+            if missing:
+                self.idle.put(session)
+            else:
+                self.standby.put(session)
+
+    #
+    # The health check uses a standby session, or a session opened for
+    # the purpose if there is none, and so never takes a session away
+    # from the signatures.
+
+    def check_health(self):
+        session = None
+        try:
+            session = self.standby.get_nowait()
+            standby = True
+        except queue.Empty:
+            standby = False
+        try:
+            if not standby:
+                session = self.pkcs11.openSession(self.slot)
+            info = session.getSessionInfo()
+            if info.state not in [CKS_RO_USER_FUNCTIONS,
+                                  CKS_RW_USER_FUNCTIONS]:
+                session.login(self.pin)
+        except PyKCS11Error as e:
+            if standby:
+                self.broken.put(session)
+            elif session is not None:
+                self.close_quietly(session)
+            self.set_health(e)
+            logging.warning(f'HSM {self.name} failed its health check: {e}')
+        else:
+            if standby:
+                self.standby.put(session)
+            else:
+                session.closeSession()
+            self.set_health()
+        self.checked = time.monotonic()
+
+    def health_loop(self, interval):
+        while not self.stopping.wait(interval):
+            try:
+                self.check_health()
+            except Exception as e:
+                logging.error(f'HSM {self.name} health check: {e}')
+
+    def up(self):
+        return self.healthy and self.down_until <= time.monotonic()
+
+    def health(self):
+        checked = None
+        if self.checked is not None:
+            checked = round(time.monotonic() - self.checked, 3)
+        return {
+            'device': self.name,
+            'up': self.up(),
+            'error': self.error,
+            'checked_ago': checked,
+            'outstanding': self.outstanding,
+            'standby': self.standby.qsize(),
+        }
+
+    def succeeded(self, elapsed):
+        with self.state_lock:
+            self.failures = 0
+            self.down_until = 0
+            self.healthy = True
+            self.error = None
+            self.latency += LATENCY_DECAY * (elapsed - self.latency)
+
+    #
+    # Signatures which were already in flight when the device failed
+    # are likely to fail too, so they do not extend the backoff.
+
+    def failed(self, error=None):
+        now = time.monotonic()
+        with self.state_lock:
+            self.errors += 1
+            if error is not None:
+                self.error = str(error)
+            if self.down_until <= now:
+                self.failures += 1
+                backoff = min(self.backoff * 2 ** (self.failures - 1),
+                              MAX_BACKOFF)
+                self.down_until = now + backoff
+            return self.down_until - now
+
+    def close(self):
+        self.stopping.set()
+        self.broken.put(None)
+        for q in [self.idle, self.standby]:
+            while True:
+                try:
+                    q.get_nowait().closeSession()
+                except queue.Empty:
+                    break
+
+    def find_key(self, handle):
+        with self.index_lock:
+            if self.index is not None:
+                key = self.index.get(handle)
+                if key is not None:
+                    return key
+            with metrics.startup.phase('hsm_index'):
+                with self.session() as session:
+                    self.index = KeyIndex(session)
+            return self.index.get(handle)
+
+    def collect(self):
+        labels = {'device': self.name}
+        return [
+            ('signer_hsm_outstanding', 'gauge',
+             'Signatures in flight or waiting for a session on each HSM',
+             labels, self.outstanding),
+            ('signer_hsm_errors_total', 'counter',
+             'Failed signatures on each HSM', labels, self.errors),
+            ('signer_hsm_up', 'gauge',
+             'Whether each HSM is in use, 0 while it is backing off',
+             labels, int(self.up())),
+            ('signer_hsm_standby_sessions', 'gauge',
+             'Logged in sessions ready to replace a failed one', labels,
+             self.standby.qsize()),
+            ('signer_hsm_repairs_total', 'counter',
+             'Sessions reopened after a failure', labels, self.repairs),
+        ]
+
+class KeyIndex:
+    def __init__(self, session):
+        self.labels = {}
+        self.handles = {}
+        for o in session.findObjects([(CKA_CLASS, CKO_PRIVATE_KEY)]):
+            self.handles[str(o.value())] = o
+            for label in session.getAttributeValue(o, [CKA_LABEL]):
+                self.labels.setdefault(label, o)
+        logging.info('Indexed %d private keys on the HSM', len(self.handles))
+
+    def get(self, handle):
+        key = self.labels.get(handle)
+        if key is None:
+            key = self.handles.get(handle)
+        return key
 
 def find_key(session, handle, filter=False):
     tmpl = [(CKA_CLASS, CKO_PRIVATE_KEY)]
@@ -33,47 +419,73 @@ def find_key(session, handle, filter=False):
 
 class HsmSigner(Signer):
     def __init__(self, config, key):
-        hsm_user = config.get_hsm_username()
         with open('hsm_passwd', 'r') as file:
             hsm_password = file.read().rstrip('\n')
-        self.hsm_pin = f'{hsm_user}:{hsm_password}'
-        self.hsm_libfile = config.get_hsm_lib()
+        self.pkh = key['pkh']
         self.hsm_private_handle = key['signer_args'][0]
-        self.hsm_slot = config.get_hsm_slot()
-        self.key = key
-        self.lock = threading.Lock()
-
-        global session
-        if session is None:
-            pkcs11 = PyKCS11Lib()
-            pkcs11.load(self.hsm_libfile)
-            session = pkcs11.openSession(self.hsm_slot)
-            session.login(self.hsm_pin)
-        self.session = session
-
-        self.key = find_key(self.session, self.hsm_private_handle, True)
-        if self.key is None:
-            self.key = find_key(self.session, self.hsm_private_handle)
-
-        if self.key is None:
+
+        self.keys = {}
+        for device in config.get_hsm_devices() or [{}]:
+            dconfig = config.derive(device)
+            pin = f'{dconfig.get_hsm_username()}:{hsm_password}'
+            pool = get_pool(dconfig.get_hsm_lib(), dconfig.get_hsm_slot(),
+                            pin, dconfig.get_hsm_pool_size(),
+                            dconfig.get_hsm_backoff(),
+                            dconfig.get_hsm_standby(),
+                            dconfig.get_hsm_health_interval())
+            hsm_key = pool.find_key(self.hsm_private_handle)
+            if hsm_key is None:
+                logging.warning(f"Can't find key for {key['pkh']} on " +
+                                f"HSM {pool.name}")
+                continue
+            self.keys[pool] = hsm_key
+        if len(self.keys) == 0:
             raise(KeyError(f"Can't find key for {key['pkh']}"))
 
+    def health(self):
+        return [pool.health() for pool in self.keys]
+
+    #
+    # When a standby session has already replaced a session which failed
+    # with one of RETRY_ERRORS, we retry once on the same pool before we
+    # count it as a failure of the device.
+
     def sign(self, sigreq):
-        logging.debug(f'Signing with HSM client:')
-        logging.debug(f'    Slot = {self.hsm_slot}')
-        logging.debug(f'    lib = {self.hsm_libfile}')
-        logging.debug(f'    private_handle = {self.hsm_private_handle}')
-        #
-        # XXXrcd: we continue to use a lock because it was necessary
-        #         when we were using py-hsm.  We are not sure we needed
-        #         it due to bugs in py-hsm or the underlying PKCS#11
-        #         library.  Although we strongly suspect the former, we
-        #         have not had time to test our hypothesis.
-        with self.lock:
-            sig = self.session.sign(self.key, sigreq.get_hashed_payload(),
-                                    Mechanism(CKM_ECDSA, None))
-            sig = bytes(sig)
-            logging.debug(f'Raw signature: {sig}')
-            encoded_sig = Signer.b58encode_signature(sig)
-            logging.debug(f'Base58-encoded signature: {encoded_sig}')
-            return encoded_sig
+        pools = list(self.keys)
+        tried = []
+        retried = []
+        while True:
+            pool = choose(pools, tried)
+            logging.debug('Signing with HSM client: device=%s handle=%s',
+                          pool.name, self.hsm_private_handle)
+            start = time.perf_counter()
+            try:
+                #
+                # Object handles are valid in all of the sessions that
+                # we have open on the token, so we can sign with
+                # whichever session we check out of the pool.
+                with pool.session() as session:
+                    sig = session.sign(self.keys[pool],
+                                       sigreq.get_hashed_payload(),
+                                       Mechanism(CKM_ECDSA, None))
+            except Exception as e:
+                if isinstance(e, SessionReplaced) and pool not in retried:
+                    retried.append(pool)
+                    logging.warning(f'HSM {pool.name} failed to sign, ' +
+                                    f'retrying on a standby session: {e}')
+                    continue
+                tried.append(pool)
+                backoff = pool.failed(e)
+                logging.warning(f'HSM {pool.name} failed to sign, skipping ' +
+                                f'it for {backoff:.1f}s: {e}')
+                if len(tried) == len(pools):
+                    raise
+                continue
+            elapsed = time.perf_counter() - start
+            pool.succeeded(elapsed)
+            metrics.stage_seconds.observe(elapsed, 'hsm', self.pkh,
+                                          sigreq.get_type(), pool.name)
+            break
+        encoded_sig = Signer.b58encode_signature(bytes(sig))
+        logging.debug('Base58-encoded signature: %s', encoded_sig)
+        return encoded_sig
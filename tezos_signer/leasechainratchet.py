@@ -0,0 +1,361 @@
+#
+# A ChainRatchet for active/standby signers which share a table.  The
+# signer that holds a time-bounded lease on the table checks ratchets
+# in memory, and the others refuse to sign until the lease is theirs.
+#
+# A lease is a record in the store with an owner, an expiry and an
+# epoch, which is incremented each time the lease is acquired.  The
+# holder renews it every lease_duration/3 seconds and the standbys try
+# to acquire it every lease_duration/4 seconds, which succeeds once it
+# has expired.  The expiry only decides when a standby may take over,
+# it is not what keeps us from double signing, and so we do not rely
+# on the signers' clocks agreeing.
+#
+# Instead, each sig_type carries a reservation: the highest level that
+# a holder may have signed.  Before the holder signs above its
+# reservation, it reserves lease_reserve levels ahead in a write which
+# is fenced by its epoch, i.e. which fails if the lease has since been
+# acquired by anyone else.  A new holder reads each sig_type after it
+# acquires the lease and will sign nothing at or below its reservation,
+# and so it is above anything that a previous holder signed or will
+# ever be allowed to sign.  Between reservations, checks are made
+# against the high-water marks in memory, and the high-water marks are
+# persisted by a thread of their own every lease_flush_ms, only the
+# latest for each sig_type being written, for monitoring and so that a
+# holder which releases the lease can hand over exactly where it
+# stopped.  The lease is renewed by another thread, so that it is never
+# held up by the writes.
+#
+# A holder which crashes, and so does not release the lease, leaves the
+# next holder to skip up to lease_reserve levels on each sig_type,
+# which is the price of keeping the writes off the request path.  Set
+# it to 0 to reserve on every level, which writes as often as
+# DDBChainRatchet.
+#
+# The store is DDBLeaseStore, see ddbleasestore.py, unless one is
+# given.  Stores provide:
+#
+#   acquire(name, owner, duration, now)     -> the new epoch or None
+#   renew(name, owner, epoch, duration, now) -> whether we still hold it
+#   release(name, owner, epoch)
+#   get(sig_type)       -> (lastblock, lastround, reserved) or None
+#   reserve(sig_type, reserved, name, owner, epoch, hwm=None)
+#                       raises Fenced if the epoch is no longer current
+#   persist(sig_type, level, round)  moving the high-water mark forward
+#
+# Signers in the same process share the lease of the same name and
+# owner.  When keys.json is reloaded, the new ratchet waits for the old
+# one to be closed, which happens once the new config is in use, and
+# the old one then releases the lease and hands it over at once.  If
+# the reload fails, the new ratchet is closed instead and the old one
+# carries on.
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from werkzeug.exceptions import abort
+
+from tezos_signer import ChainRatchet, metrics
+
+holders = {}
+holders_lock = threading.Lock()
+
+
+class Fenced(Exception):
+    pass
+
+class LeaseChainRatchet(ChainRatchet):
+
+    def __init__(self, config, store=None):
+        if store is None:
+            from tezos_signer.ddbleasestore import DDBLeaseStore
+
+            store = DDBLeaseStore(config)
+        self.store = store
+        self.name = config.get_lease_name()
+        self.owner = config.get_lease_owner() or \
+                     f'{socket.gethostname()}:{os.getpid()}'
+        self.duration = config.get_lease_duration()
+        self.reserve = config.get_lease_reserve()
+        self.flush_interval = config.get_lease_flush_ms() / 1000.0
+
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.state = {}
+        self.dirty = {}
+        self.epoch = None
+        self.successor = None
+        self.valid_until = 0
+        self.renew_at = 0
+        self.acquire_at = 0
+        self.reservations = 0
+        self.fenced = 0
+        metrics.register(self)
+
+        with holders_lock:
+            previous = holders.get((self.name, self.owner))
+            self.waiting = previous is not None
+            if self.waiting:
+                previous.successor = self
+            else:
+                holders[(self.name, self.owner)] = self
+
+        if not self.waiting:
+            with metrics.startup.phase('lease'):
+                self.try_acquire()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='lease',
+                                       daemon=True)
+        self.flusher = threading.Thread(target=self.flush_loop,
+                                        name='lease-flush', daemon=True)
+        self.thread.start()
+        self.flusher.start()
+
+    def collect(self):
+        labels = {'lease': self.name}
+        return [
+            ('signer_ratchet_lease_held', 'gauge',
+             'Whether this signer holds the ratchet lease', labels,
+             int(self.held() is not None)),
+            ('signer_ratchet_lease_epoch', 'gauge',
+             'The epoch of the ratchet lease that this signer holds',
+             labels, self.epoch or 0),
+            ('signer_ratchet_reservations_total', 'counter',
+             'Levels reserved ahead in the ratchet store', labels,
+             self.reservations),
+            ('signer_ratchet_lease_fenced_total', 'counter',
+             'Reservations refused because the lease was lost', labels,
+             self.fenced),
+        ]
+
+    def sig_lock(self, sig_type):
+        lock = self.locks.get(sig_type)
+        if lock is None:
+            lock = self.locks.setdefault(sig_type, threading.Lock())
+        return lock
+
+    def held(self):
+        epoch = self.epoch
+        if epoch is None or time.monotonic() >= self.valid_until:
+            return None
+        return epoch
+
+    def acquire(self):
+        start = time.monotonic()
+        self.acquire_at = start + self.duration / 4
+        epoch = self.store.acquire(self.name, self.owner, self.duration,
+                                   time.time())
+        if epoch is None:
+            return False
+        with self.lock:
+            self.state = {}
+            self.valid_until = start + self.duration
+            self.renew_at = start + self.duration / 3
+            self.epoch = epoch
+        logging.info(f'Acquired ratchet lease {self.name} epoch {epoch}')
+        return True
+
+    def renew(self):
+        epoch = self.epoch
+        start = time.monotonic()
+        if self.store.renew(self.name, self.owner, epoch, self.duration,
+                            time.time()):
+            self.valid_until = start + self.duration
+            self.renew_at = start + self.duration / 3
+        else:
+            self.lost(epoch)
+
+    def lost(self, epoch):
+        with self.lock:
+            if self.epoch == epoch:
+                self.epoch = None
+                logging.warning(f'Lost ratchet lease {self.name} ' +
+                                f'epoch {epoch}')
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        for sig_type, (level, round) in dirty.items():
+            self.store.persist(sig_type, level, round)
+
+    def try_acquire(self):
+        try:
+            self.acquire()
+        except Exception as e:
+            logging.warning(f'Ratchet lease {self.name}: {e}')
+
+    def flush_loop(self):
+        while not self.stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.warning(f'Ratchet lease {self.name} flush: {e}')
+
+    def run(self):
+        while not self.stopping.wait(self.flush_interval):
+            try:
+                now = time.monotonic()
+                if self.epoch is None:
+                    if not self.waiting and now >= self.acquire_at:
+                        self.acquire()
+                elif now >= self.renew_at:
+                    self.renew()
+            except Exception as e:
+                logging.warning(f'Ratchet lease {self.name}: {e}')
+
+    #
+    # close() stops the background threads and, if we hold the lease,
+    # persists the high-water marks, lowers each reservation to just
+    # below them and releases the lease, so that the next holder starts
+    # exactly where we stopped.  It then hands the lease to the ratchet
+    # of a reload which is waiting for it, if any.
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        self.flusher.join()
+        self.release()
+        key = (self.name, self.owner)
+        with holders_lock:
+            successor = None
+            if holders.get(key) is self:
+                successor = self.successor
+                if successor is None:
+                    del holders[key]
+                else:
+                    holders[key] = successor
+            elif holders.get(key) is not None and \
+                 holders[key].successor is self:
+                holders[key].successor = None
+        if successor is not None:
+            successor.try_acquire()
+            successor.waiting = False
+
+    def release(self):
+        with self.lock:
+            epoch, self.epoch = self.epoch, None
+        if epoch is None:
+            return
+        try:
+            for sig_type, st in list(self.state.items()):
+                with self.sig_lock(sig_type):
+                    if st['hwm'] is None or st['hwm'][0] <= st['floor']:
+                        continue
+                    self.store.reserve(sig_type, st['hwm'][0] - 1, self.name,
+                                       self.owner, epoch, st['hwm'])
+            self.store.release(self.name, self.owner, epoch)
+            logging.info(f'Released ratchet lease {self.name} epoch {epoch}')
+        except Exception as e:
+            logging.warning(f'Failed to release ratchet lease ' +
+                            f'{self.name}: {e}')
+
+    def load(self, sig_type):
+        item = self.store.get(sig_type)
+        if item is None:
+            return {'floor': 0, 'reserved': 0, 'hwm': None}
+        lastblock, lastround, reserved = item
+        hwm = None if lastblock is None else (lastblock, lastround)
+        return {'floor': reserved, 'reserved': reserved, 'hwm': hwm}
+
+    def check(self, sig_type, level=0, round=0):
+        with self.sig_lock(sig_type):
+            epoch = self.held()
+            if epoch is None:
+                abort(503, f'Ratchet lease {self.name} is not held')
+            st = self.state.get(sig_type)
+            if st is None:
+                st = self.load(sig_type)
+                self.state[sig_type] = st
+
+            if level <= st['floor']:
+                abort(410, f"Will not sign {level}/{round} because ratchet " +
+                           f"is reserved up to level {st['floor']}")
+            if st['hwm'] is not None and (level, round) <= st['hwm']:
+                abort(410, f"Will not sign {level}/{round} because ratchet " +
+                           f"has seen {st['hwm'][0]}/{st['hwm'][1]}")
+
+            if level > st['reserved']:
+                try:
+                    self.store.reserve(sig_type, level + self.reserve,
+                                       self.name, self.owner, epoch)
+                except Fenced:
+                    self.fenced += 1
+                    self.lost(epoch)
+                    abort(503, f'Ratchet lease {self.name} was lost')
+                except Exception as e:
+                    logging.error(f'Ratchet reservation failed: {e}')
+                    abort(500, "DB error")
+                self.reservations += 1
+                st['reserved'] = level + self.reserve
+
+            st['hwm'] = (level, round)
+            with self.lock:
+                self.dirty[sig_type] = (level, round)
+        return True
+
+#
+# An in-process store, with the same semantics as DDBLeaseStore, for
+# tests and for signers which only need to fail over between threads.
+
+class MemoryLeaseStore:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.leases = {}
+        self.items = {}
+
+    def acquire(self, name, owner, duration, now):
+        with self.lock:
+            lease = self.leases.get(name)
+            if lease is not None and lease['expires'] >= now and \
+               lease['owner'] != owner:
+                return None
+            epoch = 1 if lease is None else lease['epoch'] + 1
+            self.leases[name] = {'owner': owner, 'epoch': epoch,
+                                 'expires': now + duration}
+            return epoch
+
+    def current(self, name, owner, epoch):
+        lease = self.leases.get(name)
+        return lease is not None and lease['owner'] == owner and \
+               lease['epoch'] == epoch
+
+    def renew(self, name, owner, epoch, duration, now):
+        with self.lock:
+            if not self.current(name, owner, epoch):
+                return False
+            self.leases[name]['expires'] = now + duration
+            return True
+
+    def release(self, name, owner, epoch):
+        with self.lock:
+            if self.current(name, owner, epoch):
+                self.leases[name]['expires'] = 0
+
+    def get(self, sig_type):
+        with self.lock:
+            item = self.items.get(sig_type)
+            if item is None:
+                return None
+            return (item.get('lastblock'), item.get('lastround'),
+                    item.get('reserved', 0))
+
+    def reserve(self, sig_type, reserved, name, owner, epoch, hwm=None):
+        with self.lock:
+            if not self.current(name, owner, epoch):
+                raise Fenced(f'Lease {name} epoch {epoch} is not current')
+            item = self.items.setdefault(sig_type, {})
+            item['reserved'] = reserved
+            if hwm is not None:
+                item['lastblock'], item['lastround'] = hwm
+
+    def persist(self, sig_type, level, round):
+        with self.lock:
+            item = self.items.setdefault(sig_type, {})
+            if (level, round) > (item.get('lastblock', -1),
+                                 item.get('lastround', -1)):
+                item['lastblock'] = level
+                item['lastround'] = round
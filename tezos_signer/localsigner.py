@@ -1,17 +1,82 @@
 #
 # This is a simple local signer class.  It expects to have the secret
 # key passed in via the standard config next to the public_key.
+#
+# The key is decoded once, when the signer is built: decoding a p256
+# key costs about as much as signing with it.
+#
+# Signing is CPU bound and, for p256 keys, holds the GIL, so a signer
+# with many local keys is limited to one core.  If local_processes is
+# set, the signatures are made in a pool of that many worker processes
+# instead, shared by all of the LocalSigners.  The workers are spawned,
+# rather than forked from a process which already has threads, when the
+# first LocalSigner is built, and each decodes a key the first time it
+# signs with it and keeps it for the next time.
+
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from pytezos.crypto.key import Key
 
-from tezos_signer import Signer
+from tezos_signer import Signer, metrics
+
+pools = {}
+pools_lock = threading.Lock()
+
+#
+# The keys that a worker process has decoded, by their encoding.
+
+worker_keys = {}
+
+def worker_sign(private_key, payload):
+    key = worker_keys.get(private_key)
+    if key is None:
+        key = Key.from_encoded_key(private_key)
+        worker_keys[private_key] = key
+    return key.sign(payload)
+
+def worker_ready():
+    return True
+
+def get_pool(size):
+    with pools_lock:
+        pool = pools.get(size)
+        if pool is None:
+            with metrics.startup.phase('local_processes'):
+                pool = ProcessPoolExecutor(
+                    size, mp_context=multiprocessing.get_context('spawn'))
+                for f in [pool.submit(worker_ready) for i in range(size)]:
+                    f.result()
+            pools[size] = pool
+        return pool
+
+def discard_pool(size, pool):
+    with pools_lock:
+        if pools.get(size) is pool:
+            del pools[size]
+    pool.shutdown(wait=False)
 
 
 class LocalSigner(Signer):
     def __init__(self, config, key):
         self.config = config
         self.private_key = key['private_key']
+        self.key = Key.from_encoded_key(self.private_key)
+        self.processes = config.get_local_processes()
+        if self.processes > 0:
+            get_pool(self.processes)
 
     def sign(self, sigreq):
-        key = Key.from_encoded_key(self.private_key)
-        return key.sign(sigreq.get_payload())
+        if self.processes == 0:
+            return self.key.sign(sigreq.get_payload())
+        pool = get_pool(self.processes)
+        try:
+            return pool.submit(worker_sign, self.private_key,
+                               sigreq.get_payload()).result()
+        except BrokenProcessPool:
+            logging.error('A local signing process died, restarting them')
+            discard_pool(self.processes, pool)
+            raise
@@ -0,0 +1,113 @@
+#
+# Logging for the signer process.  The request threads never write to
+# the log file themselves: the root logger has a single QueueHandler
+# which hands records to a bounded queue that a QueueListener thread
+# drains to the file.  If the queue is full, we drop the record and
+# count it rather than block a signature on the disk.
+#
+# Request failures (records at WARNING and above from the request log,
+# REQUEST_LOGGER) are also rate limited with a token bucket so that a
+# flood of stale or bad requests cannot fill the queue.  Other records,
+# e.g. an HSM or DynamoDB failing, are never suppressed.  When records
+# have been suppressed, the next one that is let through says how many.
+
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+from tezos_signer import metrics
+
+FORMAT = '%(asctime)s %(threadName)s %(message)s'
+REQUEST_LOGGER = 'tezos_signer.request'
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.total_suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                self.total_suppressed += 1
+                return False
+            self.tokens -= 1
+            suppressed = self.suppressed
+            self.suppressed = 0
+        if suppressed > 0:
+            record.msg = f"{record.getMessage()} " + \
+                         f"[{suppressed} failure messages suppressed]"
+            record.args = ()
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    #
+    # QueueHandler formats the record in the calling thread so that it
+    # can be pickled, but our queue never leaves the process and so we
+    # leave the formatting to the listener.
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline:
+    def __init__(self, filename, level=logging.INFO, queue_size=10000,
+                 failure_rate=10, failure_burst=50):
+        self.file_handler = logging.FileHandler(filename)
+        self.file_handler.setFormatter(logging.Formatter(FORMAT))
+        self.ratelimit = RateLimitFilter(failure_rate, failure_burst)
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        logging.getLogger(REQUEST_LOGGER).addFilter(self.ratelimit)
+        self.listener = logging.handlers.QueueListener(self.handler.queue,
+                                                       self.file_handler)
+
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        root.setLevel(level)
+        self.listener.start()
+        metrics.register(self)
+
+    def configure(self, config):
+        logging.getLogger().setLevel(config.get_log_level())
+        with self.ratelimit.lock:
+            self.ratelimit.rate = config.get_log_failure_rate()
+            self.ratelimit.burst = config.get_log_failure_burst()
+
+    def stop(self):
+        self.listener.stop()
+        logging.getLogger().removeHandler(self.handler)
+        logging.getLogger(REQUEST_LOGGER).removeFilter(self.ratelimit)
+
+    def collect(self):
+        return [
+            ('signer_log_dropped_total', 'counter',
+             'Log records dropped because the log queue was full', {},
+             self.handler.dropped),
+            ('signer_log_suppressed_total', 'counter',
+             'Failure log records suppressed by the rate limit', {},
+             self.ratelimit.total_suppressed),
+        ]
@@ -0,0 +1,42 @@
+#
+# A ChainRatchet which keeps its high-water marks in memory.  It is as
+# fast as a ratchet can be, but it forgets everything when the signer
+# restarts and it is not shared with other signers, so it should only
+# be used where there is a single signer and something else, e.g. the
+# baker's own watermarks, covers a restart.
+#
+# The compare and set for each sig_type is performed under a lock of
+# its own, so that checks for different keys and chains never wait for
+# each other.  The locks are created on first use and never removed,
+# there being only a few sig_types for each key.
+
+import threading
+
+from werkzeug.exceptions import abort
+
+from tezos_signer import ChainRatchet
+
+
+class MemoryChainRatchet(ChainRatchet):
+
+    def __init__(self, config):
+        self.hwm = {}
+        self.locks = {}
+
+    def lock(self, sig_type):
+        lock = self.locks.get(sig_type)
+        if lock is None:
+            #
+            # setdefault is atomic, so if two threads race to create
+            # the lock for a sig_type they will both get the same one.
+            lock = self.locks.setdefault(sig_type, threading.Lock())
+        return lock
+
+    def check(self, sig_type, level=0, round=0):
+        with self.lock(sig_type):
+            last = self.hwm.get(sig_type)
+            if last is not None and (level, round) <= last:
+                abort(410, f"Will not sign {level}/{round} because ratchet " +
+                           f"has seen {last[0]}/{last[1]}")
+            self.hwm[sig_type] = (level, round)
+        return True
@@ -0,0 +1,202 @@
+#
+# Metrics in the Prometheus text format, served on /metrics.
+#
+# Latencies are recorded in histograms with fixed buckets.  To keep the
+# request path free of locks, each thread records into its own shard of
+# each histogram and the shards are only summed when /metrics is
+# scraped.  A scrape may therefore see an observation in a bucket a
+# moment before it is reflected in the _sum, which Prometheus tolerates.
+# The shards of threads that have exited are folded together from time
+# to time so that servers with a thread per request do not grow without
+# bound.
+#
+# Other objects, e.g. ratchets which count things, can register with
+# register() and implement a collect() method which returns a list of
+# (name, type, help, labels, value) tuples.
+#
+# We also record how long each phase of startup took, e.g. logging in
+# to the HSM or preloading the ratchet, so that slow starts can be
+# explained.  Phases may nest, in which case the outer phase includes
+# the inner ones.
+
+import bisect
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SWEEP_SHARDS = 64
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = {}
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            pass
+        shard = {}
+        with self.lock:
+            if len(self.shards) >= SWEEP_SHARDS:
+                self.sweep()
+            self.shards.append((threading.current_thread(), shard))
+        self.local.shard = shard
+        return shard
+
+    #
+    # Each series is a list of the count of observations in each bucket,
+    # those above the last bucket, and finally the sum of all of the
+    # observations.
+
+    def observe(self, value, *labels):
+        shard = self.shard()
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @staticmethod
+    def merge(into, shard):
+        for labels, series in list(shard.items()):
+            total = into.setdefault(labels, [0] * len(series))
+            for i, v in enumerate(series):
+                total[i] += v
+
+    def sweep(self):
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self.merge(self.retired, shard)
+        self.shards = live
+
+    def collect(self):
+        with self.lock:
+            self.sweep()
+            totals = {}
+            self.merge(totals, self.retired)
+            for thread, shard in self.shards:
+                self.merge(totals, shard)
+        return totals
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.collect().items()):
+            labelstr = format_labels(zip(self.labelnames, labels))
+            count = 0
+            for le, n in zip(self.buckets + ('+Inf',), series):
+                count += n
+                bucketlabels = format_labels(zip(self.labelnames + ('le',),
+                                                 labels + (str(le),)))
+                lines.append(f"{self.name}_bucket{bucketlabels} {count}")
+            lines.append(f"{self.name}_sum{labelstr} {series[-1]}")
+            lines.append(f"{self.name}_count{labelstr} {count}")
+        return lines
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start,
+                               *self.labels)
+
+class Startup:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def summary(self):
+        with self.lock:
+            return ' '.join(f'{name}={elapsed:.3f}s'
+                            for name, elapsed in self.phases.items())
+
+    def collect(self):
+        with self.lock:
+            return [('signer_startup_seconds', 'gauge',
+                     'Seconds spent in each phase of startup',
+                     {'phase': name}, elapsed)
+                    for name, elapsed in self.phases.items()]
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                     .replace('\n', '\\n')
+
+def format_labels(pairs):
+    pairs = [f'{k}="{escape(v)}"' for k, v in pairs]
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+stage_seconds = Histogram('signer_stage_seconds',
+                          'Time spent in each stage of a signing request',
+                          ('stage', 'key', 'type', 'backend'))
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 100)
+
+batch_size = Histogram('signer_ratchet_batch_size',
+                       'Ratchet writes committed together',
+                       ('backend',), BATCH_BUCKETS)
+
+histograms = [stage_seconds, batch_size]
+collectors = weakref.WeakSet()
+
+def timed(stage, key, type, backend):
+    return stage_seconds.time(stage, key, type, backend)
+
+def register(collector):
+    collectors.add(collector)
+
+startup = Startup()
+register(startup)
+
+def render():
+    lines = []
+    for h in histograms:
+        lines.extend(h.render())
+    metrics = {}
+    for c in list(collectors):
+        for name, type, help, labels, value in c.collect():
+            metrics.setdefault((name, type, help), []).append((labels,
+                                                               value))
+    for (name, type, help), values in sorted(metrics.items()):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for labels, value in values:
+            lines.append(f"{name}{format_labels(labels.items())} {value}")
+    return '\n'.join(lines) + '\n'
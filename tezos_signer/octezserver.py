@@ -0,0 +1,201 @@
+#
+# A server for the binary protocol that Octez clients and bakers use to
+# talk to a remote signer given as tcp://host:port or unix:/path.  Each
+# message, in either direction, is a two byte big-endian length followed
+# by the message.  A request starts with a one byte tag:
+#
+#   0   sign            key hash, payload with a four byte length, and
+#                       an optional authentication signature
+#   1   public key      key hash
+#   2   authorized keys
+#   5   supports deterministic nonces
+#
+# where a key hash is a byte for the curve and the 20 byte hash.  The
+# response is a zero byte followed by the result, or a one byte and the
+# error.  A signature is returned as its 64 bytes and a public key as a
+# byte for the curve followed by the key.  We do not check
+# authentication signatures and so answer that no keys are authorized,
+# which tells the client not to send them, and we do not support
+# deterministic nonces, so the baker generates its own.
+#
+# Requests go through the same handlers, and so the same SignatureReq,
+# ValidateSigner and ratchet, as the HTTP servers, but without the JSON
+# and hex.  Each connection is served by a thread of its own, and may
+# carry any number of requests in turn.
+#
+# The sockets are listed in octez_sockets, e.g.:
+#
+#   "octez_sockets": ["tcp://127.0.0.1:7732", "unix:/run/signer.sock"]
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+from werkzeug.exceptions import HTTPException
+
+from tezos_signer import encoding, handlers
+
+SIGN = 0
+PUBLIC_KEY = 1
+AUTHORIZED_KEYS = 2
+SUPPORTS_DETERMINISTIC_NONCES = 5
+
+u16 = struct.Struct('>H')
+u32 = struct.Struct('>L')
+
+
+class ProtocolError(Exception):
+    pass
+
+def recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+def read_frame(sock):
+    header = recv_exactly(sock, 2)
+    if header is None:
+        return None
+    frame = recv_exactly(sock, u16.unpack(header)[0])
+    if frame is None:
+        raise ProtocolError('Connection closed in the middle of a request')
+    return frame
+
+def frame(message):
+    return u16.pack(len(message)) + message
+
+def read_pkh(request, off):
+    if len(request) < off + 21:
+        raise ProtocolError('Truncated key hash')
+    try:
+        pkh = encoding.encode_pkh(request[off], request[off + 1:off + 21])
+    except ValueError as e:
+        raise ProtocolError(str(e))
+    return pkh, off + 21
+
+#
+# Errors are returned as an Octez error trace of one generic error,
+# "failure", which the client prints with its message.  Each error is
+# a JSON object which is encoded as a BSON document.
+
+def bson_strings(obj):
+    body = b''
+    for k, v in obj.items():
+        v = v.encode()
+        body += b'\x02' + k.encode() + b'\x00' + \
+                (len(v) + 1).to_bytes(4, 'little') + v + b'\x00'
+    return (len(body) + 5).to_bytes(4, 'little') + body + b'\x00'
+
+def error(message):
+    doc = bson_strings({'kind': 'permanent', 'id': 'failure',
+                        'msg': message})
+    return b'\x01' + u32.pack(len(doc)) + doc
+
+def ok(result):
+    return b'\x00' + result
+
+def response(status, data):
+    if status == 200:
+        return None
+    if isinstance(data, dict):
+        data = data.get('error', json.dumps(data))
+    return error(f'{status} {data}')
+
+def handle(config, request):
+    if len(request) == 0:
+        raise ProtocolError('Empty request')
+    tag = request[0]
+
+    if tag == SIGN:
+        pkh, off = read_pkh(request, 1)
+        if len(request) < off + 4:
+            raise ProtocolError('Truncated request')
+        n = u32.unpack_from(request, off)[0]
+        payload = request[off + 4:off + 4 + n]
+        if len(payload) < n:
+            raise ProtocolError('Truncated request')
+        status, data = handlers.keys(config, pkh, 'POST', payload, raw=True)
+        return response(status, data) or \
+               ok(encoding.decode_signature(data['signature']))
+
+    if tag == PUBLIC_KEY:
+        pkh, off = read_pkh(request, 1)
+        status, data = handlers.keys(config, pkh, 'GET')
+        return response(status, data) or \
+               ok(encoding.decode_public_key(data['public_key']))
+
+    if tag == AUTHORIZED_KEYS:
+        return ok(b'\x00')
+
+    if tag == SUPPORTS_DETERMINISTIC_NONCES:
+        return ok(b'\x00')
+
+    return error(f'Request {tag} is not supported')
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                request = read_frame(sock)
+                if request is None:
+                    return
+                try:
+                    reply = handle(self.server.config, request)
+                except HTTPException as e:
+                    reply = error(f'{e.code} {e.description}')
+                except ProtocolError as e:
+                    reply = error(f'400 {e}')
+                except Exception as e:
+                    logging.error(f'Exception thrown during request: {e}')
+                    reply = error(f'500 {e}')
+                sock.sendall(frame(reply))
+            except (OSError, ProtocolError):
+                return
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class TCP6Server(TCPServer):
+    address_family = socket.AF_INET6
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def make_server(config, uri):
+    if uri.startswith('tcp://'):
+        host, _, port = uri[len('tcp://'):].rpartition(':')
+        if host.startswith('['):
+            server = TCP6Server((host[1:-1], int(port)), Handler)
+        else:
+            server = TCPServer((host, int(port)), Handler)
+    elif uri.startswith('unix:'):
+        path = uri[len('unix:'):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = UnixServer(path, Handler)
+    else:
+        raise ValueError(f'octez_sockets: {uri} is not tcp:// or unix:')
+    server.config = config
+    return server
+
+def start(config):
+    servers = []
+    for uri in config.get_octez_sockets():
+        server = make_server(config, uri)
+        threading.Thread(target=server.serve_forever, name=f'octez {uri}',
+                         daemon=True).start()
+        logging.info(f'Serving the Octez binary protocol on {uri}')
+        servers.append(server)
+    return servers
@@ -0,0 +1,233 @@
+#
+# On-demand profiling of a running signer, driven by the /admin/profile
+# endpoints in handlers.py.  A profile runs for the next N requests or T
+# seconds, whichever comes first, in one of two modes:
+#
+#   cprofile    each request is run under its own cProfile.Profile in
+#               the thread that handles it and the results are merged.
+#               This gives exact call counts and times but only sees the
+#               request thread, e.g. not the subsigner of a request with
+#               parallel_ratchet, and slows the profiled requests down.
+#
+#   sample      a thread takes the stacks of all of the other threads
+#               every interval seconds and counts the functions on them,
+#               which sees every thread and costs the requests nothing.
+#               Only stacks which are inside tezos_signer are counted,
+#               from the outermost tezos_signer frame inwards, so that
+#               idle server threads and the frames of the server, which
+#               are under every request, do not drown out the rest.
+#               With sort "cumtime", functions are ranked by how many
+#               stacks they are on rather than by how many they top.
+#
+# A thread is sampled when it has let go of the GIL, and so the tops of
+# the stacks are biased towards I/O and C calls which release it, e.g.
+# the logging handler's write.
+#
+# While no profile is running, the only cost on the request path is
+# checking the active flag.
+#
+# stacks() returns the current stack of every thread, to see what they
+# are blocked on.
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODES = ['cprofile', 'sample']
+SORTS = ['tottime', 'cumtime', 'calls']
+
+
+def funcname(filename, lineno, name):
+    parts = filename.split(os.sep)
+    return f"{os.sep.join(parts[-2:])}:{lineno}({name})"
+
+class Session:
+    def __init__(self, mode, requests, seconds, top, sort, interval):
+        self.mode = mode
+        self.remaining = requests
+        self.top = top
+        self.sort = sort
+        self.interval = interval
+        self.start = time.monotonic()
+        self.deadline = self.start + seconds
+        self.elapsed = None
+        self.requests = 0
+        self.inflight = 0
+        self.stats = None
+        self.samples = 0
+        self.own = Counter()
+        self.cumulative = Counter()
+
+    def expired(self):
+        return time.monotonic() >= self.deadline or self.remaining == 0
+
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False
+        self.session = None
+
+    def start(self, mode='cprofile', requests=None, seconds=None, top=30,
+              sort='tottime', interval=0.005):
+        if mode not in MODES:
+            raise ValueError(f'mode must be one of {", ".join(MODES)}')
+        if sort not in SORTS:
+            raise ValueError(f'sort must be one of {", ".join(SORTS)}')
+        if seconds is None:
+            seconds = 10 if requests is None else 60
+        if float(seconds) <= 0 or float(interval) <= 0 or int(top) <= 0 or \
+           (requests is not None and int(requests) <= 0):
+            raise ValueError('requests, seconds, top and interval must ' +
+                             'be positive')
+        with self.lock:
+            if self.active:
+                raise RuntimeError('A profile is already running')
+            session = Session(mode, None if requests is None
+                              else int(requests), float(seconds), int(top),
+                              sort, float(interval))
+            self.session = session
+            self.active = True
+        if mode == 'sample':
+            threading.Thread(target=self.sample, args=(session,),
+                             name='profiler', daemon=True).start()
+        return self.status(session)
+
+    def finish(self, session):
+        # Called with the lock held.
+        if self.session is session and self.active:
+            session.elapsed = time.monotonic() - session.start
+            self.active = False
+
+    #
+    # profile() is called by the handlers with each request while a
+    # profile is active.
+
+    def profile(self, func, *args):
+        with self.lock:
+            session = self.session
+            if not self.active:
+                session = None
+            elif session.expired():
+                if session.inflight == 0:
+                    self.finish(session)
+                session = None
+            else:
+                session.requests += 1
+                session.inflight += 1
+                if session.remaining is not None:
+                    session.remaining -= 1
+        if session is None:
+            return func(*args)
+
+        prof = None
+        try:
+            if session.mode == 'cprofile':
+                prof = cProfile.Profile()
+                return prof.runcall(func, *args)
+            return func(*args)
+        finally:
+            with self.lock:
+                if prof is not None:
+                    if session.stats is None:
+                        session.stats = pstats.Stats(prof,
+                                                     stream=io.StringIO())
+                    else:
+                        session.stats.add(prof)
+                session.inflight -= 1
+                if session.expired() and session.inflight == 0:
+                    self.finish(session)
+
+    def sample(self, session):
+        me = threading.get_ident()
+        while True:
+            with self.lock:
+                if session.expired() and session.inflight == 0:
+                    self.finish(session)
+                if not self.active or self.session is not session:
+                    return
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                ours = 0
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno,
+                                  code.co_name))
+                    if code.co_filename.startswith(PACKAGE_DIR):
+                        ours = len(stack)
+                    frame = frame.f_back
+                if ours == 0:
+                    continue
+                stack = stack[:ours]
+                with self.lock:
+                    session.samples += 1
+                    session.own[stack[0]] += 1
+                    session.cumulative.update(set(stack))
+            time.sleep(session.interval)
+
+    def status(self, session):
+        return {
+            'mode': session.mode,
+            'state': 'running' if self.active and self.session is session
+                     else 'done',
+            'requests': session.requests,
+            'seconds': session.elapsed if session.elapsed is not None
+                       else time.monotonic() - session.start,
+        }
+
+    def report(self):
+        with self.lock:
+            session = self.session
+            if session is None:
+                return {'state': 'idle'}
+            if self.active and session.expired() and session.inflight == 0 \
+               and session.mode == 'cprofile':
+                self.finish(session)
+            result = self.status(session)
+            if result['state'] == 'running':
+                return result
+            if session.mode == 'cprofile':
+                result['functions'] = self.top_calls(session)
+            else:
+                result['samples'] = session.samples
+                counts = session.own
+                if session.sort == 'cumtime':
+                    counts = session.cumulative
+                result['functions'] = [
+                    {'function': funcname(*f),
+                     'own': session.own[f],
+                     'cumulative': session.cumulative[f]}
+                    for f, n in counts.most_common(session.top)]
+            return result
+
+    @staticmethod
+    def top_calls(session):
+        if session.stats is None:
+            return []
+        column = {'calls': 1, 'tottime': 2, 'cumtime': 3}[session.sort]
+        rows = sorted(session.stats.stats.items(),
+                      key=lambda item: item[1][column], reverse=True)
+        return [{'function': funcname(*f), 'calls': nc,
+                 'tottime': round(tt, 6), 'cumtime': round(ct, 6)}
+                for f, (cc, nc, tt, ct, callers) in rows[:session.top]]
+
+    @staticmethod
+    def stacks():
+        names = {t.ident: t.name for t in threading.enumerate()}
+        out = []
+        for ident, frame in sorted(sys._current_frames().items()):
+            out.append(f'Thread {names.get(ident, "?")} ({ident}):\n')
+            out.extend(traceback.format_stack(frame))
+            out.append('\n')
+        return ''.join(out)
+
+profiler = Profiler()
@@ -0,0 +1,137 @@
+#
+# A ChainRatchet which is a quorum of other ChainRatchets, e.g. DynamoDB
+# tables in several regions or SQLite files on several disks.  Each check
+# is sent to all of them at once and is accepted as soon as a majority
+# have accepted it, so a single slow or unavailable backend does not hold
+# up requests.  The backends that are still working on a check when the
+# majority is reached carry on in the background.
+#
+# This cannot double sign: each backend accepts a given sig_type at a
+# given level and round at most once, and any two majorities share a
+# backend, so at most one request at each level and round can win a
+# majority, however many signers share the backends.  If a check does
+# not win a majority, some backends may have moved forward anyway, which
+# only means that they will refuse requests at or below that level.
+#
+# The backends are listed in quorum_ratchets, each of which is a
+# dictionary of settings which override those of the enclosing config,
+# including chain_ratchet which names the backend's class.
+#
+# Each backend has its own pool of executor_threads threads and at most
+# that many checks in flight, so that a backend which hangs cannot take
+# the threads of the others.  A check which finds its backend's pool
+# full counts that backend's vote as failed rather than queueing behind
+# the checks which are stuck there.
+
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from werkzeug.exceptions import Gone, abort
+
+from tezos_signer import ChainRatchet, metrics
+
+
+class QuorumChainRatchet(ChainRatchet):
+
+    def __init__(self, config):
+        from tezos_signer.config import load, ratchets
+
+        self.backends = []
+        for i, conf in enumerate(config.get_quorum_ratchets()):
+            name = conf.get("chain_ratchet")
+            if name not in ratchets or name == "quorum":
+                raise (KeyError(f'quorum ratchet: {name} not found'))
+            ratchet = load(ratchets, name)(config.derive(conf))
+            self.backends.append((f'{i}:{type(ratchet).__name__}', ratchet))
+        if len(self.backends) == 0:
+            raise (KeyError("config.quorum_ratchets not defined"))
+
+        self.quorum = len(self.backends) // 2 + 1
+        self.cap = config.get_executor_threads()
+        self.executors = {
+            name: ThreadPoolExecutor(max_workers=self.cap,
+                                     thread_name_prefix=f'quorum-{name}')
+            for name, ratchet in self.backends}
+        self.lock = threading.Lock()
+        self.inflight = {name: 0 for name, ratchet in self.backends}
+        self.overloaded = {name: 0 for name, ratchet in self.backends}
+        metrics.register(self)
+
+    def collect(self):
+        return [
+            ('signer_ratchet_quorum_overloaded_total', 'counter',
+             'Quorum checks which found a backend with every thread busy',
+             {'quorum': name}, self.overloaded[name])
+            for name, ratchet in self.backends]
+
+    def preload(self, pkhs):
+        futures = [(name, self.executors[name].submit(ratchet.preload,
+                                                      pkhs))
+                   for name, ratchet in self.backends]
+        for name, f in futures:
+            try:
+                f.result()
+            except Exception as e:
+                logging.warning(f"Quorum ratchet {name} preload failed: {e}")
+
+    def close(self):
+        for name, ratchet in self.backends:
+            ratchet.close()
+            self.executors[name].shutdown(wait=False)
+
+    def check_one(self, name, ratchet, sig_type, level, round):
+        start = time.perf_counter()
+        try:
+            return ratchet.check(sig_type, level, round)
+        finally:
+            with self.lock:
+                self.inflight[name] -= 1
+            req_type, _, pkh = sig_type.split('_', 2)
+            metrics.stage_seconds.observe(time.perf_counter() - start,
+                                          'quorum', pkh, req_type, name)
+
+    def submit(self, name, ratchet, sig_type, level, round):
+        with self.lock:
+            if self.inflight[name] >= self.cap:
+                self.overloaded[name] += 1
+                return None
+            self.inflight[name] += 1
+        return self.executors[name].submit(self.check_one, name, ratchet,
+                                           sig_type, level, round)
+
+    def check(self, sig_type, level=0, round=0):
+        accepted = 0
+        refused = []
+        failed = []
+        pending = set()
+        for name, ratchet in self.backends:
+            f = self.submit(name, ratchet, sig_type, level, round)
+            if f is None:
+                failed.append(Exception(f'ratchet {name} is overloaded'))
+            else:
+                pending.add(f)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                e = f.exception()
+                if e is None:
+                    accepted += 1
+                elif isinstance(e, Gone):
+                    refused.append(e)
+                else:
+                    failed.append(e)
+            if accepted >= self.quorum:
+                return True
+            if len(refused) + len(failed) > len(self.backends) - self.quorum:
+                break
+
+        msg = f"{accepted} of {len(self.backends)} ratchets accepted, " + \
+              f"{self.quorum} needed"
+        if len(refused) > 0:
+            abort(410, f"Will not sign {level}/{round}: {msg}: " +
+                       refused[0].description)
+        logging.error(f"Ratchet quorum failed for {sig_type}: {msg}: " +
+                      f"{failed[0]}")
+        abort(500, "Ratchet quorum failed")
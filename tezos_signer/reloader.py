@@ -0,0 +1,81 @@
+#
+# Reloading keys.json without a restart.  A ConfigReloader stands in for
+# the TacoinfraConfig that the servers are given: it passes attribute
+# lookups through to the current config.  A reload builds a new config
+# from the file, reusing the ratchet and signers of the current one
+# where it can (see config.py), and then replaces the reference to the
+# current config.  The servers look up the key once per request, so a
+# request in flight completes with the config that it started with.
+#
+# A reload may be requested with SIGHUP, in which case it runs in a
+# thread of its own, or with a POST to /admin/reload from the loopback
+# interface which returns the result.  A failed reload leaves the
+# current config in place.  If the reload replaced the ChainRatchet, the
+# old one is closed once the new config is in use.
+
+import logging
+import signal
+import threading
+import time
+
+from tezos_signer import metrics
+from tezos_signer.config import TacoinfraConfig
+
+
+class ConfigReloader:
+    def __init__(self, filename="keys.json"):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.reloads = 0
+        self.failures = 0
+        self.config = TacoinfraConfig(filename)
+        metrics.register(self)
+
+    def __getattr__(self, name):
+        return getattr(self.config, name)
+
+    def reload(self):
+        with self.lock:
+            start = time.perf_counter()
+            try:
+                config = TacoinfraConfig(self.filename, previous=self.config)
+            except Exception as e:
+                self.failures += 1
+                logging.error(f"Failed to reload {self.filename}: {e}")
+                raise
+            previous, self.config = self.config, config
+            self.reloads += 1
+            logging.info(f"Reloaded {self.filename} with " +
+                         f"{len(config.keys)} keys in " +
+                         f"{time.perf_counter() - start:.3f}s")
+            if config.ratchet is not previous.ratchet:
+                try:
+                    previous.ratchet.close()
+                except Exception as e:
+                    logging.error(f"Failed to close the old ratchet: {e}")
+        for listener in self.listeners:
+            listener(config)
+        return config
+
+    def reload_in_background(self):
+        def reload():
+            #
+            # reload() has already logged and counted the failure.
+            try:
+                self.reload()
+            except Exception as e:
+                logging.debug(f"Background reload failed: {e}")
+        threading.Thread(target=reload, name='reload', daemon=True).start()
+
+    def install_sighup(self):
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: self.reload_in_background())
+
+    def collect(self):
+        return [
+            ('signer_config_reloads_total', 'counter',
+             'Successful reloads of the config', {}, self.reloads),
+            ('signer_config_reload_failures_total', 'counter',
+             'Failed reloads of the config', {}, self.failures),
+        ]
@@ -0,0 +1,79 @@
+#
+# A cache of the signatures that we have recently returned, keyed on the
+# key and the hash of the payload.  When a baker times out and resends
+# exactly the same request, the ratchet would reject it as it has
+# already seen the level and round and the baker would lose a signature
+# that it was entitled to.  Returning the signature that we have already
+# released for identical bytes cannot double sign, so we do that without
+# going to the ratchet or the signer.
+#
+# Entries expire after ttl seconds and the cache holds at most size
+# entries, evicting the least recently used.  Each entry is a little
+# over 200 bytes, so the default of 10000 entries is about 2MB.
+
+import threading
+import time
+from collections import OrderedDict
+
+from tezos_signer import metrics
+
+
+class ReplayCache:
+    def __init__(self, size=10000, ttl=120):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        metrics.register(self)
+
+    def get(self, pkh, sigreq):
+        k = (pkh, sigreq.get_hashed_payload())
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(k)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(k)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[k]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, pkh, sigreq, sig):
+        k = (pkh, sigreq.get_hashed_payload())
+        now = time.monotonic()
+        with self.lock:
+            self.entries[k] = (now + self.ttl, sig)
+            self.entries.move_to_end(k)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            #
+            # Expired entries that are not looked up again would
+            # otherwise stay until they are pushed out by the size
+            # limit, so we drop a few from the old end on each put.
+            for i in range(2):
+                oldest = next(iter(self.entries.values()), None)
+                if oldest is None or oldest[0] > now:
+                    break
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def collect(self):
+        return [
+            ('signer_replay_cache_hits_total', 'counter',
+             'Requests answered with a previously issued signature', {},
+             self.hits),
+            ('signer_replay_cache_misses_total', 'counter',
+             'Requests not found in the replay cache', {}, self.misses),
+            ('signer_replay_cache_evictions_total', 'counter',
+             'Replay cache entries evicted by size or age', {},
+             self.evictions),
+            ('signer_replay_cache_entries', 'gauge',
+             'Entries in the replay cache', {}, len(self.entries)),
+        ]
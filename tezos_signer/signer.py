@@ -3,7 +3,7 @@
 # to implement a constructor and a single method "sign".  They return a
 # base58-encoded signature.
 
-from pytezos.crypto.encoding import base58_encode
+from tezos_signer.encoding import base58_encode
 
 
 class Signer:
@@ -1,63 +1,100 @@
-import string
+import re
 import struct
+from functools import lru_cache
 
-from pytezos.crypto.encoding import base58_encode
-from pytezos.crypto.key import blake2b
 from werkzeug.exceptions import abort
 
+from tezos_signer.encoding import base58_encode, blake2b
+
+#
+# We parse the request in a single pass over a memoryview of the payload,
+# keeping track of our offset rather than slicing off the bytes that we
+# have consumed.  Each parse_* function takes the buffer and the offset
+# and returns the value and the offset of the following field.
+
+hex_re = re.compile(r'[0-9a-fA-F]*')
+be_int = struct.Struct('>L')
 
 def get_be_int(bytes):
-    return struct.unpack('>L', bytes[0:4])[0]
+    return be_int.unpack_from(bytes)[0]
+
+def parse_byte(b, off):
+    return b[off], off + 1
 
-def drop_bytes(b, n):
-    del(b[:n])
+def parse_bytes(b, off, n):
+    if off + n > len(b):
+        raise(struct.error(f"need {n} bytes at offset {off}"))
+    return bytes(b[off:off + n]), off + n
 
-def parse_bytes(b, n):
-    ret = b[:n]
-    drop_bytes(b, n)
-    if n == 1:
-        ret = ord(ret)
-    return ret
+def parse_be_int(b, off):
+    return be_int.unpack_from(b, off)[0], off + 4
 
-def parse_be_int(b):
-    return get_be_int(parse_bytes(b, 4))
+#
+# There are very few chains and so we cache their base58 encodings
+# rather than recompute them on every request.
 
-def parse_chain_id(b):
-    return base58_encode(parse_bytes(b, 4), prefix=b'Net').decode()
+@lru_cache(maxsize=64)
+def encode_chain_id(raw):
+    return base58_encode(raw, prefix=b'Net').decode()
+
+def parse_chain_id(b, off):
+    raw, off = parse_bytes(b, off, 4)
+    return encode_chain_id(raw), off
 
 class SignatureReq:
+    __slots__ = ('blockhash', 'chainid', 'hashed_payload', 'hex_payload',
+                 'level', 'payload', 'period', 'pkh', 'pkh_type',
+                 'proposal', 'round', 'type', 'vote')
+
+    #
+    # The request is given in hex, as it is in the JSON protocol, or as
+    # bytes, as it is in the binary protocol.
 
     def __init__(self, hexdata):
-        if not all(c in string.hexdigits for c in hexdata):
+        if isinstance(hexdata, bytes):
+            self.payload = hexdata
+            self.hex_payload = None
+        elif not isinstance(hexdata, str) or not hex_re.fullmatch(hexdata):
             abort(400, 'Invalid signature request: not all hex digits')
+        else:
+            try:
+                self.payload = bytes.fromhex(hexdata)
+            except ValueError:
+                abort(400, 'Invalid signature request: odd number of ' +
+                           'hex digits')
+            self.hex_payload = hexdata
 
-        self.hex_payload = hexdata
-        self.payload = bytes.fromhex(hexdata)
+        self.hashed_payload = None
+        self.level = None
 
-        data = bytearray(self.payload)
-        self.level   = None
-        tag = parse_bytes(data, 1)
-        self.chainid = parse_chain_id(data)
+        try:
+            self.parse(memoryview(self.payload))
+        except (IndexError, struct.error):
+            abort(400, 'Invalid signature request: truncated')
+
+    def parse(self, data):
+        tag, off = parse_byte(data, 0)
+        self.chainid, off = parse_chain_id(data, off)
 
         if tag == 0x03:   # Operation, for now, we only do ballots
             self.type = "Unknown operation"
-            self.blockhash = parse_bytes(data, 28)    # The block hash
+            self.blockhash, off = parse_bytes(data, off, 28) # The block hash
             errs = []
-            while len(data) > 0:
+            while off < len(data):
                 # The entire operation must be consumed so that the
                 # next byte will be the next operation tag.  Also, for
                 # now, we stop after the first operation as we would need
                 # to update the framework to deal with multiple operations.
                 # We leave the loop in to suggest this later extension.
-                otag = parse_bytes(data, 1)
+                otag, off = parse_byte(data, off)
                 if self.type != "Unknown operation":
                     self.type = "Multiple operations not supported"
                 elif otag == 0x06:                        # 0x06 is a ballot
-                    self.pkh_type = parse_bytes(data, 1)
-                    self.pkh = parse_bytes(data, 20)
-                    self.period = parse_bytes(data, 4)
-                    self.proposal = parse_bytes(data, 32)
-                    vote = parse_bytes(data, 1)
+                    self.pkh_type, off = parse_byte(data, off)
+                    self.pkh, off = parse_bytes(data, off, 20)
+                    self.period, off = parse_bytes(data, off, 4)
+                    self.proposal, off = parse_bytes(data, off, 32)
+                    vote, off = parse_byte(data, off)
                     if vote == 0x00:
                         self.type = "Ballot"
                         self.vote = 'yay'
@@ -70,43 +107,42 @@ class SignatureReq:
                 else:
                     errs.append(f"{otag}")
             if len(errs) > 0:
-                self.type = "Unknown operation tags: {", ".join(errs)}"
+                self.type = f"Unknown operation tags: {', '.join(errs)}"
 
         elif tag == 0x11:   # Tenderbake block
             self.type  = "Baking"
-            self.level = parse_be_int(data)
-            drop_bytes(data, 74)
-            fitness_sz = parse_be_int(data)
-            drop_bytes(data, fitness_sz - 4)
-            self.round = parse_be_int(data)
+            self.level, off = parse_be_int(data, off)
+            fitness_sz, off = parse_be_int(data, off + 74)
+            if fitness_sz < 4:
+                raise(struct.error(f"fitness too short: {fitness_sz}"))
+            self.round, off = parse_be_int(data, off + fitness_sz - 4)
 
         elif tag == 0x12:   # Tenderbake preendorsement
             self.type  = "Preendorsement"
-            drop_bytes(data, 35)
-            self.level = parse_be_int(data)
-            self.round = parse_be_int(data)
+            self.level, off = parse_be_int(data, off + 35)
+            self.round, off = parse_be_int(data, off)
 
         elif tag == 0x13:   # Tenderbake endorsement
             self.type  = "Endorsement"
-            drop_bytes(data, 35)
-            self.level = parse_be_int(data)
-            self.round = parse_be_int(data)
+            self.level, off = parse_be_int(data, off + 35)
+            self.round, off = parse_be_int(data, off)
 
         else:
             self.type = f"Unknown tag: {tag}"
 
-        self.logstr = f"{self.chainid} {self.type}"
-        if self.level is not None:
-            self.logstr += f" at {self.level}/{self.round}"
-
     def get_hex_payload(self):
+        if self.hex_payload is None:
+            self.hex_payload = self.payload.hex()
         return self.hex_payload
 
     def get_payload(self):
         return self.payload
 
     def get_hashed_payload(self):
-        return blake2b(self.payload, digest_size=32).digest()
+        if self.hashed_payload is None:
+            self.hashed_payload = blake2b(self.payload,
+                                          digest_size=32).digest()
+        return self.hashed_payload
 
     def get_type(self):
         return self.type
@@ -124,4 +160,10 @@ class SignatureReq:
         return self.vote
 
     def get_logstr(self):
-        return self.logstr
+        logstr = f"{self.chainid} {self.type}"
+        if self.level is not None:
+            logstr += f" at {self.level}/{self.round}"
+        return logstr
+
+    def __str__(self):
+        return self.get_logstr()
@@ -0,0 +1,162 @@
+#
+# A ChainRatchet which stores its high-water marks in a local SQLite
+# database.  The database is in WAL mode with synchronous=FULL and so
+# each commit is durable once it returns, and SQLite's file locking
+# allows multiple signer processes on the same host to share it.
+#
+# Each check is a conditional upsert which only moves the stored level
+# and round forward, performed in an IMMEDIATE transaction so that the
+# compare and the set are atomic across processes.
+#
+# By default, we group commit: callers queue their checks for a single
+# writer thread which performs everything queued in one transaction and
+# so one fsync covers all of the requests that arrived while the last
+# commit was in flight.  Each caller waits for the commit that contains
+# its check before it learns the result, and so nothing is signed until
+# its high-water mark is on disk.
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from werkzeug.exceptions import Gone, InternalServerError
+
+from tezos_signer import ChainRatchet
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS ratchet (
+        sig_type    TEXT PRIMARY KEY,
+        lastblock   INTEGER NOT NULL,
+        lastround   INTEGER NOT NULL
+    )
+"""
+
+UPSERT = """
+    INSERT INTO ratchet (sig_type, lastblock, lastround) VALUES (?, ?, ?)
+    ON CONFLICT (sig_type) DO UPDATE
+        SET lastblock = excluded.lastblock, lastround = excluded.lastround
+        WHERE lastblock < excluded.lastblock OR
+              (lastblock = excluded.lastblock AND
+               lastround < excluded.lastround)
+"""
+
+SELECT = "SELECT lastblock, lastround FROM ratchet WHERE sig_type = ?"
+
+
+class SQLiteChainRatchet(ChainRatchet):
+
+    def __init__(self, config):
+        self.filename = config.get_sqlite_file()
+        self.group_commit = config.get_sqlite_group_commit()
+        self.group_window = config.get_sqlite_group_window() / 1000.0
+
+        conn = self.connect()
+        self.set_wal(conn)
+        conn.execute(SCHEMA)
+        conn.close()
+
+        self.local = threading.local()
+        self.closed = False
+        if self.group_commit:
+            self.queue = queue.Queue()
+            self.writer = threading.Thread(target=self.write_loop,
+                                           name='sqlite-ratchet',
+                                           daemon=True)
+            self.writer.start()
+
+    def connect(self):
+        conn = sqlite3.connect(self.filename, timeout=30,
+                               isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    #
+    # SQLite does not wait for the busy timeout when another process is
+    # switching the same new database to WAL at the same time, and so we
+    # retry until it would have.
+
+    def set_wal(self, conn):
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                return
+            except sqlite3.OperationalError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.01)
+
+    def update(self, conn, sig_type, level, round):
+        if conn.execute(UPSERT, (sig_type, level, round)).rowcount == 1:
+            return None
+        lastlevel, lastround = conn.execute(SELECT, (sig_type,)).fetchone()
+        return Gone(f"Will not sign {level}/{round} because ratchet " +
+                    f"has seen {lastlevel}/{lastround}")
+
+    def commit(self, conn, reqs):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sig_type, level, round in reqs:
+                    results.append(self.update(conn, sig_type, level, round))
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            logging.error(f"SQLite error during ratchet commit: {e}")
+            return [InternalServerError("DB error") for req in reqs]
+        return results
+
+    #
+    # close() queues None, which stops the writer once it has committed
+    # everything queued before it.
+
+    def write_loop(self):
+        conn = self.connect()
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            if self.group_window > 0:
+                time.sleep(self.group_window)
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+                if len(batch) == 0:
+                    continue
+            results = self.commit(conn, [req for req, fut in batch])
+            for (req, fut), err in zip(batch, results):
+                if err is None:
+                    fut.set_result(True)
+                else:
+                    fut.set_exception(err)
+        conn.close()
+
+    def close(self):
+        if self.group_commit and not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.writer.join()
+
+    def check(self, sig_type, level=0, round=0):
+        if self.group_commit and not self.closed:
+            fut = Future()
+            self.queue.put(((sig_type, level, round), fut))
+            return fut.result()
+
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.connect()
+        err = self.commit(self.local.conn, [(sig_type, level, round)])[0]
+        if err is not None:
+            raise err
+        return True
@@ -3,22 +3,59 @@
 # and then passes it down to a signer.  In order to do this, it must
 # parse the request and to obtain the level and round to pass to the
 # ratchet code.
+#
+# If parallel_ratchet is set, we start the signature in a thread from a
+# shared pool while we run the ratchet in the calling thread, and so a
+# request costs the longer of the two rather than their sum.  This is
+# safe because a signature does no harm until it is released: we only
+# return it once the ratchet has accepted the request and if the
+# ratchet raises, the signature is discarded.
+#
+# Once the policy has allowed a request, we look for it in the replay
+# cache (see replaycache.py).  If we have already signed exactly these
+# bytes with this key, we return the same signature again without going
+# to the ratchet, which would reject the retry, or the signer.
+#
+# Requests which are not in the replay cache then pass through the
+# admission controller, if one is configured, which limits how many are
+# with the ratchet and the signer at once, see admission.py.
 
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from werkzeug.exceptions import abort
 
-from tezos_signer import Signer
+from tezos_signer import Signer, metrics
 
 baking_req_types = ["Baking", "Endorsement", "Preendorsement" ]
 voting_req_types = ["Ballot"]
 
+executor = None
+executor_lock = threading.Lock()
+
+def get_executor(threads):
+    global executor
+
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=threads,
+                                          thread_name_prefix='subsigner')
+        return executor
+
 class ValidateSigner(Signer):
     def __init__(self, config, key, ratchet=None, subsigner=None):
         self.ratchet = ratchet
         self.subsigner = subsigner
         self.policy = config.get_policy()
         self.key = key
+        self.ratchet_name = type(ratchet).__name__
+        self.subsigner_name = type(subsigner).__name__
+        self.replay_cache = config.get_replay_cache()
+        self.admission = config.get_admission()
+        self.executor = None
+        if config.get_parallel_ratchet():
+            self.executor = get_executor(config.get_executor_threads())
 
     def check_policy(self, sigreq):
         allowed = False
@@ -42,16 +79,54 @@ class ValidateSigner(Signer):
             abort(403, 'Request is against policy')
 
     def sign(self, sigreq):
-        logging.debug(f"About to sign {sigreq.get_hex_payload()}")
+        logging.debug("About to sign %s", sigreq.get_hex_payload())
 
-        self.check_policy(sigreq)
+        pkh = self.key['pkh']
+        req_type = sigreq.get_type()
 
-        if sigreq.get_type() in baking_req_types:
-            sig_type = f"{sigreq.get_type()}_{sigreq.get_chainid()}"
-            sig_type += f"_{self.key['pkh']}"
-            level = sigreq.get_level()
-            round = sigreq.get_round()
+        with metrics.timed('policy', pkh, req_type, 'python'):
+            self.check_policy(sigreq)
+
+        if self.replay_cache is None:
+            return self.admit_and_sign(sigreq)
+
+        sig = self.replay_cache.get(pkh, sigreq)
+        if sig is None:
+            sig = self.admit_and_sign(sigreq)
+            self.replay_cache.put(pkh, sigreq, sig)
+        return sig
+
+    def admit_and_sign(self, sigreq):
+        if self.admission is None:
+            return self.ratchet_and_sign(sigreq)
+        with self.admission.admit(self.key['pkh'], sigreq.get_type()):
+            return self.ratchet_and_sign(sigreq)
+
+    def ratchet_and_sign(self, sigreq):
+        pkh = self.key['pkh']
+        req_type = sigreq.get_type()
+        if req_type not in baking_req_types:
+            return self.subsign(sigreq)
+
+        sig_type = f"{req_type}_{sigreq.get_chainid()}_{pkh}"
+        level = sigreq.get_level()
+        round = sigreq.get_round()
+
+        if self.executor is None:
+            with metrics.timed('ratchet', pkh, req_type, self.ratchet_name):
+                self.ratchet.check(sig_type, level, round)
+            return self.subsign(sigreq)
 
-            self.ratchet.check(sig_type, level, round)
+        sig = self.executor.submit(self.subsign, sigreq)
+        try:
+            with metrics.timed('ratchet', pkh, req_type, self.ratchet_name):
+                self.ratchet.check(sig_type, level, round)
+        except BaseException:
+            sig.cancel()
+            raise
+        return sig.result()
 
-        return self.subsigner.sign(sigreq)
+    def subsign(self, sigreq):
+        with metrics.timed('sign', self.key['pkh'], sigreq.get_type(),
+                           self.subsigner_name):
+            return self.subsigner.sign(sigreq)